@@ -0,0 +1,39 @@
+"""
+Code to convert the NetCDF output of an extraction (e.g. from extract_box.py,
+extract_box_chunks.py, or the mooring extractions) to a time-chunked, compressed
+zarr or NetCDF store, using lo_tools/store_functions.py.
+
+The output goes next to the input file, with the suffix for the new store type.
+
+Example:
+python convert_store.py -in_fn [path to]/byrd_surf_2019.01.01_2019.12.31.nc -store zarr
+
+Then read it lazily, like:
+from lo_tools import store_functions
+ds = store_functions.open_store([path to]/byrd_surf_2019.01.01_2019.12.31.zarr)
+"""
+
+import sys
+import argparse
+from pathlib import Path
+from time import time
+from lo_tools import store_functions
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-in_fn', type=str) # full path to the file to convert
+parser.add_argument('-store', type=str, default='zarr') # zarr or nc
+parser.add_argument('-nt_chunk', type=int, default=24) # number of times in a chunk
+args = parser.parse_args()
+
+if args.in_fn == None:
+    print('*** Missing required argument: in_fn')
+    sys.exit()
+in_fn = Path(args.in_fn)
+out_fn = store_functions.get_store_fn(in_fn, args.store)
+if out_fn == in_fn:
+    out_fn = in_fn.parent / (in_fn.stem + '_chunked' + in_fn.suffix)
+
+tt0 = time()
+store_functions.convert_store(in_fn, out_fn, nt_chunk=args.nt_chunk)
+print('Converted %s\n => %s' % (str(in_fn), str(out_fn)))
+print('Time to convert = %0.2f sec' % (time()-tt0))
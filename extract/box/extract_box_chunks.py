@@ -19,6 +19,21 @@ which is too much for even the 32 GB on my mac.
 I consider this code a hack to solve a pressing problem, but in the long run I will
 be using more sophisticated tools like zarr and dask.
 
+2026.10.18 Recoded as a single streaming pass, with no ncks, ncrcat, or temporary files.
+Each history file is read once (just the box hyperslab, using netCDF4) by a
+multiprocessing Pool with Nproc workers. The z variables, uv_to_rho averaging, and
+surf/bot selection are done for that one time step, and the result is written as one
+time record of a single chunked, compressed (zlib, complevel=1) output file. So memory
+use is about one time step per worker, no matter how long the extraction is. The
+contents of the output file are the same as before. The folder name still ends
+in "_chunks", so existing workflows will find it.
+
+2026.10.18 The output is written using lo_tools/store_functions.py. Use -store zarr
+to make a zarr store instead of NetCDF. Use -append True to add the times to a store
+named for the job (with no dates) in LO_output/extract/[gtagex]/box, so you can build
+up a long record one day at a time. Read the output lazily with store_functions.open_store().
+Older NetCDF output can be converted with convert_store.py.
+
 Testing:
 run extract_box_chunks.py -gtx cas6_v0_live -job byrd -surf True -uv_to_rho True -test True
 
@@ -31,12 +46,14 @@ python extract_box_chunks.py -gtx cas6_v0_live -ro 0 -lt hourly -0 2019.01.01 -1
 import sys
 import argparse
 from lo_tools import Lfun, zfun, zrfun
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
+from lo_tools import store_functions
 import os
 from time import time
 import numpy as np
 import xarray as xr
+import netCDF4 as nc
+import multiprocessing as mp
+from collections import deque
 
 pid = os.getpid()
 print(' extract_box_monthly '.center(60,'='))
@@ -59,6 +76,10 @@ parser.add_argument('-surf', default=False, type=Lfun.boolean_string)
 parser.add_argument('-bot', default=False, type=Lfun.boolean_string)
 # set this to True to interpolate all u, and v fields to the rho-grid
 parser.add_argument('-uv_to_rho', default=False, type=Lfun.boolean_string)
+# Optional: output type, nc (NetCDF) or zarr, see lo_tools/store_functions.py
+parser.add_argument('-store', type=str, default='nc')
+# Optional: set this to True to add the times to an existing store (job name only, no dates)
+parser.add_argument('-append', default=False, type=Lfun.boolean_string)
 # Optional: set max number of subprocesses to run at any time
 parser.add_argument('-Nproc', type=int, default=10)
 # Optional: for testing
@@ -106,8 +127,12 @@ elif Ldir['bot']:
 else:
     bb_str = '_'
 
-out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'box' / (Ldir['job'] + bb_str + dd_str + '_chunks')
-Lfun.make_dir(out_dir, clean=True)
+if Ldir['append']:
+    out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'box'
+    Lfun.make_dir(out_dir)
+else:
+    out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'box' / (Ldir['job'] + bb_str + dd_str + '_chunks')
+    Lfun.make_dir(out_dir, clean=True)
 
 # get list of files to work on
 fn_list = Lfun.get_fn_list(Ldir['list_type'], Ldir, Ldir['ds0'], Ldir['ds1'])
@@ -142,261 +167,233 @@ lon0, lon1, lat0, lat1 = aa
 ilon0, ilat0 = check_bounds(lon0, lat0)
 ilon1, ilat1 = check_bounds(lon1, lat1)
 
-# NOTE: ncks indexing is zero-based but is INCLUSIVE of the last point.
-# NOTE: ncks extractions retain singleton dimensions
-
 # naming the final output file
-box_fn_final = out_dir / (Ldir['job'] + bb_str + dd_str + '.nc')
+if Ldir['append']:
+    # the store keeps growing, so its name has no dates
+    box_fn_final = store_functions.get_store_fn(out_dir / (Ldir['job'] + bb_str[:-1]), Ldir['store'])
+else:
+    box_fn_final = store_functions.get_store_fn(out_dir / (Ldir['job'] + bb_str + dd_str), Ldir['store'])
 
-## Start of chunks loop
 tt00 = time()
-NFN = len(fn_list)
-cca = np.arange(NFN)
-# The number of "chunks" is the "12" in this call.  The function np.array_split() is a
-# really handy way to split a vectory into a number of approximatly equal-length sub vectors.
-ccas = np.array_split(cca, 12)
-
-counter = 0
-for this_cca in ccas:
-    cc0 = this_cca[0]
-    cc1 = this_cca[-1]
-    print('\nWorking on index range %d:%d' % (cc0, cc1))
-    sys.stdout.flush()
-    
-    this_fn_list = fn_list[cc0:cc1+1]
-
-    box_fn = out_dir / ('chunk_' + ('0000' + str(counter))[-4:] +'.nc')
-    # also make a temporary name for adding variables
-    box_temp_fn = out_dir / ('chunk_temp_' + ('0000' + str(counter))[-4:] +'.nc')
-    # name the temp dir to accumulate individual extractions
-    temp_dir = out_dir / 'temp_dir'
+NT = len(fn_list)
 
-    box_fn.unlink(missing_ok=True)
-    box_temp_fn.unlink(missing_ok=True)
-    Lfun.make_dir(temp_dir, clean=True)
+# Slices for the box on each grid. As in the old ncks version the box limits
+# are on the rho grid, and u and v are the points inside them.
+box_dict = {'rho': (slice(ilat0, ilat1+1), slice(ilon0, ilon1+1)),
+    'u': (slice(ilat0, ilat1+1), slice(ilon0, ilon1)),
+    'v': (slice(ilat0, ilat1), slice(ilon0, ilon1+1))}
+# mask on the rho grid, True over water
+Maskr = G['mask_rho'][box_dict['rho']] == 1
+NR, NC = Maskr.shape
 
-    # do the initial extractions
-    N = len(this_fn_list)
-    proc_list = []
-    tt0 = time()
-    print('Working on ' + box_fn.name + ' (' + str(N) + ' times)')
-    sys.stdout.flush()
-    for ii in range(N):
-        fn = this_fn_list[ii]
-        # extract one day at a time using ncks
-        count_str = ('000000' + str(ii))[-6:]
-        out_fn = temp_dir / ('box_' + count_str + '.nc')
-        cmd_list1 = ['ncks',
-            '-v', vn_list,
-            '-d', 'xi_rho,'+str(ilon0)+','+str(ilon1), '-d', 'eta_rho,'+str(ilat0)+','+str(ilat1),
-            '-d', 'xi_u,'+str(ilon0)+','+str(ilon1-1), '-d', 'eta_u,'+str(ilat0)+','+str(ilat1),
-            '-d', 'xi_v,'+str(ilon0)+','+str(ilon1), '-d', 'eta_v,'+str(ilat0)+','+str(ilat1-1)]
-        if Ldir['surf']:
-            cmd_list1 += ['-d','s_rho,'+str(S['N']-1)]
-        elif Ldir['bot']:
-            cmd_list1 += ['-d','s_rho,0']
-        cmd_list1 += ['-O', str(fn), str(out_fn)]
-        proc = Po(cmd_list1, stdout=Pi, stderr=Pi)
-        proc_list.append(proc)
+# get the list of variables to extract, and where they live on the grid
+ds = nc.Dataset(fn_list[0])
+vn_list = [vn for vn in vn_list.split(',') if vn in ds.variables]
+grid_dict = dict() # 'rho', 'u', or 'v'
+vdim_dict = dict() # 's_rho', 's_w', or None
+for vn in vn_list:
+    dims = ds[vn].dimensions
+    if 'xi_u' in dims:
+        grid_dict[vn] = 'u'
+    elif 'xi_v' in dims:
+        grid_dict[vn] = 'v'
+    else:
+        grid_dict[vn] = 'rho'
+    if 's_rho' in dims:
+        vdim_dict[vn] = 's_rho'
+    elif 's_w' in dims:
+        vdim_dict[vn] = 's_w'
+    else:
+        vdim_dict[vn] = None
+# fields that do not change with time
+static_list = [vn for vn in vn_list if 'ocean_time' not in ds[vn].dimensions]
+time_list = [vn for vn in vn_list if vn not in static_list]
+grid_list = list(set(grid_dict.values()))
+# things that do not change with time
+attrs_dict = dict()
+for vn in vn_list + ['ocean_time', 's_rho', 's_w']:
+    attrs_dict[vn] = {k:ds[vn].getncattr(k) for k in ds[vn].ncattrs()
+        if k not in ['_FillValue', 'coordinates']}
+global_attrs = {k:ds.getncattr(k) for k in ds.ncattrs()}
+static_dict = dict()
+for vn in static_list:
+    static_dict[vn] = ds[vn][box_dict[grid_dict[vn]]]
+s_rho = ds['s_rho'][:]
+s_w = ds['s_w'][:]
+ds.close()
 
-        # screen output about progress
-        if (np.mod(ii,10) == 0) and ii>0:
-            print(str(ii), end=', ')
-            sys.stdout.flush()
-        if (np.mod(ii,50) == 0) and (ii > 0):
-            print('') # line feed
-            sys.stdout.flush()
-        if (ii == N-1):
-            print(str(ii))
-            sys.stdout.flush()
-    
-        # Nproc controls how many ncks subprocesses we allow to stack up
-        # before we require them all to finish.
-        if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
-            for proc in proc_list:
-                proc.communicate()
-            # make sure everyone is finished before continuing
-            proc_list = []
-        ii += 1
-    print(' Time to for initial extraction = %0.2f sec' % (time()- tt0))
-    sys.stdout.flush()
+# the z variables need zeta and h
+do_z = (Ldir['surf']==False) and (Ldir['bot']==False)
+if do_z and (('zeta' not in time_list) or ('h' not in static_list)):
+    print('Warning: need h and zeta in vn_list to add z variables')
+    do_z = False
+if do_z:
+    h = G['h'][box_dict['rho']]
 
-    # Ensure that all days have the same fill value.  This was required for cas6_v3_lo8b
-    # when passing from 2021.10.31 to 2021.11.01 because they had inconsistent fill values,
-    # which leaks through the ncrcat call below.
-    tt0 = time()
-    enc_dict = {'_FillValue':1e20}
-    vn_List = vn_list.split(',')
-    Enc_dict = {vn:enc_dict for vn in vn_List}
-    for out_fn in list(temp_dir.glob('box_*.nc')):
-        out_temp_fn = out_fn.parent / out_fn.name.replace('box', 'xob')
-        ds = xr.open_dataset(out_fn)
-        ds.to_netcdf(out_temp_fn, encoding=Enc_dict)
-        ds.close()
-        out_temp_fn.replace(out_fn)
-    print(' Time for adding fill value = %0.2f sec' % (time()- tt0))
-    sys.stdout.flush()
+# index of the s_rho level to get for surf or bot
+if Ldir['surf']:
+    nlev = S['N'] - 1
+elif Ldir['bot']:
+    nlev = 0
+else:
+    nlev = None
 
-    # concatenate the records into one file
-    # This bit of code is a nice example of how to replicate a bash pipe
-    tt0 = time()
-    pp1 = Po(['ls', str(temp_dir)], stdout=Pi)
-    pp2 = Po(['grep','box'], stdin=pp1.stdout, stdout=Pi)
-    cmd_list = ['ncrcat','-p', str(temp_dir), '-O', str(box_fn)]
-    proc = Po(cmd_list, stdin=pp2.stdout, stdout=Pi, stderr=Pi)
-    stdout, stderr = proc.communicate()
-    if len(stdout) > 0:
-        print('\n'+stdout.decode())
-    if len(stderr) > 0:
-        print('\n'+stderr.decode())
-    print(' Time to concatenate initial extraction = %0.2f sec' % (time()- tt0))
-    sys.stdout.flush()
+def to_rho(aa, gr):
+    """
+    Interpolate a field on the u or v grid to the rho grid, assuming
+    zero values where masked, and leaving a masked ring around the outermost edge.
+    """
+    aa = aa.copy()
+    aa[np.isnan(aa)] = 0
+    if gr == 'u':
+        AA = (aa[...,1:-1,1:] + aa[...,1:-1,:-1])/2
+    elif gr == 'v':
+        AA = (aa[...,1:,1:-1] + aa[...,:-1,1:-1])/2
+    aaa = np.nan * np.ones(aa.shape[:-2] + (NR, NC), dtype=aa.dtype)
+    aaa[...,1:-1,1:-1] = AA
+    aaa[...,~Maskr] = np.nan
+    return aaa
 
+def get_one_time(fn):
+    """
+    Does the extraction for a single history file.
+    Returns a dict of arrays, ready to write as one time record.
+    """
+    ds = nc.Dataset(fn)
+    CC = dict()
+    CC['ocean_time'] = float(ds['ocean_time'][0])
+    for vn in time_list:
+        js, is_ = box_dict[grid_dict[vn]]
+        if (vdim_dict[vn] == 's_rho') and (nlev != None):
+            aa = ds[vn][0, nlev, js, is_]
+        else:
+            aa = ds[vn][0, ..., js, is_]
+        # Masked values become nan. netCDF4 uses the _FillValue of each file, so
+        # files with different fill values are handled correctly.
+        if np.ma.isMaskedArray(aa):
+            aa = aa.filled(np.nan)
+        if Ldir['uv_to_rho'] and (grid_dict[vn] in ['u', 'v']):
+            aa = to_rho(aa, grid_dict[vn])
+        CC[vn] = aa
+    ds.close()
     # add z variables
-    # NOTE: this only works if you have salt as a saved field!
-    try:
-        if (Ldir['surf']==False) and (Ldir['bot']==False):
-            tt0 = time()
-            ds = xr.open_dataset(box_fn)
-            NT, N, NR, NC = ds.salt.shape
-            ds.update({'z_rho':(('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), np.nan*np.ones((NT, N, NR, NC)))})
-            ds.update({'z_w':(('ocean_time', 's_w', 'eta_rho', 'xi_rho'), np.nan*np.ones((NT, N+1, NR, NC)))})
-            ds.z_rho.attrs = {'units':'m', 'long_name': 'vertical position on s_rho grid, positive up'}
-            ds.z_w.attrs = {'units':'m', 'long_name': 'vertical position on s_w grid, positive up'}
-            for ii in range(NT):
-                h = ds.h.values
-                zeta = ds.zeta[ii,:,:].values
-                z_rho, z_w = zrfun.get_z(h, zeta, S)
-                ds['z_rho'][ii,:,:,:] = z_rho
-                ds['z_w'][ii,:,:,:] = z_w
-            ds.to_netcdf(box_temp_fn)
-            ds.close()
-            box_temp_fn.replace(box_fn)
-            print(' Time to add z variables = %0.2f sec' % (time()- tt0))
-            sys.stdout.flush()
-    except Exception as e:
-        print(' * Exception while adding z variables')
-        print(e)
+    if do_z:
+        CC['z_rho'], CC['z_w'] = zrfun.get_z(h, CC['zeta'], S)
+    return CC
 
+def get_dims(vn):
+    # dimensions of time-dependent variable vn in the output file
+    gr = grid_dict[vn]
     if Ldir['uv_to_rho']:
-        try:
-            # interpolate anything on the u and v grids to the rho grid, assuming
-            # zero values where masked, and leaving a masked ring around the outermost edge
-            tt0 = time()
-            ds = xr.open_dataset(box_fn)
-            Maskr = ds.mask_rho.values == 1 # True over water
-            NR, NC = Maskr.shape
-            for vn in ds.data_vars:
-                if ('xi_u' in ds[vn].dims) and ('ocean_time' in ds[vn].dims):
-                    if len(ds[vn].dims) == 4:
-                        uu = ds[vn].values
-                        NT, N, NRu, NCu = uu.shape
-                        uu[np.isnan(uu)] = 0
-                        UU = (uu[:,:,1:-1,1:]+uu[:,:,1:-1,:-1])/2
-                        uuu = np.nan * np.ones((NT, N, NR, NC))
-                        uuu[:,:,1:-1,1:-1] = UU
-                        Maskr3 = np.tile(Maskr.reshape(1,1,NR,NC),[NT,N,1,1])
-                        uuu[~Maskr3] = np.nan
-                        ds.update({vn:(('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), uuu)})
-                    elif len(ds[vn].dims) == 3:
-                        uu = ds[vn].values
-                        NT, NRu, NCu = uu.shape
-                        uu[np.isnan(uu)] = 0
-                        UU = (uu[:,1:-1,1:]+uu[:,1:-1,:-1])/2
-                        uuu = np.nan * np.ones((NT, NR, NC))
-                        uuu[:,1:-1,1:-1] = UU
-                        Maskr3 = np.tile(Maskr.reshape(1,NR,NC),[NT,1,1])
-                        uuu[~Maskr3] = np.nan
-                        ds.update({vn:(('ocean_time', 'eta_rho', 'xi_rho'), uuu)})
-                elif ('xi_v' in ds[vn].dims) and ('ocean_time' in ds[vn].dims):
-                    if len(ds[vn].dims) == 4:
-                        vv = ds[vn].values
-                        NT, N, NRv, NCv = vv.shape
-                        vv[np.isnan(vv)] = 0
-                        VV = (vv[:,:,1:,1:-1]+vv[:,:,:-1,1:-1])/2
-                        vvv = np.nan * np.ones((NT, N, NR, NC))
-                        vvv[:,:,1:-1,1:-1] = VV
-                        Maskr3 = np.tile(Maskr.reshape(1,1,NR,NC),[NT,N,1,1])
-                        vvv[~Maskr3] = np.nan
-                        ds.update({vn:(('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), vvv)})
-                    elif len(ds[vn].dims) == 3:
-                        vv = ds[vn].values
-                        NT, NRv, NCv = vv.shape
-                        vv[np.isnan(vv)] = 0
-                        VV = (vv[:,1:,1:-1]+vv[:,:-1,1:-1])/2
-                        vvv = np.nan * np.ones((NT, NR, NC))
-                        vvv[:,1:-1,1:-1] = VV
-                        Maskr3 = np.tile(Maskr.reshape(1,NR,NC),[NT,1,1])
-                        vvv[~Maskr3] = np.nan
-                        ds.update({vn:(('ocean_time', 'eta_rho', 'xi_rho'), vvv)})
-            ds.to_netcdf(box_temp_fn)
-            ds.close()
-            box_temp_fn.replace(box_fn)
-            print(' Time to interpolate uv variables to rho grid = %0.2f sec' % (time()- tt0))
-            sys.stdout.flush()
-        except Exception as e:
-            print('Exception during uv_to_rho step')
-            print(e)
-    
-    # squeeze the resulting file
-    try:
-        tt0 = time()
-        ds = xr.open_dataset(box_fn)
-        ds = ds.squeeze(drop=True) # remove singleton dimensions
-        ds.to_netcdf(box_temp_fn)
-        ds.close()
-        box_temp_fn.replace(box_fn)
-        print(' Time to squeeze = %0.2f sec' % (time()- tt0))
-        sys.stdout.flush()
-    except Exception as e:
-        print(' * Exception during squeeze')
-        print(e)
-        
-    # compress the resulting file
-    try:
-        tt0 = time()
-        ds = xr.open_dataset(box_fn)
-        enc_dict = {'zlib':True, 'complevel':1, '_FillValue':1e20}
-        Enc_dict = {vn:enc_dict for vn in ds.data_vars if 'ocean_time' in ds[vn].dims}
-        ds.to_netcdf(box_temp_fn, encoding=Enc_dict)
-        ds.close()
-        box_temp_fn.replace(box_fn)
-        print(' Time to compress = %0.2f sec' % (time()- tt0))
-        sys.stdout.flush()
-    except Exception as e:
-        print(' * Exception compress step')
-        print(e)
+        gr = 'rho'
+    dims = ('ocean_time',)
+    if (vdim_dict[vn] == 's_w') or ((vdim_dict[vn] == 's_rho') and (nlev == None)):
+        dims += (vdim_dict[vn],)
+    dims += ('eta_' + gr, 'xi_' + gr)
+    return dims
 
-    # clean up
-    Lfun.make_dir(temp_dir, clean=True)
-    temp_dir.rmdir()
-    
-    counter += 1
-    ## End of month loop
-    
-# concatenate the chunks into one file
+def start_file(CC):
+    # Create the output store, using the first result to get the data types.
+    # grids used in the output file
+    if Ldir['uv_to_rho']:
+        out_grid_list = ['rho']
+    else:
+        out_grid_list = list(set(['rho'] + grid_list))
+    dim_dict = dict()
+    var_dict = dict()
+    if nlev == None:
+        dim_dict['s_rho'] = S['N']
+        var_dict['s_rho'] = {'dims':('s_rho',), 'dtype':float, 'attrs':attrs_dict['s_rho'], 'data':s_rho}
+    if do_z or ('s_w' in vdim_dict.values()):
+        dim_dict['s_w'] = S['N']+1
+        var_dict['s_w'] = {'dims':('s_w',), 'dtype':float, 'attrs':attrs_dict['s_w'], 'data':s_w}
+    for gr in out_grid_list:
+        js, is_ = box_dict[gr]
+        dim_dict['eta_' + gr] = js.stop - js.start
+        dim_dict['xi_' + gr] = is_.stop - is_.start
+    var_dict['ocean_time'] = {'dims':('ocean_time',), 'dtype':float, 'attrs':attrs_dict['ocean_time']}
+    # lon and lat on each grid
+    for gr in out_grid_list:
+        for ll in ['lon', 'lat']:
+            var_dict[ll + '_' + gr] = {'dims':('eta_' + gr, 'xi_' + gr), 'dtype':float,
+                'attrs':dict(), 'data':G[ll + '_' + gr][box_dict[gr]]}
+    for vn in static_list:
+        gr = grid_dict[vn]
+        attrs = attrs_dict[vn].copy()
+        attrs['coordinates'] = 'lon_' + gr + ' lat_' + gr
+        var_dict[vn] = {'dims':('eta_' + gr, 'xi_' + gr), 'dtype':static_dict[vn].dtype,
+            'attrs':attrs, 'data':static_dict[vn]}
+    # Time-dependent variables are compressed, and chunked by time record,
+    # so each record is written (and can be read back) independently.
+    for vn in time_list:
+        dims = get_dims(vn)
+        attrs = attrs_dict[vn].copy()
+        attrs['coordinates'] = 'lon_' + dims[-1][3:] + ' lat_' + dims[-1][3:]
+        var_dict[vn] = {'dims':dims, 'dtype':CC[vn].dtype, 'attrs':attrs}
+    if do_z:
+        for vn in ['z_rho', 'z_w']:
+            var_dict[vn] = {'dims':('ocean_time', vn.replace('z_','s_'), 'eta_rho', 'xi_rho'),
+                'dtype':CC[vn].dtype, 'attrs':{'units':'m', 'coordinates':'lon_rho lat_rho'}}
+        var_dict['z_rho']['attrs']['long_name'] = 'vertical position on s_rho grid, positive up'
+        var_dict['z_w']['attrs']['long_name'] = 'vertical position on s_w grid, positive up'
+    St = store_functions.start_store(box_fn_final, dim_dict, var_dict,
+        global_attrs=global_attrs, nt_chunk=1, append=Ldir['append'])
+    return St
+
+def write_one_time(St, CC):
+    # Add one result to the output store.
+    CC_dict = {vn:np.asarray(CC[vn])[np.newaxis] for vn in St['time_list']}
+    store_functions.write_block(St, CC_dict)
+
+# loop over all history files
+print('Working on ' + box_fn_final.name + ' (' + str(NT) + ' times)')
+sys.stdout.flush()
 tt0 = time()
-pp1 = Po(['ls', str(out_dir)], stdout=Pi)
-pp2 = Po(['grep','chunk_'], stdin=pp1.stdout, stdout=Pi)
-cmd_list = ['ncrcat','-p', str(out_dir), '-O', str(box_fn_final)]
-proc = Po(cmd_list, stdin=pp2.stdout, stdout=Pi, stderr=Pi)
-stdout, stderr = proc.communicate()
-if len(stdout) > 0:
-    print('\n'+stdout.decode())
-if len(stderr) > 0:
-    print('\n'+stderr.decode())
-print(' Time to concatenate chunks = %0.2f sec' % (time()- tt0))
+if Ldir['Nproc'] > 1:
+    # The workers are forked, so they inherit all the index info above.
+    # We only let 2*Nproc results be pending at a time, to limit memory use.
+    pool = mp.get_context('fork').Pool(min(Ldir['Nproc'], NT))
+    pending = deque()
+    ifn = 0
+    def CC_gen():
+        global ifn
+        for ii in range(NT):
+            while (ifn < NT) and (len(pending) < 2*Ldir['Nproc']):
+                pending.append(pool.apply_async(get_one_time, (fn_list[ifn],)))
+                ifn += 1
+            yield pending.popleft().get()
+    CC_iter = CC_gen()
+else:
+    pool = None
+    CC_iter = map(get_one_time, fn_list)
+for ii, CC in enumerate(CC_iter):
+    if ii == 0:
+        St = start_file(CC)
+    write_one_time(St, CC)
+    # screen output about progress
+    if (np.mod(ii,10) == 0) and ii>0:
+        print(str(ii), end=', ')
+        sys.stdout.flush()
+    if (np.mod(ii,50) == 0) and (ii > 0):
+        print('') # line feed
+        sys.stdout.flush()
+    if (ii == NT-1):
+        print(str(ii))
+        sys.stdout.flush()
+if pool != None:
+    pool.close()
+    pool.join()
+store_functions.close_store(St)
+print(' Time for extraction = %0.2f sec' % (time()- tt0))
 sys.stdout.flush()
 
 # Finale
 print('\nSize of full rho-grid = %s' % (str(G['lon_rho'].shape)))
 print(' \nContents of extracted box file: '.center(60,'-'))
 # check on the results
-ds = xr.open_dataset(box_fn_final)
+ds = store_functions.open_store(box_fn_final)
 for vn in ds.data_vars:
     print('%s %s' % (vn, str(ds[vn].shape)))
 ds.close()
 print('\nPath to file:\n%s' % (str(box_fn_final)))
 print('\nTotal time = %0.2f sec' % (time()- tt00))
-
-
@@ -4,6 +4,7 @@ Module of functions for cast extractions.
 
 from lo_tools import zfun, zrfun
 
+import sys
 import subprocess
 import xarray as xr
 import numpy as np
@@ -32,16 +33,7 @@ def get_cast(out_fn, fn, lon, lat, npzd):
         print('ERROR: point on land mask ' + out_fn.name)
         return
         
-    v_list = 'AKs,salt,temp,h'
-    if npzd == 'new':
-        v_list += ',phytoplankton,chlorophyll,zooplankton,SdetritusN,LdetritusN,oxygen,alkalinity,TIC,NO3,NH4'
-    elif npzd == 'old':
-        v_list += ',phytoplankton,zooplankton,detritus,Ldetritus,oxygen,alkalinity,TIC,NO3'
-    elif npzd == 'none':
-        pass
-    else:
-        print('Error: unrecognized npzd')
-        sys.exit()
+    v_list = get_v_list(npzd)
     
     # Run ncks to do the extraction, overwriting any existing file
     cmd_list = ['ncks', '-d', 'xi_rho,'+str(ix), '-d', 'eta_rho,'+str(iy),
@@ -71,6 +63,60 @@ def get_cast(out_fn, fn, lon, lat, npzd):
     foo.to_netcdf(out_fn)
     foo.close()
         
+def get_v_list(npzd):
+    # The list of variables to extract.
+    # Note: We get AKs so that the s_w dimension is retained
+    v_list = 'AKs,salt,temp,h'
+    if npzd == 'new':
+        v_list += ',phytoplankton,chlorophyll,zooplankton,SdetritusN,LdetritusN,oxygen,alkalinity,TIC,NO3,NH4'
+    elif npzd == 'old':
+        v_list += ',phytoplankton,zooplankton,detritus,Ldetritus,oxygen,alkalinity,TIC,NO3'
+    elif npzd == 'none':
+        pass
+    else:
+        print('Error: unrecognized npzd')
+        sys.exit()
+    return v_list
+
+def get_casts_one_file(fn, cast_list, npzd, S):
+    """
+    Does the extraction of all the casts in cast_list that come from the same
+    history file fn, reading the file only once, and saves each one to a NetCDF
+    file just like get_cast().
+    
+    cast_list is a list of (out_fn, iy, ix) tuples, where (iy, ix) are the
+    rho-grid indices of a cast, already checked to be in bounds and not on land.
+    """
+    ds = xr.open_dataset(fn)
+    v_list = []
+    for vn in get_v_list(npzd).split(','):
+        if vn in ds.data_vars:
+            v_list.append(vn)
+        else:
+            # the ncks path in get_cast() would fail here, so at least say so
+            print('WARNING: %s not in %s, skipping it' % (vn, fn.name))
+    # get all the profiles at once using vectorized point indexing
+    iy = xr.DataArray([cc[1] for cc in cast_list], dims='cast')
+    ix = xr.DataArray([cc[2] for cc in cast_list], dims='cast')
+    dsc = ds[v_list].isel(eta_rho=iy, xi_rho=ix).load()
+    ds.close()
+    for ii in range(len(cast_list)):
+        out_fn = cast_list[ii][0]
+        # Add z-coordinates, as in get_cast()
+        foo = dsc.isel(cast=ii).squeeze()
+        z_rho, z_w = zrfun.get_z(foo['h'].values, np.array([0.]), S)
+        foo['z_rho'] = (('s_rho'), z_rho)
+        foo['z_w'] = (('s_w'), z_w)
+        foo.s_rho.attrs['long_name'] = 'vertical position on s_rho grid, positive up, zero at surface'
+        foo.s_rho.attrs['units'] = 'm'
+        foo.s_w.attrs['long_name'] = 'vertical position on s_w grid, positive up, zero at surface'
+        foo.s_w.attrs['units'] = 'm'
+        foo.salt.attrs['units'] = 'g kg-1'
+        out_fn.unlink(missing_ok=True)
+        foo.to_netcdf(out_fn)
+        foo.close()
+    return [cc[0].name for cc in cast_list]
+
 def get_his_fn_from_dt(Ldir, dt):
     # This creates the Path of a history file from its datetime
     if dt.hour == 0:
@@ -6,6 +6,7 @@ using subprocess.
 """
 
 from lo_tools import Lfun, zfun, zrfun
+import cast_functions as cfun
 import subprocess
 import xarray as xr
 import numpy as np
@@ -31,7 +32,8 @@ lat = float(args.lat)
 npzd = args.npzd
     
 # This function does the cast extraction and saves it to a NetCDF file.
-G, S, T = zrfun.get_basic_info(fn)
+# The grid info comes from a cache already checked by extract_casts_fast.py.
+G, S, T = zrfun.get_basic_info_cached(fn, check=False)
 Lon = G['lon_rho'][0,:]
 Lat = G['lat_rho'][:,0]
 
@@ -51,16 +53,7 @@ if G['mask_rho'][iy,ix] == 0:
     print('ERROR: point on land mask ' + out_fn.name)
     sys.exit()
     
-v_list = 'AKs,salt,temp,h'
-if npzd == 'new':
-    v_list += ',phytoplankton,chlorophyll,zooplankton,SdetritusN,LdetritusN,oxygen,alkalinity,TIC,NO3,NH4'
-elif npzd == 'old':
-    v_list += ',phytoplankton,zooplankton,detritus,Ldetritus,oxygen,alkalinity,TIC,NO3'
-elif npzd == 'none':
-    pass
-else:
-    print('Error: unrecognized npzd')
-    sys.exit()
+v_list = cfun.get_v_list(npzd)
 
 # Run ncks to do the extraction, overwriting any existing file
 cmd_list = ['ncks', '-d', 'xi_rho,'+str(ix), '-d', 'eta_rho,'+str(iy),
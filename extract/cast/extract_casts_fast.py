@@ -5,9 +5,19 @@ capability.
 
 Refactored 2022_07 to conform to the new cast data format.
 
+2026.10.18 Added a batch mode, used with -batch True. Many casts come from the same
+history file, so this groups the casts by history file, and then a multiprocessing
+Pool with Nproc workers reads each file once, gets all the profiles for that file with
+vectorized point indexing, and writes the same per-cast NetCDF files as cast_worker.py.
+This avoids launching a python process and an ncks call for every cast, so it is much
+faster for years with thousands of casts, and it does not need NCO.
+
 Test on mac in ipython:
 run extract_casts_fast -gtx cas6_v0_live -source ecology -otype ctd -year 2019 -test True
 
+or in batch mode:
+run extract_casts_fast -gtx cas6_v0_live -source ecology -otype ctd -year 2019 -test True -batch True
+
 """
 
 import sys
@@ -24,6 +34,7 @@ from time import time
 from subprocess import Popen as Po
 from subprocess import PIPE as Pi
 import sys
+import multiprocessing as mp
 
 Ldir = exfun.intro() # this handles the argument passing
 
@@ -34,7 +45,7 @@ out_dir = (Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'cast' /
 Lfun.make_dir(out_dir, clean=True)
 
 info_fn = Ldir['LOo'] / 'obs' / Ldir['source'] / Ldir['otype'] / ('info_' + year_str + '.p')
-if info_fn.is_file():
+if info_fn.is_file() and (Ldir['batch'] == False):
     ii = 0
     info_df = pd.read_pickle(info_fn)
     N = len(info_df.index)
@@ -59,6 +70,8 @@ if info_fn.is_file():
                 else:
                     npzd = 'none'
                 ds.close()
+                # make (or check) the grid cache used by cast_worker.py
+                zrfun.get_basic_info_cached(fn)
             
             print('Get ' + out_fn.name)
             sys.stdout.flush()
@@ -92,5 +105,78 @@ if info_fn.is_file():
         else:
             pass
 
-
-
+elif info_fn.is_file() and Ldir['batch']:
+    tt0 = time()
+    info_df = pd.read_pickle(info_fn)
+    # Group the casts by history file: fn_dict[fn] is a list of (out_fn, iy, ix)
+    fn_dict = dict()
+    ii = 0
+    for cid in info_df.index:
+        lon = info_df.loc[cid,'lon']
+        lat = info_df.loc[cid,'lat']
+        dt = info_df.loc[cid,'time']
+        out_fn = out_dir / (str(int(cid)) + '.nc')
+        fn = cfun.get_his_fn_from_dt(Ldir, dt)
+        
+        if fn.is_file(): # useful for testing
+            
+            if ii == 0:
+                # check on which bio variables to get
+                ds = xr.open_dataset(fn)
+                if 'NH4' in ds.data_vars:
+                    npzd = 'new'
+                elif 'NO3' in ds.data_vars:
+                    npzd = 'old'
+                else:
+                    npzd = 'none'
+                ds.close()
+                # get the grid info, from the cache
+                G, S, T = zrfun.get_basic_info_cached(fn)
+                Lon = G['lon_rho'][0,:]
+                Lat = G['lat_rho'][:,0]
+            ii += 1
+            
+            # error checking, as in cast_worker.py
+            if (lon < Lon[0]) or (lon > Lon[-1]):
+                print('ERROR: lon out of bounds ' + out_fn.name)
+                continue
+            if (lat < Lat[0]) or (lat > Lat[-1]):
+                print('ERROR: lat out of bounds ' + out_fn.name)
+                continue
+            ix = zfun.find_nearest_ind(Lon, lon)
+            iy = zfun.find_nearest_ind(Lat, lat)
+            if G['mask_rho'][iy,ix] == 0:
+                print('ERROR: point on land mask ' + out_fn.name)
+                continue
+            if fn not in fn_dict.keys():
+                fn_dict[fn] = []
+            fn_dict[fn].append((out_fn, iy, ix))
+            if Ldir['testing'] and (ii > 4):
+                break
+                
+        else:
+            pass
+    
+    NC = sum([len(fn_dict[fn]) for fn in fn_dict.keys()])
+    print('Extracting %d casts from %d history files' % (NC, len(fn_dict)))
+    sys.stdout.flush()
+    
+    def get_one_file(fn):
+        return cfun.get_casts_one_file(fn, fn_dict[fn], npzd, S)
+    
+    if len(fn_dict) > 0:
+        if Ldir['Nproc'] > 1:
+            # the workers are forked, so they inherit fn_dict and S
+            pool = mp.get_context('fork').Pool(min(Ldir['Nproc'], len(fn_dict)))
+            name_iter = pool.imap_unordered(get_one_file, fn_dict.keys())
+        else:
+            pool = None
+            name_iter = map(get_one_file, fn_dict.keys())
+        for name_list in name_iter:
+            for name in name_list:
+                print('Got ' + name)
+            sys.stdout.flush()
+        if pool != None:
+            pool.close()
+            pool.join()
+    print('Time for batch extraction = %0.2f sec' % (time()-tt0))
@@ -1,6 +1,11 @@
+"""
+Compress a single history file, in place, using compress_fun.compress_one_file()
+with the default settings (zlib, complevel=1, lossless).
+
+python compress_a_file.py [full path to history file]
+"""
 import sys
-from time import time
-import xarray as xr
+import compress_fun as cfun
 
 arg_list = sys.argv
 if len(arg_list) != 2:
@@ -9,11 +14,9 @@ if len(arg_list) != 2:
     
 fn = arg_list[1]
 
-# compress that copy in place
-tt0 = time()
-ds = xr.load_dataset(fn)
-enc_dict = {'zlib':True, 'complevel':1}
-Enc_dict = {vn:enc_dict for vn in ds.data_vars if 'ocean_time' in ds[vn].dims}
-ds.to_netcdf(fn, encoding=Enc_dict)
-ds.close()
-print('- %0.1f sec to compress %s/%s' % (time()-tt0, fn.split('/')[-2], fn.split('/')[-1]))
+# compress that file in place
+R = cfun.compress_one_file(fn)
+if R['ok']:
+    print('- %0.1f sec to compress %s/%s' % (R['sec'], fn.split('/')[-2], fn.split('/')[-1]))
+else:
+    print('- ERROR: %s not compressed, original kept: %s' % (fn, R['msg']))
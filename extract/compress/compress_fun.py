@@ -0,0 +1,186 @@
+"""
+Module of functions for compressing ROMS history files.
+
+compress_one_file() copies a history file into a temporary file in the same folder,
+one variable at a time (and one vertical level at a time for 4-D fields), so the
+whole file is never in memory. The time-dependent variables are compressed with the
+chosen codec and level, and optionally quantized using least_significant_digit.
+The temporary file is then checked against the original, and only if it passes is
+it renamed to replace the original. Since the rename is atomic, a crash at any point
+leaves either the original file or the fully checked compressed file.
+"""
+
+import os
+from pathlib import Path
+from time import time
+import numpy as np
+import netCDF4 as nc
+
+# classes of variables, used to set quantization for a group of variables at once
+class_dict = {
+    'tracer': ['salt', 'temp'],
+    'bio': ['NO3', 'NH4', 'phytoplankton', 'chlorophyll', 'zooplankton',
+        'SdetritusN', 'LdetritusN', 'SdetritusC', 'LdetritusC', 'detritus', 'Ldetritus',
+        'oxygen', 'alkalinity', 'TIC', 'rho'],
+    'velocity': ['u', 'v', 'w', 'ubar', 'vbar', 'omega'],
+    'mixing': ['AKs', 'AKv', 'AKt'],
+    'surface': ['zeta', 'Pair', 'Uwind', 'Vwind', 'shflux', 'ssflux', 'latent', 'sensible',
+        'lwrad', 'swrad', 'sustr', 'svstr', 'bustr', 'bvstr'],
+    }
+
+def get_lsd_dict(lsd_str):
+    """
+    Make the dict {variable name: least_significant_digit} from a string like
+    'bio:3,mixing:2,zeta:4', where each item is a variable class from class_dict,
+    or a single variable name. An empty string means no quantization.
+    """
+    lsd_dict = dict()
+    if (lsd_str == None) or (len(lsd_str) == 0):
+        return lsd_dict
+    for item in lsd_str.split(','):
+        name, lsd = item.split(':')
+        if name in class_dict.keys():
+            for vn in class_dict[name]:
+                lsd_dict[vn] = int(lsd)
+        else:
+            lsd_dict[name] = int(lsd)
+    return lsd_dict
+
+def get_slices(vv):
+    # Indices to copy a variable in pieces: one (time, level) slab at a time
+    # for 4-D fields, and all at once for everything else.
+    if len(vv.shape) == 4:
+        return [(it, iz) for it in range(vv.shape[0]) for iz in range(vv.shape[1])]
+    else:
+        return [Ellipsis]
+
+def compress_one_file(fn, codec='zlib', complevel=1, lsd_dict=dict(), verify=True):
+    """
+    Compress history file fn, replacing it only after the result is checked.
+
+    Returns a dict of results: 'ok' (True if fn was replaced), 'msg',
+    'in_MB', 'out_MB', 'sec', 'MB_per_sec', and 'ratio'.
+    """
+    tt0 = time()
+    fn = Path(fn)
+    temp_fn = fn.parent / (fn.name + '.compress_temp')
+    temp_fn.unlink(missing_ok=True)
+    R = {'ok':False, 'msg':'', 'in_MB':os.path.getsize(fn)/1e6, 'out_MB':np.nan,
+        'sec':np.nan, 'MB_per_sec':np.nan, 'ratio':np.nan}
+    try:
+        ds = nc.Dataset(fn)
+        out_ds = nc.Dataset(temp_fn, 'w', format='NETCDF4')
+        out_ds.setncatts({k:ds.getncattr(k) for k in ds.ncattrs()})
+        for dim in ds.dimensions.values():
+            out_ds.createDimension(dim.name, None if dim.isunlimited() else len(dim))
+        for vn in ds.variables:
+            vv = ds[vn]
+            attrs = {k:vv.getncattr(k) for k in vv.ncattrs() if k != '_FillValue'}
+            if '_FillValue' in vv.ncattrs():
+                fill_value = vv.getncattr('_FillValue')
+            else:
+                fill_value = None
+            if 'ocean_time' in vv.dimensions and len(vv.dimensions) > 1:
+                # compress time-dependent fields
+                lsd = lsd_dict.get(vn, None)
+                if vv.dtype.kind != 'f':
+                    lsd = None
+                ww = out_ds.createVariable(vn, vv.dtype, vv.dimensions, compression=codec,
+                    complevel=complevel, shuffle=True, fill_value=fill_value,
+                    least_significant_digit=lsd)
+            else:
+                lsd = None
+                ww = out_ds.createVariable(vn, vv.dtype, vv.dimensions, fill_value=fill_value)
+            ww.setncatts(attrs)
+            if lsd == None:
+                # copy the raw values, so the result is exactly the same
+                vv.set_auto_maskandscale(False)
+                ww.set_auto_maskandscale(False)
+            for sl in get_slices(vv):
+                ww[sl] = vv[sl]
+        out_ds.close()
+        ds.close()
+        if verify:
+            R['msg'] = check_file(fn, temp_fn, lsd_dict)
+        if len(R['msg']) == 0:
+            R['out_MB'] = os.path.getsize(temp_fn)/1e6
+            # the atomic rename
+            os.replace(temp_fn, fn)
+            R['ok'] = True
+    except Exception as e:
+        R['msg'] = str(e)
+    temp_fn.unlink(missing_ok=True)
+    R['sec'] = time() - tt0
+    R['MB_per_sec'] = R['in_MB'] / R['sec']
+    R['ratio'] = R['in_MB'] / R['out_MB']
+    return R
+
+def same_attrs(a, b, skip=[]):
+    """
+    True if the netCDF4 Datasets or Variables a and b have the same attribute
+    names and values, ignoring any names in skip.
+    """
+    a_list = [k for k in a.ncattrs() if k not in skip]
+    b_list = [k for k in b.ncattrs() if k not in skip]
+    if set(a_list) != set(b_list):
+        return False
+    for k in a_list:
+        av = a.getncattr(k)
+        bv = b.getncattr(k)
+        if isinstance(av, str) or isinstance(bv, str):
+            if av != bv:
+                return False
+        else:
+            av = np.asarray(av)
+            bv = np.asarray(bv)
+            if (av.dtype != bv.dtype) or not np.array_equal(av, bv, equal_nan=(av.dtype.kind == 'f')):
+                return False
+    return True
+
+def check_file(fn, temp_fn, lsd_dict):
+    """
+    Check that the compressed file temp_fn has the same contents as the original fn.
+    Values must be identical except for quantized variables, which must be within
+    10**(-least_significant_digit). Returns an empty string if all is well, and
+    otherwise a description of the first problem found.
+    """
+    ds = nc.Dataset(fn)
+    out_ds = nc.Dataset(temp_fn)
+    msg = ''
+    if set(ds.variables) != set(out_ds.variables):
+        msg = 'variable lists differ'
+    elif not same_attrs(ds, out_ds):
+        msg = 'global attributes differ'
+    else:
+        for vn in ds.variables:
+            vv = ds[vn]
+            ww = out_ds[vn]
+            if (vv.dimensions != ww.dimensions) or (vv.shape != ww.shape) or (vv.dtype != ww.dtype):
+                msg = vn + ': dimensions, shape or type differ'
+                break
+            if not same_attrs(vv, ww, skip=['least_significant_digit']):
+                # quantization adds least_significant_digit, everything else must match
+                msg = vn + ': attributes differ'
+                break
+            lsd = ww.least_significant_digit if hasattr(ww, 'least_significant_digit') else None
+            if lsd == None:
+                vv.set_auto_maskandscale(False)
+                ww.set_auto_maskandscale(False)
+            for sl in get_slices(vv):
+                a = vv[sl]
+                b = ww[sl]
+                if lsd == None:
+                    ok = np.array_equal(a, b, equal_nan=(a.dtype.kind == 'f'))
+                else:
+                    # masked points must match, and the rest be within the tolerance
+                    am = np.ma.getmaskarray(a)
+                    ok = np.array_equal(am, np.ma.getmaskarray(b))
+                    ok = ok and (np.abs(np.ma.getdata(a)[~am] - np.ma.getdata(b)[~am]) <= 10.0**(-lsd)).all()
+                if not ok:
+                    msg = vn + ': values differ'
+                    break
+            if len(msg) > 0:
+                break
+    ds.close()
+    out_ds.close()
+    return msg
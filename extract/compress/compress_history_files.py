@@ -9,6 +9,17 @@ Test on mac:
 run compress_history_files -gtx cas6_v3_lo8b -ro 2 -0 2019.07.04 -1 2019.07.04
 python compress_history_files.py -gtx cas6_v3_lo8b -ro 2 -0 2019.07.04 -1 2019.07.04
 
+2026.10.18 Recoded to do the compression in-process (using compress_fun.py) with a
+multiprocessing Pool of Nproc workers. Each file is streamed one variable at a time
+into a temporary file, which is checked against the original before it is renamed to
+replace it, so a crash can no longer destroy a history file. You can choose the codec
+(-codec: zlib, zstd, bzip2, szip, blosc_lz4, etc.) and level (-level), and optionally
+quantize classes of variables using least_significant_digit, e.g. -lsd bio:3,mixing:2
+(see compress_fun.class_dict, the default is lossless). It reports the time, MB/s,
+and compression ratio for each file, and the totals at the end.
+
+python compress_history_files.py -gtx cas6_v3_lo8b -ro 2 -0 2019.07.04 -1 2019.07.04 -codec zstd -level 4
+
 Performance: took 3 minutes to compress 1 day of cas6 on my laptop.  This is 18 hours per year,
 however that was with Nproc = 4.  With Nproc = 10 on perigee it took 8 hours for a year of
 history files with no NPZD.  Using Nproc = 100 did not speed things up, but it did make
@@ -20,13 +31,11 @@ perigee a bit sluggish on the command line.  Overall I think 5 sec per file migh
 import sys
 import argparse
 from lo_tools import Lfun
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
 from time import time
 import numpy as np
-import xarray as xr
-from time import time
 from datetime import datetime, timedelta
+import multiprocessing as mp
+import compress_fun as cfun
 
 print(' compress history files '.center(60,'='))
 
@@ -38,8 +47,13 @@ parser.add_argument('-ro', '--roms_out_num', type=int) # 2 = Ldir['roms_out2'],
 # select time period and frequency
 parser.add_argument('-0', '--ds0', type=str) # e.g. 2019.07.04
 parser.add_argument('-1', '--ds1', type=str) # e.g. 2019.07.06
-# Optional: set max number of subprocesses to run at any time
+# Optional: set number of worker processes
 parser.add_argument('-Nproc', type=int, default=10)
+# Optional: compression codec and level
+parser.add_argument('-codec', type=str, default='zlib')
+parser.add_argument('-level', type=int, default=1)
+# Optional: quantization, e.g. bio:3,mixing:2 (variable classes or names : least_significant_digit)
+parser.add_argument('-lsd', type=str, default='')
 # Optional: for testing
 parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
 # get the args and put into Ldir
@@ -67,26 +81,41 @@ fn_list = []
 for this_ds in ds_list:
     fn_list = fn_list + Lfun.get_fn_list('allhours', Ldir, this_ds, this_ds)
 
+lsd_dict = cfun.get_lsd_dict(Ldir['lsd'])
+
+def compress_one_file(fn):
+    return fn, cfun.compress_one_file(fn, codec=Ldir['codec'], complevel=Ldir['level'],
+        lsd_dict=lsd_dict)
+
 # do the compression
 N = len(fn_list)
-proc_list = []
 tt0 = time()
-for ii in range(N):
-    fn = fn_list[ii]
-    cmd_list = ['python', 'compress_a_file.py', str(fn)]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-    # complete Nproc jobs before filling proc_list again
-    if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
-        for proc in proc_list:
-            # make sure everyone is finished before continuing
-            stdout, stderr = proc.communicate()
-            if len(stdout) > 0:
-                print(stdout.decode().replace('\n',''))
-            if len(stderr) > 0:
-                print(stderr.decode())
-            sys.stdout.flush()
-        proc_list = []
-    ii += 1
-print('Total time to compress %d files = %0.1f sec' % (N, time()-tt0))
-    
+if Ldir['Nproc'] > 1:
+    pool = mp.get_context('fork').Pool(min(Ldir['Nproc'], N))
+    R_iter = pool.imap_unordered(compress_one_file, fn_list)
+else:
+    pool = None
+    R_iter = map(compress_one_file, fn_list)
+in_MB = 0
+out_MB = 0
+nbad = 0
+for fn, R in R_iter:
+    fstr = fn.parent.name + '/' + fn.name
+    if R['ok']:
+        in_MB += R['in_MB']
+        out_MB += R['out_MB']
+        print('- %0.1f sec to compress %s: %0.1f MB => %0.1f MB (ratio %0.2f) %0.1f MB/s' %
+            (R['sec'], fstr, R['in_MB'], R['out_MB'], R['ratio'], R['MB_per_sec']))
+    else:
+        nbad += 1
+        print('- ERROR: %s not compressed, original kept: %s' % (fstr, R['msg']))
+    sys.stdout.flush()
+if pool != None:
+    pool.close()
+    pool.join()
+sec = time()-tt0
+print('Total time to compress %d files = %0.1f sec' % (N, sec))
+if out_MB > 0:
+    print('Total: %0.1f MB => %0.1f MB (ratio %0.2f) %0.1f MB/s' % (in_MB, out_MB, in_MB/out_MB, in_MB/sec))
+if nbad > 0:
+    print('ERROR: %d files were not compressed' % (nbad))
@@ -15,6 +15,16 @@ perigee
 -Nproc 20 = 2.5 min per day
 -Nproc 10 = 2.0 min per day: BEST CHOICE
 
+2026.10.18 Added a streaming mode, used with -stream True, for multi-day backfills.
+The default mode reads the 71 hourly files that go into each day's tidal average,
+so over many days each history file is read three times. The streaming mode reads
+each hourly file only once (with the next one read in a background thread), and
+adds its contribution, weighted by zfun.godin_shape(), to each of the up to three
+output days that it falls in. Each lowpassed.nc is written as soon as its 71-hour
+window is complete. It runs in this process, so -Nproc is not used.
+
+run extract_lowpass -gtx cas6_v0_live -ro 0 -0 2019.07.04 -1 2019.07.10 -stream True
+
 """
 
 import sys
@@ -25,6 +35,7 @@ from datetime import datetime, timedelta
 from subprocess import Popen as Po
 from subprocess import PIPE as Pi
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 
 from lo_tools import Lfun, zfun, zrfun
 from lo_tools import extract_argfun as exfun
@@ -46,6 +57,88 @@ lon_psi = S_ds.lon_psi
 lat_psi = S_ds.lat_psi
 S_ds.close()
 
+def finish_day(lp_full, dt_out):
+    """
+    Add a time dimension, h, and z fields to the tidal average lp_full,
+    and save it as lowpassed.nc in the folder for day dt_out.
+    """
+    out_dir = Ldir['roms_out'] / Ldir['gtagex'] / ('f' + dt_out.strftime(Lfun.ds_fmt))
+    # add a time dimension
+    lp_full = lp_full.expand_dims('ocean_time')
+    lp_full['ocean_time'] = (('ocean_time'), pd.DatetimeIndex([dt_out + timedelta(days=0.5)]))
+    # add z fields
+    # NOTE: this only works if you have h, zeta, and salt as saved fields
+    lp_full['h'] = h
+    NT, N, NR, NC = lp_full.salt.shape
+    lp_full.update({'z_rho':(('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), np.nan*np.ones((NT, N, NR, NC)))})
+    lp_full.update({'z_w':(('ocean_time', 's_w', 'eta_rho', 'xi_rho'), np.nan*np.ones((NT, N+1, NR, NC)))})
+    lp_full.z_rho.attrs = {'units':'m', 'long_name': 'vertical position on s_rho grid, positive up'}
+    lp_full.z_w.attrs = {'units':'m', 'long_name': 'vertical position on s_w grid, positive up'}
+    hh = h.values
+    zeta = lp_full.zeta[0,:,:].values
+    z_rho, z_w = zrfun.get_z(hh, zeta, S)
+    lp_full['z_rho'][0,:,:,:] = z_rho
+    lp_full['z_w'][0,:,:,:] = z_w
+    lp_full.coords['lon_psi'] = (('eta_psi','xi_psi'), lon_psi.values)
+    lp_full.coords['lat_psi'] = (('eta_psi','xi_psi'), lat_psi.values)
+    out_fn = out_dir / 'lowpassed.nc'
+    out_fn.unlink(missing_ok=True)
+    lp_full.to_netcdf(out_fn)
+    lp_full.close()
+
+if Ldir['stream']:
+    # Streaming mode: read each hourly file once.
+    if Ldir['testing']:
+        vn_list = ['h','zeta','salt']
+    else:
+        # same as in lp_worker.py
+        vn_list = ['h','zeta','salt','temp','u','v','w',
+        'NO3','phytoplankton','zooplankton',
+        'detritus','Ldetritus','oxygen',
+        'TIC','alkalinity',
+        'Pair','Uwind','Vwind','shflux','ssflux','latent','sensible','lwrad','swrad',
+        'sustr','svstr','bustr','bvstr']
+    # filter shape
+    gs = zfun.godin_shape() # length 71, sum = 1
+    ndays = (dt1 - dt0).days + 1
+    # Item n of fn_list is the history file n hours after 00:00 on ds0.
+    # Output day k (the tidal average centered on noon of the day after
+    # dt0 + k days) uses items 24*k + 1 to 24*k + 71.
+    ds_last = (dt1 + timedelta(days=2)).strftime(Lfun.ds_fmt)
+    fn_list = Lfun.get_fn_list('hourly', Ldir, ds0, ds_last)
+    nmax = 24*(ndays-1) + 71
+    def get_ds(n):
+        ds = xr.open_dataset(fn_list[n])
+        this_vn_list = [vn for vn in vn_list if vn in ds.data_vars]
+        this_ds = ds[this_vn_list].squeeze(dim='ocean_time', drop=True).load()
+        ds.close()
+        return this_ds
+    lp_dict = dict() # partial sums for the output days that are pending
+    tt0 = time()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(get_ds, 1)
+        for n in range(1, nmax+1):
+            ds = future.result()
+            if n < nmax:
+                # start reading the next file while we work on this one
+                future = executor.submit(get_ds, n+1)
+            # output days that use this hour: 24*k + 1 <= n <= 24*k + 71
+            for k in range(max(0, -((71-n)//24)), min(ndays, (n-1)//24 + 1)):
+                ii = n - 24*k - 1 # index into the filter
+                if ii == 0:
+                    lp_dict[k] = (ds * gs[ii]).compute()
+                else:
+                    lp_dict[k] = (lp_dict[k] + ds * gs[ii]).compute()
+                if ii == 70:
+                    # the window for this day is complete
+                    dt_out = dt0 + timedelta(days=k+1)
+                    print('\n' + (dt_out - timedelta(days=1)).strftime(Lfun.ds_fmt))
+                    finish_day(lp_dict.pop(k), dt_out)
+                    print(' - Time to make tidal average = %0.1f minutes' % ((time()-tt0)/60))
+                    sys.stdout.flush()
+                    tt0 = time()
+    sys.exit()
+
 # loop over all days
 dt00 = dt0
 while dt00 <= dt1:
@@ -57,7 +150,6 @@ while dt00 <= dt1:
     # final file output location
     dt_out = dt00 + timedelta(days=1)
     ds_out = dt_out.strftime(Lfun.ds_fmt)
-    out_dir = Ldir['roms_out'] / Ldir['gtagex'] / ('f' + ds_out)
 
     # Start of chunks loop for this day.
     tt0 = time()
@@ -101,28 +193,7 @@ while dt00 <= dt1:
             lp_full = ds.copy()
         else:
             lp_full = (lp_full + ds).compute()
-    # add a time dimension
-    lp_full = lp_full.expand_dims('ocean_time')
-    lp_full['ocean_time'] = (('ocean_time'), pd.DatetimeIndex([dt_out + timedelta(days=0.5)]))
-    # add z fields
-    # NOTE: this only works if you have h, zeta, and salt as saved fields
-    lp_full['h'] = h
-    NT, N, NR, NC = lp_full.salt.shape
-    lp_full.update({'z_rho':(('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), np.nan*np.ones((NT, N, NR, NC)))})
-    lp_full.update({'z_w':(('ocean_time', 's_w', 'eta_rho', 'xi_rho'), np.nan*np.ones((NT, N+1, NR, NC)))})
-    lp_full.z_rho.attrs = {'units':'m', 'long_name': 'vertical position on s_rho grid, positive up'}
-    lp_full.z_w.attrs = {'units':'m', 'long_name': 'vertical position on s_w grid, positive up'}
-    hh = h.values
-    zeta = lp_full.zeta[0,:,:].values
-    z_rho, z_w = zrfun.get_z(hh, zeta, S)
-    lp_full['z_rho'][0,:,:,:] = z_rho
-    lp_full['z_w'][0,:,:,:] = z_w
-    lp_full.coords['lon_psi'] = (('eta_psi','xi_psi'), lon_psi.values)
-    lp_full.coords['lat_psi'] = (('eta_psi','xi_psi'), lat_psi.values)
-    out_fn = out_dir / 'lowpassed.nc'
-    out_fn.unlink(missing_ok=True)
-    lp_full.to_netcdf(out_fn)
-    lp_full.close()
+    finish_day(lp_full, dt_out)
     
     # tidying up
     Lfun.make_dir(temp_out_dir, clean=True)
@@ -27,6 +27,7 @@ from subprocess import Popen as Po
 from subprocess import PIPE as Pi
 import numpy as np
 import xarray as xr
+import moor_fun
 
 # command line arugments
 parser = argparse.ArgumentParser()
@@ -123,31 +124,10 @@ ilat = zfun.find_nearest_ind(Lat, lat)
 # more error checking
 
 def find_good(ilat, ilon, mask):
-    if mask == 'rho':
-        # look on all four sides
-        jig_list = [[0,0],[1,0],[-1,0],[0,1],[0,-1]]
-    elif mask == 'u':
-        # just look to west
-        jig_list = [[0,0],[0,-1]]
-    elif mask == 'v':
-        # just look to south
-        jig_list = [[0,0],[-1,0]]
-    count = 0
-    found_good = False
-    while count < len(jig_list):
-        jig = jig_list[count]
-        Ilat = ilat + jig[0]
-        Ilon = ilon + jig[1]
-        if G['mask_'+mask][Ilat,Ilon] == 1:
-            print('   - %s: (%d, %d) => (%d, %d), jig = [%d, %d]' %
-                (mask, ilat, ilon, Ilat, Ilon, jig[0], jig[1]))
-            return Ilat, Ilon
-            found_good = True
-            break
-        count += 1
-    if found_good == False:
-        print('ERROR: no good nearby point found on mask for ' + mask)
+    Ilat, Ilon = moor_fun.find_good(G, ilat, ilon, mask)
+    if Ilat == None:
         sys.exit()
+    return Ilat, Ilon
 
 ilat_rho, ilon_rho = find_good(ilat, ilon, 'rho')
 if Ldir['get_vel'] or Ldir['get_surfbot']:
@@ -156,31 +136,9 @@ if Ldir['get_vel'] or Ldir['get_surfbot']:
     
 fn_list = Lfun.get_fn_list(Ldir['list_type'], Ldir, Ldir['ds0'], Ldir['ds1'])
 
-# check to see if we are working with the old or new NPZDOC variables
+# get the list of variables to extract
 ds = xr.open_dataset(fn_list[0])
-if 'NH4' in ds.data_vars:
-    # updated ROMS
-    bio_list = ',NO3,NH4,phytoplankton,zooplankton,SdetritusN,LdetritusN,SdetritusC,LdetritusC,oxygen,alkalinity,TIC,rho'
-else:
-    # original version
-    bio_list = ',NO3,phytoplankton,zooplankton,detritus,Ldetritus,oxygen,alkalinity,TIC,rho'
-
-vn_list = 'h,zeta'
-if Ldir['get_tsa']:
-    vn_list += ',salt,temp,AKs,AKv'
-if Ldir['get_vel']:
-    vn_list += ',u,v,w,ubar,vbar'
-if Ldir['get_bio']:
-    vn_list += bio_list
-if Ldir['get_surfbot']:
-    vn_list += ',Pair,Uwind,Vwind,shflux,ssflux,latent,sensible,lwrad,swrad,sustr,svstr,bustr,bvstr'
-# The choice below is a custom job that is not part of get_all.  It is problematic to add such jobs becasue
-# you also have to add them to the args at the top of this code and the multi_mooring_driver.
-if Ldir['get_pressure']: # fields used for 1-D pressure analysis
-    vn_list += ',salt,temp,u,v,Pair,Uwind,Vwind'
-
-# do a final check to drop missing variables from the list
-vn_list = (',').join([item for item in vn_list.split(',') if item in ds.data_vars])
+vn_list = moor_fun.get_vn_list(Ldir, ds.data_vars)
 ds.close()
 
 tt_ncks = time()
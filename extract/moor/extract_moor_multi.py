@@ -0,0 +1,350 @@
+"""
+This is code for doing multiple mooring extractions in a single pass through
+the history files. It takes the same arguments as multi_mooring_driver.py,
+and gets the stations from the same job_lists.py.
+
+Instead of running extract_moor.py once for each station (which opens every
+history file once per station with ncks) this:
+- finds the (ilat, ilon) indices of all the stations, using the same
+find_good() logic as extract_moor.py,
+- reads each history file only once, getting the j/i hyperslab that covers
+all the stations for each variable, and picks out all stations with fancy indexing,
+- calculates z_rho and z_w in the same pass,
+- writes one NetCDF file per station, with the same name and contents as those
+made by multi_mooring_driver.py, directly to the folder named for the job.
+
+The history files are handled by a multiprocessing Pool with Nproc workers.
+Results come back in time order and are written to the station files in blocks
+of NB times, so memory use does not grow with the length of the extraction.
+
+Stations that are out of bounds or have no good nearby point on the mask are
+skipped with an error message, instead of stopping the job.
+
+2026.10.18 The output is written using lo_tools/store_functions.py, chunked in
+blocks of NB times. Use -store zarr to make zarr stores instead of NetCDF. Use
+-append True to add the times to a store for each station named [sn].nc (or .zarr),
+so you can build up a long record one day at a time.
+
+Run from the command line like:
+python extract_moor_multi.py -gtx cas6_v3_lo8b -ro 2 -0 2019.07.04 -1 2019.07.06 -lt hourly -job mickett_2 -get_all True > emm.log &
+
+Test on mac in ipython:
+run extract_moor_multi -gtx cas6_v0_live -test True
+
+"""
+
+# imports
+from lo_tools import Lfun, zrfun, zfun
+from lo_tools import store_functions
+
+import sys
+import argparse
+import os
+from time import time
+import numpy as np
+import netCDF4 as nc
+import multiprocessing as mp
+import moor_fun
+
+pid = os.getpid()
+print(' extract_moor_multi '.center(60,'='))
+print('PID for this job = ' + str(pid))
+
+# command line arugments
+parser = argparse.ArgumentParser()
+# which run to use
+parser.add_argument('-gtx', '--gtagex', type=str)   # e.g. cas6_v3_l08b
+parser.add_argument('-ro', '--roms_out_num', type=int) # 2 = Ldir['roms_out2'], etc.
+# select time period and frequency
+parser.add_argument('-0', '--ds0', type=str) # e.g. 2019.07.04
+parser.add_argument('-1', '--ds1', type=str) # e.g. 2019.07.06
+parser.add_argument('-lt', '--list_type', type=str) # list type: hourly or daily
+# select job name
+parser.add_argument('-job', type=str) # job name
+# select categories of variables to extract (defined in moor_fun.get_vn_list())
+parser.add_argument('-get_tsa', type=Lfun.boolean_string, default=False)
+parser.add_argument('-get_vel', type=Lfun.boolean_string, default=False)
+parser.add_argument('-get_bio', type=Lfun.boolean_string, default=False)
+parser.add_argument('-get_surfbot', type=Lfun.boolean_string, default=False)
+parser.add_argument('-get_pressure', type=Lfun.boolean_string, default=False)
+# OR select all of them
+parser.add_argument('-get_all', type=Lfun.boolean_string, default=False)
+# Optional: output type, nc (NetCDF) or zarr, see lo_tools/store_functions.py
+parser.add_argument('-store', type=str, default='nc')
+# Optional: set this to True to add the times to an existing store (station name only, no dates)
+parser.add_argument('-append', type=Lfun.boolean_string, default=False)
+# Optional: set number of worker processes reading history files
+parser.add_argument('-Nproc', type=int, default=10)
+# Optional: for testing
+parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
+# get the args and put into Ldir
+args = parser.parse_args()
+# test that main required arguments were provided
+argsd = args.__dict__
+for a in ['gtagex']:
+    if argsd[a] == None:
+        print('*** Missing required argument: ' + a)
+        sys.exit()
+gridname, tag, ex_name = args.gtagex.split('_')
+# get the dict Ldir
+Ldir = Lfun.Lstart(gridname=gridname, tag=tag, ex_name=ex_name)
+# add more entries to Ldir
+for a in argsd.keys():
+    if a not in Ldir.keys():
+        Ldir[a] = argsd[a]
+# testing
+if Ldir['testing']:
+    Ldir['roms_out_num'] = 0
+    Ldir['ds0'] = '2019.07.04'
+    Ldir['ds1'] = '2019.07.06'
+    Ldir['list_type'] = 'daily'
+    Ldir['job'] = 'scoot'
+    Ldir['get_all'] = True
+# set where to look for model output
+if Ldir['roms_out_num'] == 0:
+    pass
+elif Ldir['roms_out_num'] > 0:
+    Ldir['roms_out'] = Ldir['roms_out' + str(Ldir['roms_out_num'])]
+# set variable list flags
+if Ldir['get_all']:
+    Ldir['get_tsa'] = True
+    Ldir['get_vel'] = True
+    Ldir['get_bio'] = True
+    Ldir['get_surfbot'] = True
+
+# get the job_lists module, looking first in LO_user
+pth = Ldir['LO'] / 'extract' / 'moor'
+upth = Ldir['LOu'] / 'extract' / 'moor'
+if (upth / 'job_lists.py').is_file():
+    print('Importing job_lists from LO_user')
+    job_lists = Lfun.module_from_file('job_lists', upth / 'job_lists.py')
+else:
+    print('Importing job_lists from LO')
+    job_lists = Lfun.module_from_file('job_lists', pth / 'job_lists.py')
+
+# Get job dict:
+sta_dict = job_lists.get_sta_dict(Ldir['job'])
+
+# make place for the results of this job
+out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'moor'
+jout_dir = out_dir / Ldir['job']
+Lfun.make_dir(jout_dir)
+print('Results will go to %s' % (str(jout_dir)))
+
+tt00 = time()
+
+fn_list = Lfun.get_fn_list(Ldir['list_type'], Ldir, Ldir['ds0'], Ldir['ds1'])
+NT = len(fn_list)
+
+# number of times to hold in memory before writing to the output files
+NB = 24
+
+# get the list of variables to extract, and where they live on the grid
+ds = nc.Dataset(fn_list[0])
+vn_list = moor_fun.get_vn_list(Ldir, ds.variables).split(',')
+grid_dict = dict() # 'rho', 'u', or 'v'
+vdim_dict = dict() # 's_rho', 's_w', or None
+for vn in vn_list:
+    dims = ds[vn].dimensions
+    if 'xi_u' in dims:
+        grid_dict[vn] = 'u'
+    elif 'xi_v' in dims:
+        grid_dict[vn] = 'v'
+    else:
+        grid_dict[vn] = 'rho'
+    if 's_rho' in dims:
+        vdim_dict[vn] = 's_rho'
+    elif 's_w' in dims:
+        vdim_dict[vn] = 's_w'
+    else:
+        vdim_dict[vn] = None
+ds.close()
+# fields that do not change with time
+static_list = ['h']
+time_list = [vn for vn in vn_list if vn not in static_list]
+grid_list = list(set(grid_dict.values()))
+
+# get indices for extraction
+G, S, T = zrfun.get_basic_info(fn_list[0])
+Lon = G['lon_rho'][0,:]
+Lat = G['lat_rho'][:,0]
+sn_list = []
+ji_dict = dict() # lists of indices on each grid
+for gr in grid_list:
+    ji_dict[gr] = ([],[])
+for sn in sta_dict.keys():
+    print('Finding indices for ' + sn)
+    lon, lat = sta_dict[sn]
+    # error checking
+    if (lon < Lon[0]) or (lon > Lon[-1]) or (lat < Lat[0]) or (lat > Lat[-1]):
+        print('ERROR: lon or lat out of bounds for ' + sn)
+        continue
+    ilon = zfun.find_nearest_ind(Lon, lon)
+    ilat = zfun.find_nearest_ind(Lat, lat)
+    # more error checking
+    this_ji = dict()
+    this_ji['rho'] = moor_fun.find_good(G, ilat, ilon, 'rho')
+    if this_ji['rho'][0] == None:
+        continue
+    for gr in ['u', 'v']:
+        if gr in grid_list:
+            this_ji[gr] = moor_fun.find_good(G, this_ji['rho'][0], this_ji['rho'][1], gr)
+            if this_ji[gr][0] == None:
+                break
+    if None in [this_ji[gr][0] for gr in this_ji.keys()]:
+        continue
+    sn_list.append(sn)
+    for gr in grid_list:
+        ji_dict[gr][0].append(this_ji[gr][0])
+        ji_dict[gr][1].append(this_ji[gr][1])
+NS = len(sn_list)
+if NS == 0:
+    print('ERROR: no good stations')
+    sys.exit()
+
+def get_box(jj, ii):
+    # Returns the slices that cover all the points (jj, ii), and the point
+    # indices relative to the start of those slices.
+    jj = np.array(jj, dtype=int); ii = np.array(ii, dtype=int)
+    j0 = jj.min(); i0 = ii.min()
+    return (slice(j0, jj.max()+1), slice(i0, ii.max()+1)), jj-j0, ii-i0
+
+box_dict = dict()
+for gr in grid_list:
+    box_dict[gr] = get_box(ji_dict[gr][0], ji_dict[gr][1])
+
+def get_points(ds, vn):
+    # Get the values of variable vn at all stations, packed (station, z)
+    # or (station). Masked values are returned as nan, as xarray would do.
+    (js, is_), jj, ii = box_dict[grid_dict[vn]]
+    if vn in static_list:
+        aa = ds[vn][js, is_]
+    else:
+        aa = ds[vn][0, ..., js, is_]
+    aa = aa[..., jj, ii]
+    if np.ma.isMaskedArray(aa):
+        if aa.dtype.kind == 'f':
+            aa = aa.filled(np.nan)
+        else:
+            aa = aa.data
+    return aa.T
+
+# things that do not change with time
+ds = nc.Dataset(fn_list[0])
+h = get_points(ds, 'h')
+attrs_dict = dict()
+for vn in vn_list + ['ocean_time', 's_rho', 's_w']:
+    attrs_dict[vn] = {k:ds[vn].getncattr(k) for k in ds[vn].ncattrs() if k != '_FillValue'}
+s_rho = ds['s_rho'][:]
+s_w = ds['s_w'][:]
+ds.close()
+
+def get_one_time(fn):
+    """
+    Does the extraction of all stations for a single history file.
+    Returns a dict of arrays packed (station, z) or (station).
+    """
+    ds = nc.Dataset(fn)
+    CC = dict()
+    CC['ocean_time'] = float(ds['ocean_time'][0])
+    for vn in time_list:
+        CC[vn] = get_points(ds, vn)
+    ds.close()
+    # add z coordinates
+    z_rho, z_w = zrfun.get_z(h, CC['zeta'], S)
+    CC['z_rho'] = z_rho.reshape(S['N'], NS).T
+    CC['z_w'] = z_w.reshape(S['N']+1, NS).T
+    return CC
+
+def start_files(CC):
+    # Create the output stores, using the first result to get the data types.
+    St_dict = dict()
+    for ss in range(NS):
+        sn = sn_list[ss]
+        if Ldir['append']:
+            # the store keeps growing, so its name has no dates
+            moor_fn = store_functions.get_store_fn(jout_dir / sn, Ldir['store'])
+        else:
+            moor_fn = store_functions.get_store_fn(jout_dir / (sn + '_' + Ldir['ds0'] + '_' + Ldir['ds1']), Ldir['store'])
+        dim_dict = {'s_rho':S['N'], 's_w':S['N']+1}
+        var_dict = dict()
+        attrs = attrs_dict['ocean_time'].copy()
+        # update the time long name
+        attrs['long_name'] = 'Time [UTC]'
+        var_dict['ocean_time'] = {'dims':('ocean_time',), 'dtype':float, 'attrs':attrs}
+        var_dict['s_rho'] = {'dims':('s_rho',), 'dtype':float, 'attrs':attrs_dict['s_rho'], 'data':s_rho}
+        var_dict['s_w'] = {'dims':('s_w',), 'dtype':float, 'attrs':attrs_dict['s_w'], 'data':s_w}
+        # position of the station on each grid
+        for gr in grid_list:
+            jj, ii = ji_dict[gr][0][ss], ji_dict[gr][1][ss]
+            for ll in ['lon', 'lat']:
+                var_dict[ll + '_' + gr] = {'dims':(), 'dtype':float, 'attrs':dict(),
+                    'data':G[ll + '_' + gr][jj, ii]}
+        var_dict['h'] = {'dims':(), 'dtype':h.dtype, 'attrs':attrs_dict['h'], 'data':h[ss]}
+        for vn in time_list:
+            if vdim_dict[vn] == None:
+                dims = ('ocean_time',)
+            else:
+                dims = ('ocean_time', vdim_dict[vn])
+            var_dict[vn] = {'dims':dims, 'dtype':CC[vn].dtype, 'attrs':attrs_dict[vn].copy()}
+        # add units to salt
+        if 'salt' in time_list:
+            var_dict['salt']['attrs']['units'] = 'g kg-1'
+        for vn in ['z_rho', 'z_w']:
+            var_dict[vn] = {'dims':('ocean_time', vn.replace('z_','s_')), 'dtype':CC[vn].dtype,
+                'attrs':{'units':'m'}}
+        var_dict['z_rho']['attrs']['long name'] = 'vertical position on s_rho grid, positive up'
+        var_dict['z_w']['attrs']['long name'] = 'vertical position on s_w grid, positive up'
+        St_dict[sn] = store_functions.start_store(moor_fn, dim_dict, var_dict,
+            global_attrs={'format':'netCDF-4'}, nt_chunk=NB, append=Ldir['append'])
+    return St_dict
+
+def write_block(St_dict, CC_list):
+    # Add a list of results to all the output stores.
+    ot = np.array([CC['ocean_time'] for CC in CC_list])
+    aa_dict = dict()
+    for vn in time_list + ['z_rho', 'z_w']:
+        aa_dict[vn] = np.stack([CC[vn] for CC in CC_list]) # packed (t, station, ...)
+    for ss in range(NS):
+        CC_dict = {vn:aa_dict[vn][:, ss, ...] for vn in aa_dict.keys()}
+        CC_dict['ocean_time'] = ot
+        store_functions.write_block(St_dict[sn_list[ss]], CC_dict)
+
+# loop over all history files
+tt0 = time()
+print('Times to extract =  %d' % (NT))
+print('Stations to extract = %d' % (NS))
+sys.stdout.flush()
+if Ldir['Nproc'] > 1:
+    # the workers are forked, so they inherit all the index info above
+    pool = mp.get_context('fork').Pool(min(Ldir['Nproc'], NT))
+    CC_iter = pool.imap(get_one_time, fn_list)
+else:
+    pool = None
+    CC_iter = map(get_one_time, fn_list)
+CC_list = []
+for ii, CC in enumerate(CC_iter):
+    if ii == 0:
+        St_dict = start_files(CC)
+    CC_list.append(CC)
+    if (len(CC_list) == NB) or (ii == NT-1):
+        write_block(St_dict, CC_list)
+        CC_list = []
+    if (np.mod(ii,100) == 0): # 100
+        print(str(ii), end=', ')
+        sys.stdout.flush()
+        if (np.mod(ii,1000) == 0) and (ii > 0): # 1000
+            print(str(ii))
+            sys.stdout.flush()
+    elif (ii == NT-1):
+        print(str(ii))
+        sys.stdout.flush()
+if pool != None:
+    pool.close()
+    pool.join()
+for sn in sn_list:
+    store_functions.close_store(St_dict[sn])
+print(' - time for extraction %0.2f sec' % (time()-tt0))
+
+print('- total Elapsed time was %0.2f sec' % (time()-tt00))
+print('DONE')
@@ -0,0 +1,63 @@
+"""
+Module of functions shared by the mooring extraction code.
+"""
+
+def find_good(G, ilat, ilon, mask):
+    """
+    Starting from (ilat, ilon), look for a nearby point that is not
+    masked on the rho, u, or v grid (mask = 'rho', 'u', or 'v').
+    Returns the indices of the good point, or (None, None) if there
+    is not one.
+    """
+    if mask == 'rho':
+        # look on all four sides
+        jig_list = [[0,0],[1,0],[-1,0],[0,1],[0,-1]]
+    elif mask == 'u':
+        # just look to west
+        jig_list = [[0,0],[0,-1]]
+    elif mask == 'v':
+        # just look to south
+        jig_list = [[0,0],[-1,0]]
+    count = 0
+    while count < len(jig_list):
+        jig = jig_list[count]
+        Ilat = ilat + jig[0]
+        Ilon = ilon + jig[1]
+        if G['mask_'+mask][Ilat,Ilon] == 1:
+            print('   - %s: (%d, %d) => (%d, %d), jig = [%d, %d]' %
+                (mask, ilat, ilon, Ilat, Ilon, jig[0], jig[1]))
+            return Ilat, Ilon
+        count += 1
+    print('ERROR: no good nearby point found on mask for ' + mask)
+    return None, None
+
+def get_vn_list(Ldir, data_vars):
+    """
+    Make the comma-separated string of variables to extract, based on the
+    get_* flags in Ldir, and the list of variables in the history files.
+    """
+    # check to see if we are working with the old or new NPZDOC variables
+    if 'NH4' in data_vars:
+        # updated ROMS
+        bio_list = ',NO3,NH4,phytoplankton,zooplankton,SdetritusN,LdetritusN,SdetritusC,LdetritusC,oxygen,alkalinity,TIC,rho'
+    else:
+        # original version
+        bio_list = ',NO3,phytoplankton,zooplankton,detritus,Ldetritus,oxygen,alkalinity,TIC,rho'
+
+    vn_list = 'h,zeta'
+    if Ldir['get_tsa']:
+        vn_list += ',salt,temp,AKs,AKv'
+    if Ldir['get_vel']:
+        vn_list += ',u,v,w,ubar,vbar'
+    if Ldir['get_bio']:
+        vn_list += bio_list
+    if Ldir['get_surfbot']:
+        vn_list += ',Pair,Uwind,Vwind,shflux,ssflux,latent,sensible,lwrad,swrad,sustr,svstr,bustr,bvstr'
+    # The choice below is a custom job that is not part of get_all.  It is problematic to add such jobs becasue
+    # you also have to add them to the args at the top of this code and the multi_mooring_driver.
+    if Ldir['get_pressure']: # fields used for 1-D pressure analysis
+        vn_list += ',salt,temp,u,v,Pair,Uwind,Vwind'
+
+    # do a final check to drop missing variables from the list
+    vn_list = (',').join([item for item in vn_list.split(',') if item in data_vars])
+    return vn_list
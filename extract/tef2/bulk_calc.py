@@ -4,6 +4,10 @@ Based on his code, and modified by PM.
 
 PERFORMANCE: 9 sec for test.
 
+2026.10.18 The multi-layer calculation is now done for all days of a section at
+once using tfl.calc_bulk_values_all(), which has the slow parts vectorized, and
+sections are processed in parallel by a multiprocessing Pool of Nproc workers.
+
 To test on mac:
 run bulk_calc.py -gtx cas7_trapsV00_meV00 -ctag c0 -0 2017.07.04 -1 2017.07.06
 
@@ -16,6 +20,7 @@ import pickle
 from time import time
 import pandas as pd
 import xarray as xr
+import multiprocessing as mp
 
 from lo_tools import Lfun, zfun
 import tef_fun_lorenz as tfl
@@ -40,28 +45,27 @@ if Ldir['testing']:
 
 # ---------
 
-tt00 = time()
-
 # setting Ldir['testing'] = True runs a deep debugging step, in which you only process
-# the first day, and look at the details of the multi-layer bulk calculation,
-# both graphically and as screen output.
-
-for snp in sect_list:
+# one section, and look at the details of the multi-layer bulk calculation for the
+# first day, both graphically and as screen output.
+
+def do_one_section(snp):
+    """
+    Do the bulk calculation for one section, and save the results to NetCDF.
+    This runs in the worker processes, and returns a string to print.
+    """
     tt0 = time()
-    
-    print('Working on ' + snp)
-    sys.stdout.flush()
     out_fn = out_dir / snp
 
     # load the processed Dataset for this section
-    
+
     ds = xr.open_dataset(in_dir / snp)
-    
+
     # Create the absolute value of the net transport (to make Qprism)
     # but first remove the low-passed transport (like Qr)
     qnet_lp = zfun.lowpass(ds.qnet.values, f='godin',nanpad=False)
     qabs = np.abs(ds.qnet.values - qnet_lp)
-    
+
     # Tidal averaging, subsample, and cut off nans
     pad = 36
     # this pad is more than is required for the nans from the godin filter (35),
@@ -87,7 +91,7 @@ for snp in sect_list:
     TEF_lp['qprism'] = TEF_lp['qabs'].copy()/2
     vec_list += ['qabs', 'qprism']
     ds.close()
-    
+
     # get sizes and make sedges (the edges of sbins)
     DS=sbins[1]-sbins[0]
     sedges = np.concatenate((sbins,np.array([sbins[-1]] + DS))) - DS/2
@@ -101,75 +105,53 @@ for snp in sect_list:
         Q_dict[vn] = omat.copy()
         Q_dict[vn][:,:-1] = np.fliplr(np.cumsum(np.fliplr(TEF_lp[vn]), axis=1))
 
-    # prepare arrays to hold multi-layer output
+    # multi-layer output for all days, packed as (days, layers)
     nlay = 30
-    nmat = np.nan * np.ones((NT, nlay))
-    MLO = dict()
-    for vn in vn_list:
-        MLO[vn] = nmat.copy()
-    
+    MLO = tfl.calc_bulk_values_all(sedges, Q_dict, vn_list, nlay=nlay)
+
     if Ldir['testing']:
         plt.close('all')
-        dd_list = [0]
-        print_info = True
-    else:
-        dd_list = range(NT)
-        print_info = False
-
-    for dd in dd_list:
-            
+        dd = 0
         thisQ_dict = dict()
         for vn in vn_list:
             thisQ_dict[vn] = Q_dict[vn][dd,:]
-    
-        if print_info == True:
-            print('\n**** dd = %d ***' % (dd))
-                
-        out_tup = tfl.calc_bulk_values(sedges, thisQ_dict, vn_list, print_info=print_info)
+
+        print('\n**** dd = %d ***' % (dd))
+
+        out_tup = tfl.calc_bulk_values(sedges, thisQ_dict, vn_list, print_info=True)
         in_dict, out_dict, div_sal, ind, minmax = out_tup
-        
-        if print_info == True:
-            print(' ind = %s' % (str(ind)))
-            print(' minmax = %s' % (str(minmax)))
-            print(' div_sal = %s' % (str(div_sal)))
-            print(' Q_in_m = %s' % (str(in_dict['q'])))
-            print(' s_in_m = %s' % (str(in_dict['salt'])))
-            print(' Q_out_m = %s' % (str(out_dict['q'])))
-            print(' s_out_m = %s' % (str(out_dict['salt'])))
-        
-            fig = plt.figure(figsize=(12,8))
-        
-            ax = fig.add_subplot(121)
-            ax.plot(Q_dict['q'][dd,:], sedges,'.k')
-            min_mask = minmax=='min'
-            max_mask = minmax=='max'
-            print(min_mask)
-            print(max_mask)
-            ax.plot(Q_dict['q'][dd,ind[min_mask]], sedges[ind[min_mask]],'*b')
-            ax.plot(Q_dict['q'][dd,ind[max_mask]], sedges[ind[max_mask]],'*r')
-            ax.grid(True)
-            ax.set_title('Q(s) Time index = %d' % (dd))
-            ax.set_ylim(-.1,36.1)
-            ax.set_ylabel('Salinity')
-        
-            ax = fig.add_subplot(122)
-            ax.plot(TEF_lp['q'][dd,:], sbins)
-            ax.grid(True)
-            ax.set_title('-dQ/ds')
-        
-        bulk_dict = dict()
-        for vn in vn_list:
-            bulk_dict[vn] = np.array(in_dict[vn] + out_dict[vn])
-        ii = np.argsort(bulk_dict['salt'])
-        if len(ii) > 0:
-            for vn in vn_list:
-                bulk_dict[vn] = bulk_dict[vn][ii]
-                NL = len(ii)
-                MLO[vn][dd, :NL] = bulk_dict[vn]
-                
+
+        print(' ind = %s' % (str(ind)))
+        print(' minmax = %s' % (str(minmax)))
+        print(' div_sal = %s' % (str(div_sal)))
+        print(' Q_in_m = %s' % (str(in_dict['q'])))
+        print(' s_in_m = %s' % (str(in_dict['salt'])))
+        print(' Q_out_m = %s' % (str(out_dict['q'])))
+        print(' s_out_m = %s' % (str(out_dict['salt'])))
+
+        fig = plt.figure(figsize=(12,8))
+
+        ax = fig.add_subplot(121)
+        ax.plot(Q_dict['q'][dd,:], sedges,'.k')
+        min_mask = minmax=='min'
+        max_mask = minmax=='max'
+        print(min_mask)
+        print(max_mask)
+        ax.plot(Q_dict['q'][dd,ind[min_mask]], sedges[ind[min_mask]],'*b')
+        ax.plot(Q_dict['q'][dd,ind[max_mask]], sedges[ind[max_mask]],'*r')
+        ax.grid(True)
+        ax.set_title('Q(s) Time index = %d' % (dd))
+        ax.set_ylim(-.1,36.1)
+        ax.set_ylabel('Salinity')
+
+        ax = fig.add_subplot(122)
+        ax.plot(TEF_lp['q'][dd,:], sbins)
+        ax.grid(True)
+        ax.set_title('-dQ/ds')
+
     for vn in vec_list:
         MLO[vn] = TEF_lp[vn].copy()
-        
+
     # Pack results in a Dataset and then save to NetCDF
     ds = xr.Dataset(coords={'time': time_lp,'layer': np.arange(nlay)})
     for vn in vn_list:
@@ -178,19 +160,30 @@ for snp in sect_list:
         ds[vn] = (('time'), MLO[vn])
     # save it to NetCDF
     ds.to_netcdf(out_dir / out_fn)
-    if Ldir['testing']:
-        pass
-    else:
-        ds.close()
-    print('  elapsed time for section = %d seconds' % (time()-tt0))
-    sys.stdout.flush()
-    
-    if Ldir['testing']:
-        plt.show()
-        
-print('\nTotal elapsed time = %d seconds' % (time()-tt00))
+    ds.close()
+    return 'Finished %s: elapsed time for section = %0.1f seconds' % (snp, time()-tt0)
 
+tt00 = time()
 
+# Each worker inherits everything above (the forked processes share Ldir, in_dir,
+# out_dir, etc.) and does whole sections. Nproc = 1, or testing, does everything
+# in this process, which is useful for debugging.
+if (Ldir['Nproc'] > 1) and (len(sect_list) > 1) and (not Ldir['testing']):
+    pool = mp.get_context('fork').Pool(min(Ldir['Nproc'], len(sect_list)))
+    result_iter = pool.imap_unordered(do_one_section, sect_list)
+else:
+    pool = None
+    result_iter = map(do_one_section, sect_list)
+
+for msg in result_iter:
+    print(msg)
+    sys.stdout.flush()
 
+if pool != None:
+    pool.close()
+    pool.join()
 
+if Ldir['testing']:
+    plt.show()
 
+print('\nTotal elapsed time = %d seconds' % (time()-tt00))
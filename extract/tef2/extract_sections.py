@@ -4,15 +4,19 @@ Code to extract tef2 sections.
 To test on mac:
 run extract_sections.py -gtx cas7_trapsV00_meV00 -ctag c0 -get_bio True -0 2017.07.04 -1 2017.07.06
 
-Doing this with subprocesses (Nproc = 10, on my mac) was about 2x as fast as doing
-it sequentially within this program. The less-than-expected speedup may be because
-each job only takes about a second, and there is overhead to spinning up new python
-jobs because of imports.
+2026.10.18 Recoded to do the extraction in-process with a multiprocessing Pool of
+Nproc workers, instead of launching extract_sections_one_time.py as a new python
+subprocess for each history file and then concatenating the results with ncrcat.
+- The section indices are made once here, and the workers inherit them.
+- Each worker reads only small j/i hyperslabs of each variable, using netCDF4,
+instead of the full 3D fields: one box per group of nearby sections (see
+get_groups(); a single box around a whole collection would be most of the domain).
+- The results come back in time order and are written directly to the
+per-section NetCDF files, in blocks of NB times, so there are no temporary
+CC_*.nc files and no ncrcat step. DZ is also calculated by the workers.
+The output files are the same as before.
 
-Also, this is a memory-intensive calculation, so be careful about using Nproc > 10
-(10 is the default in extract_argfun).
-
-Performance: 3.5 minutes for test
+Nproc = 1 does everything in this process, which is useful for debugging.
 
 """
 
@@ -20,14 +24,13 @@ from lo_tools import Lfun, zrfun, zfun
 from lo_tools import extract_argfun as exfun
 Ldir = exfun.intro() # this handles the argument passing
 
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
 from time import time
 import sys
 import pandas as pd
-import xarray as xr
+import netCDF4 as nc
 import numpy as np
-import pickle
+import multiprocessing as mp
+import tef_fun
 
 gctag = Ldir['gridname'] + '_' + Ldir['collection_tag']
 tef2_dir = Ldir['LOo'] / 'extract' / 'tef2'
@@ -39,46 +42,220 @@ fn_list = Lfun.get_fn_list('hourly', Ldir, Ldir['ds0'], Ldir['ds1'], his_num=Ldi
 
 out_dir0 = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'tef2'
 out_dir = out_dir0 / ('extractions_' + Ldir['ds0'] + '_' + Ldir['ds1'])
-temp_dir = out_dir0 / ('temp_' + Ldir['ds0'] + '_' + Ldir['ds1'])
 Lfun.make_dir(out_dir, clean=True)
-Lfun.make_dir(temp_dir, clean=True)
 
 if Ldir['testing']:
     fn_list = fn_list[:3]
 
-# loop over all jobs
+# number of times to hold in memory before writing to the output files
+NB = 24
+
+# Things that do not change with time, made using the first history file.
+ds = nc.Dataset(fn_list[0])
+ds.set_auto_mask(False)
+if Ldir['get_bio']:
+    if 'NH4' in ds.variables:
+        vn_list = tef_fun.vn_list
+    else:
+        # old roms version
+        vn_list = ['salt', 'temp', 'oxygen',
+            'NO3', 'phytoplankton', 'zooplankton', 'detritus', 'Ldetritus',
+            'TIC', 'alkalinity']
+else:
+    vn_list = ['salt']
+time_units = ds['ocean_time'].units
+DX = 1/ds['pm'][:]
+DY = 1/ds['pn'][:]
+h = ds['h'][:]
+ds.close()
+S = zrfun.get_basic_info(fn_list[0], only_S=True)
+NZ = S['N']
+
+# Get spacing on u and v grids
+dxv = DX[:-1,:] + np.diff(DX,axis=0)/2 # DX on the v-grid
+dyu = DY[:,:-1] + np.diff(DY,axis=1)/2 # DY on the u-grid
+# separate out u and v parts of sect_df
+u_df = sect_df[sect_df.uv == 'u']
+v_df = sect_df[sect_df.uv == 'v']
+NP = len(sect_df)
+
+# get depth at section points
+# note that we are interpolating from two rho-grid points onto the u- or v-grid
+h_p = (h[sect_df.jrp, sect_df.irp]  + h[sect_df.jrm, sect_df.irm])/2
+# get width at section points
+dd = np.nan * np.ones(h_p.shape)
+dd[v_df.index] = dxv[v_df.j, v_df.i]
+dd[u_df.index] = dyu[u_df.j, u_df.i]
+
+def get_box(jj, ii):
+    # Returns the slices that cover all the points (jj, ii), and the point
+    # indices relative to the start of those slices.
+    jj = np.array(jj, dtype=int); ii = np.array(ii, dtype=int)
+    if len(jj) == 0:
+        return (slice(0,0), slice(0,0)), jj, ii
+    j0 = jj.min(); i0 = ii.min()
+    return (slice(j0, jj.max()+1), slice(i0, ii.max()+1)), jj-j0, ii-i0
+
+def get_groups(min_area=400):
+    # Group the sections so that we read one small box per group, instead of one
+    # box around every section (which would be most of the domain). We start with
+    # one group per section, and merge two groups if the box around both is not
+    # much bigger than their two boxes (min_area is about the cost of another read
+    # in grid cells). Returns a list of arrays of point indices into sect_df.
+    def box_of(ip):
+        jj = np.concatenate((sect_df.jrp.to_numpy()[ip], sect_df.jrm.to_numpy()[ip]))
+        ii = np.concatenate((sect_df.irp.to_numpy()[ip], sect_df.irm.to_numpy()[ip]))
+        return (jj.min(), jj.max(), ii.min(), ii.max())
+    def area(b):
+        return (b[1] - b[0] + 1) * (b[3] - b[2] + 1)
+    def union(b0, b1):
+        return (min(b0[0], b1[0]), max(b0[1], b1[1]), min(b0[2], b1[2]), max(b0[3], b1[3]))
+    ip_list = [np.where(sect_df.sn == sn)[0] for sn in sorted(sect_df.sn.unique())]
+    box_list = [box_of(ip) for ip in ip_list]
+    merging = True
+    while merging:
+        merging = False
+        for g0 in range(len(ip_list)):
+            for g1 in range(g0+1, len(ip_list)):
+                bu = union(box_list[g0], box_list[g1])
+                if area(bu) <= area(box_list[g0]) + area(box_list[g1]) + min_area:
+                    ip_list[g0] = np.concatenate((ip_list[g0], ip_list[g1]))
+                    box_list[g0] = bu
+                    ip_list.pop(g1)
+                    box_list.pop(g1)
+                    merging = True
+                    break
+            if merging:
+                break
+    return ip_list
+
+# index info on the rho, u, and v grids, for each group of sections
+uv = sect_df.uv.to_numpy()
+pm = sect_df.pm.to_numpy()
+group_list = []
+for ip in get_groups():
+    GR = dict()
+    GR['ip'] = ip
+    GR['r_box'], r_jj, r_ii = get_box(np.concatenate((sect_df.jrp.to_numpy()[ip], sect_df.jrm.to_numpy()[ip])),
+        np.concatenate((sect_df.irp.to_numpy()[ip], sect_df.irm.to_numpy()[ip])))
+    npg = len(ip)
+    GR['jrp'] = r_jj[:npg]; GR['jrm'] = r_jj[npg:]
+    GR['irp'] = r_ii[:npg]; GR['irm'] = r_ii[npg:]
+    for gn in ['u', 'v']:
+        ipg = ip[uv[ip] == gn]
+        GR[gn + '_ip'] = ipg
+        GR[gn + '_box'], GR[gn + '_jj'], GR[gn + '_ii'] = get_box(sect_df.j.to_numpy()[ipg],
+            sect_df.i.to_numpy()[ipg])
+        GR[gn + '_pm'] = pm[ipg].reshape(1,-1)
+    group_list.append(GR)
+print('Reading %d boxes for %d sections' % (len(group_list), len(sect_df.sn.unique())))
+
+def get_one_time(fn):
+    """
+    Does the extraction of all sections for a single history file.
+    Returns a dict of arrays packed (z,p) or (p).
+    """
+    ds = nc.Dataset(fn)
+    CC = dict()
+    CC['ot'] = float(ds['ocean_time'][0])
+    def put(vn, ip, vals):
+        # put values for the points ip into CC[vn], made the first time with
+        # the data type of the values
+        if vn not in CC.keys():
+            CC[vn] = np.empty(vals.shape[:-1] + (NP,), dtype=vals.dtype)
+        CC[vn][..., ip] = vals
+    # Fields that do change with time, read one box at a time.
+    #
+    # First: tracers and zeta. The filled() calls turn masked values into nan,
+    # as xarray would do.
+    vel = np.nan * np.ones((NZ, NP))
+    for GR in group_list:
+        ip = GR['ip']
+        jrp = GR['jrp']; jrm = GR['jrm']; irp = GR['irp']; irm = GR['irm']
+        r_box = GR['r_box']
+        for vn in vn_list:
+            aa = np.ma.filled(ds[vn][0, :, r_box[0], r_box[1]], np.nan)
+            put(vn, ip, (aa[:, jrp, irp]  + aa[:, jrm, irm])/2)
+        aa = np.ma.filled(ds['zeta'][0, r_box[0], r_box[1]], np.nan)
+        put('zeta', ip, (aa[jrp, irp]  + aa[jrm, irm])/2)
+        # Then: velocity
+        for gn in ['u', 'v']:
+            if len(GR[gn + '_ip']) > 0:
+                box = GR[gn + '_box']
+                aa = np.ma.filled(ds[gn][0, :, box[0], box[1]], np.nan)
+                vel[:, GR[gn + '_ip']] = aa[:, GR[gn + '_jj'], GR[gn + '_ii']] * GR[gn + '_pm']
+    CC['vel'] = vel
+    ds.close()
+    # layer thickness
+    zw = zrfun.get_z(h_p, CC['zeta'], S, only_w=True).reshape(NZ+1, NP)
+    CC['DZ'] = np.diff(zw, axis=0)
+    return CC
+
+# one output file for each section, with the indices of its points in sect_df
+sect_list = list(sect_df.sn.unique())
+sect_list.sort()
+p_dict = dict()
+for sn in sect_list:
+    p_dict[sn] = np.where(sect_df.sn == sn)[0]
+vn_out_list = vn_list + ['vel', 'DZ']
+
+def start_files(CC):
+    # Create the output files, using the first result to get the data types.
+    out_dict = dict()
+    for sn in sect_list:
+        ii = p_dict[sn]
+        out_ds = nc.Dataset(out_dir / (sn + '.nc'), 'w')
+        out_ds.createDimension('time', None)
+        out_ds.createDimension('z', NZ)
+        out_ds.createDimension('p', len(ii))
+        vv = out_ds.createVariable('time', float, ('time',))
+        vv.units = time_units
+        vv = out_ds.createVariable('h', float, ('p',))
+        vv[:] = h_p[ii]
+        vv = out_ds.createVariable('dd', float, ('p',))
+        vv[:] = dd[ii]
+        out_ds.createVariable('zeta', CC['zeta'].dtype, ('time','p'))
+        for vn in vn_out_list:
+            out_ds.createVariable(vn, CC[vn].dtype, ('time','z','p'))
+        out_dict[sn] = out_ds
+    return out_dict
+
+def write_block(out_dict, CC_list, it0):
+    # Write a list of results to all the output files, starting at time index it0.
+    ot = np.array([CC['ot'] for CC in CC_list])
+    zeta = np.stack([CC['zeta'] for CC in CC_list]) # packed (t,p)
+    fld_dict = dict()
+    for vn in vn_out_list:
+        fld_dict[vn] = np.stack([CC[vn] for CC in CC_list]) # packed (t,z,p)
+    it1 = it0 + len(CC_list)
+    for sn in sect_list:
+        ii = p_dict[sn]
+        out_ds = out_dict[sn]
+        out_ds['time'][it0:it1] = ot
+        out_ds['zeta'][it0:it1,:] = zeta[:,ii]
+        for vn in vn_out_list:
+            out_ds[vn][it0:it1,:,:] = fld_dict[vn][:,:,ii]
+
+# loop over all history files
 tt0 = time()
 N = len(fn_list)
-proc_list = []
-for ii in range(N):
-    # Launch a job and add its process to a list.
-    fn = fn_list[ii]
-    ii_str = ('0000' + str(ii))[-5:]
-    out_fn = temp_dir / ('CC_' + ii_str + '.nc')
-    # use subprocesses
-    cmd_list = ['python3', 'extract_sections_one_time.py',
-            '-sect_df_fn', str(sect_df_fn),
-            '-in_fn',str(fn),
-            '-out_fn', str(out_fn),
-            '-get_bio', str(Ldir['get_bio'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-    # If we have accumulated Nproc jobs, or are at the end of the
-    # total number of jobs, then stop and make sure all the jobs
-    # in proc_list have finished, using the communicate method.
-    if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            if len(stdout) > 0:
-                print('\nSTDOUT:')
-                print(stdout.decode())
-                sys.stdout.flush()
-            if len(stderr) > 0:
-                print('\nSTDERR:')
-                print(stderr.decode())
-                sys.stdout.flush()
-        # Then initialize a new list.
-        proc_list = []
+if Ldir['Nproc'] > 1:
+    # the workers are forked, so they inherit all the index info above
+    pool = mp.get_context('fork').Pool(min(Ldir['Nproc'], N))
+    CC_iter = pool.imap(get_one_time, fn_list)
+else:
+    pool = None
+    CC_iter = map(get_one_time, fn_list)
+CC_list = []
+it0 = 0
+for ii, CC in enumerate(CC_iter):
+    if ii == 0:
+        out_dict = start_files(CC)
+    CC_list.append(CC)
+    if (len(CC_list) == NB) or (ii == N-1):
+        write_block(out_dict, CC_list, it0)
+        it0 += len(CC_list)
+        CC_list = []
     # Print screen output about progress.
     if (np.mod(ii,10) == 0) and ii>0:
         print(str(ii), end=', ')
@@ -89,34 +266,19 @@ for ii in range(N):
     if (ii == N-1):
         print(str(ii))
         sys.stdout.flush()
+if pool != None:
+    pool.close()
+    pool.join()
+for sn in sect_list:
+    out_dict[sn].close()
     
 print('Total processing time = %0.2f sec' % (time()-tt0))
 
-# concatenate the records into one file
-# This bit of code is a nice example of how to replicate a bash pipe
-pp1 = Po(['ls', str(temp_dir)], stdout=Pi)
-pp2 = Po(['grep','CC'], stdin=pp1.stdout, stdout=Pi)
-temp_fn = str(temp_dir)+'/all.nc'
-cmd_list = ['ncrcat','-p', str(temp_dir), '-O', temp_fn]
-proc = Po(cmd_list, stdin=pp2.stdout, stdout=Pi, stderr=Pi)
-stdout, stderr = proc.communicate()
-if len(stdout) > 0:
-    print('\nSTDOUT:')
-    print(stdout.decode())
-    sys.stdout.flush()
-if len(stderr) > 0:
-    print('\nSTDERR:')
-    print(stderr.decode())
-    sys.stdout.flush()
-        
 """
-Next we want to repackage these results into one NetCDF file per section, with all times.
-
-We will mostly follow the structure of the output of LO/tef/extract_sections.py
+We mostly follow the structure of the output of LO/tef/extract_sections.py
 so that we can mostly recycle the subsequent processing code:
 
-The result, looking for example at "this_ds" created below
-for one section while testing:
+The result, looking for example at the output for one section while testing:
     
 <xarray.Dataset>
 Dimensions:  (time: 3, p: 8, z: 30)
@@ -135,36 +297,3 @@ The dimension "p" means a point on the stairstep section. "dd" is the point widt
 and "DZ" [m] is the vertical thickness of each cell.
     
 """
-
-# Get DZ for the full set of sections
-ds1 = xr.open_dataset(temp_fn)
-S = zrfun.get_basic_info(fn_list[0], only_S=True)
-eta = ds1.zeta.values.squeeze() # packed (t, p)
-NT, NP = eta.shape
-hh = ds1.h.values.squeeze().reshape(1,NP) * np.ones((NT,1))
-zw = zrfun.get_z(hh, eta, S, only_w=True)
-dz = np.diff(zw, axis=0) # NOTE: this is packed (z,t,p)
-DZ = np.transpose(dz, (1,0,2)) # packed (t,z,p)
-# then make a Dataset for each section, add DZ to it, and save to NetCDF
-sect_list = list(sect_df.sn.unique())
-sect_list.sort()
-for sn in sect_list:
-    """
-    A useful tool for pulling out a section is np.where() combined with the
-    xr Dataset method isel(), as is done here.
-    """
-    ii = np.where(sect_df.sn == sn)[0]
-    this_ds = ds1.isel(p=ii)
-    # add DZ
-    this_DZ = DZ[:,:,ii]
-    this_ds['DZ'] = (('time','z','p'), this_DZ)
-    this_fn = out_dir / (sn + '.nc')
-    this_ds.to_netcdf(this_fn)
-ds1.close()
-
-# clean up the temp dir
-if not Ldir['testing']:
-    Lfun.make_dir(temp_dir, clean=True)
-    temp_dir.rmdir()
-
-
@@ -10,6 +10,24 @@ Performance: 2.5 minutes for test
 Use -get_bio True to get all bio tracers
 Use -test True for more screen output and a shorter extraction
 
+2026.10.18 Recoded to do the extraction in-process with a multiprocessing Pool of
+Nproc workers, instead of launching extract_segments_one_time.py as a new python
+subprocess for each history file.
+- The segment indices, h, and cell areas are made once here, and the workers
+inherit them. They are packed as one list of all the (j,i) points in all segments,
+with a label array giving the segment number of each point.
+- Each worker reads only the j/i hyperslab (the bounding box of all the segment
+points) of each variable, using netCDF4, and calculates z_w once for all points.
+- The segment volumes and the volume (or area) integrals of the tracers are then done
+with one np.bincount() over the label array for each variable, instead of a loop
+over the segments.
+- There are no temporary files, and the results are assembled directly into the
+output Dataset, which is the same as before.
+Also: shflux is now included when it is in the history files (the check used to
+look for "sh_flux", so it was always skipped).
+
+Nproc = 1 does everything in this process, which is useful for debugging.
+
 """
 from lo_tools import Lfun, zrfun
 from lo_tools import extract_argfun as exfun
@@ -18,11 +36,11 @@ Ldir = exfun.intro() # this handles the argument passing
 import sys
 from time import time
 import numpy as np
-import pickle
 import pandas as pd
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
+import netCDF4 as nc
 import xarray as xr
+import multiprocessing as mp
+import tef_fun
 
 tt00 = time()
 
@@ -37,113 +55,169 @@ seg_info_dict_fn = tef2_dir / ('seg_info_dict_' + Ldir['gctag'] + '_' + Ldir['ri
 
 # output names and places
 out_dir0 = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'tef2'
-temp_dir = out_dir0 / ('segments_temp_' + long_tag)
 out_name = 'segments_' + long_tag + '.nc'
 out_fn = out_dir0 / out_name
 out_fn.unlink(missing_ok=True) # make sure output file does not exist
 Lfun.make_dir(out_dir0)
-Lfun.make_dir(temp_dir, clean=True)
 
 print(' Doing segment extraction for '.center(60,'='))
 print(' out_dir0 = ' + str(out_dir0))
 print(' out_name = ' + out_name)
-print(' temp dir = ' + temp_dir.name)
 
 fn_list = Lfun.get_fn_list('hourly', Ldir, Ldir['ds0'], Ldir['ds1'], his_num=Ldir['his_num'])
 if Ldir['testing']:
     fn_list = fn_list[:3]
 
-print('Doing initial data extraction:')
-# We do extractions one hour at a time, as separate subprocess jobs.
-# Files are saved to temp_dir.
+# grid info, from the cache
+G, S, T = zrfun.get_basic_info_cached(fn_list[0])
+
+# Segment index info: jj_all and ii_all are the indices of all the points in all
+# the segments, and lab is the segment number of each point. A point may be in
+# more than one segment.
+seg_info_dict = pd.read_pickle(seg_info_dict_fn)
+seg_list = list(seg_info_dict.keys())
+NS = len(seg_list)
+jj_list = []; ii_list = []; lab_list = []
+for iseg in range(NS):
+    ji = np.array(seg_info_dict[seg_list[iseg]]['ji_list'], dtype=int).reshape(-1,2)
+    jj_list.append(ji[:,0])
+    ii_list.append(ji[:,1])
+    lab_list.append(iseg * np.ones(len(ji), dtype=int))
+jj_all = np.concatenate(jj_list)
+ii_all = np.concatenate(ii_list)
+lab = np.concatenate(lab_list)
+
+def get_box(jj, ii):
+    # Returns the slices that cover all the points (jj, ii), and the point
+    # indices relative to the start of those slices.
+    jj = np.array(jj, dtype=int); ii = np.array(ii, dtype=int)
+    j0 = jj.min(); i0 = ii.min()
+    return (slice(j0, jj.max()+1), slice(i0, ii.max()+1)), jj-j0, ii-i0
+
+(js, is_), jj_box, ii_box = get_box(jj_all, ii_all)
+h_p = G['h'][jj_all, ii_all]
+DA_p = G['DA'][jj_all, ii_all]
+# area of each segment
+area = np.bincount(lab, weights=DA_p, minlength=NS)
+
+def seg_sum(aa):
+    # Sum the values aa (one for each point) over each segment.
+    return np.bincount(lab, weights=aa, minlength=NS)
+
+# set list of variables to extract
+ds = nc.Dataset(fn_list[0])
+if Ldir['get_bio']:
+    if 'NH4' in ds.variables:
+        vn_list = tef_fun.vn_list
+    else:
+        # old roms version
+        vn_list = ['salt', 'temp', 'oxygen',
+            'NO3', 'phytoplankton', 'zooplankton', 'detritus', 'Ldetritus',
+            'TIC', 'alkalinity']
+else:
+    vn_list = ['salt']
+# Trim vn_list to only have variables in ds
+vn_list = [vn for vn in vn_list if vn in ds.variables]
+# Other 2-D quantities we will want for budgets:
+#
+# EminusP
+#
+# standard_name:   surface_upward_water_flux
+# long_name:       modeled surface net freshwater flux, (E-P)/rhow
+# units:           meter second-1
+# negative_value:  upward flux, freshening (net precipitation)
+# positive_value:  downward flux, salting (net evaporation)
+#
+# salt_surf: surface salinity, to use with EminusP
+#
+# shflux
+#
+# standard_name:   surface_downward_heat_flux_in_sea_water
+# long_name:       surface net heat flux
+# units:           watt meter-2
+# negative_value:  upward flux, cooling
+# positive_value:  downward flux, heating
+two_d_list = [vn for vn in ['EminusP', 'salt_surf', 'shflux'] if (vn in ds.variables) or (vn == 'salt_surf')]
+ot_units = ds['ocean_time'].units
+ds.close()
+# add custom 3-D variables, like salt-squared
+vn_list = vn_list + ['salt2']
+
+def get_one_time(fn):
+    """
+    Does the extraction of all segments for a single history file.
+    Returns a dict of arrays packed (segment), and the time.
+    """
+    tt0 = time()
+    ds = nc.Dataset(fn)
+    CC = dict()
+    CC['ot'] = float(ds['ocean_time'][0])
+    # The filled() calls turn masked values into nan, as xarray would do.
+    zeta = np.ma.filled(ds['zeta'][0, js, is_], np.nan)[jj_box, ii_box]
+    z_w = zrfun.get_z(h_p, zeta, S, only_w=True)
+    DV = np.diff(z_w, axis=0) * DA_p
+    volume = seg_sum(DV.sum(axis=0))
+    CC['volume'] = volume
+    CC['area'] = area
+    # 3-D tracers
+    salt = np.ma.filled(ds['salt'][0, :, js, is_], np.nan)[:, jj_box, ii_box]
+    for vn in vn_list:
+        if vn == 'salt':
+            fld = salt
+        elif vn == 'salt2':
+            fld = salt * salt
+        else:
+            fld = np.ma.filled(ds[vn][0, :, js, is_], np.nan)[:, jj_box, ii_box]
+        CC[vn] = seg_sum((fld * DV).sum(axis=0))/volume
+    # 2-D properties, e.g. for surface fluxes
+    for vn in two_d_list:
+        if vn == 'salt_surf':
+            fld = salt[-1,:]
+        else:
+            fld = np.ma.filled(ds[vn][0, js, is_], np.nan)[jj_box, ii_box]
+        CC[vn] = seg_sum(fld * DA_p)/area
+    ds.close()
+    if Ldir['testing']:
+        print('%s took %0.2f sec' % (fn.parent.name + '/' + fn.name, time()-tt0))
+        sys.stdout.flush()
+    return CC
+
+print('Doing data extraction:')
 tt000 = time()
-proc_list = []
 N = len(fn_list)
-for ii in range(N):
-    fn = fn_list[ii]
-    
-    d = fn.parent.name.replace('f','')
-    nhis = int(fn.name.split('.')[0].split('_')[-1])
-    
-    cmd_list = ['python3', 'extract_segments_one_time.py',
-            '-in_fn',str(fn),
-            '-out_dir',str(temp_dir),
-            '-file_num',str(ii),
-            '-seg_fn',str(seg_info_dict_fn),
-            '-get_bio', str(Ldir['get_bio']),
-            '-test', str(Ldir['testing'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-
-    Nproc = Ldir['Nproc']
-    if ((np.mod(ii,Nproc) == 0) and (ii > 0)) or (ii == N-1):
-        tt0 = time()
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            if Ldir['testing']:
-                print(' sdtout '.center(60,'-'))
-                print(stdout.decode())
-            if len(stderr) > 0:
-                print(' stderr '.center(60,'-'))
-                print(stderr.decode())
-        print(' - %d out of %d: %d took %0.2f sec' % (ii, N, Nproc, time()-tt0))
+if Ldir['Nproc'] > 1:
+    # the workers are forked, so they inherit all the index info above
+    pool = mp.get_context('fork').Pool(min(Ldir['Nproc'], N))
+    CC_iter = pool.imap(get_one_time, fn_list)
+else:
+    pool = None
+    CC_iter = map(get_one_time, fn_list)
+CC_list = []
+tt0 = time()
+for nf, CC in enumerate(CC_iter):
+    CC_list.append(CC)
+    if ((np.mod(nf,Ldir['Nproc']) == 0) and (nf > 0)) or (nf == N-1):
+        print(' - %d out of %d: took %0.2f sec' % (nf, N, time()-tt0))
         sys.stdout.flush()
-        proc_list = []
+        tt0 = time()
+if pool != None:
+    pool.close()
+    pool.join()
 print('Total elapsed time = %0.2f sec' % (time()-tt000))
 
-"""
-Now we repackage all these single-time extractions into an xarray Dataset.  This is
-a little tricky because for the Dataset we want to have it composed of DataArrays that
-are variable(time, segment), but what we are starting from is a collection of
-time(segment, variable) pandas DataFrames.
-
-We will proceed by using a two step process, first concatenating all the pandas DataFrames
-into an xarray DataArray with dimensions(time, segment, variable).  Then we will
-convert this to an xarray Dataset with a collection of variable(time,segment) DataArrays.
-
-I'm sure there is a more clever way to do this in xarray, but I am not yet proficient
-enough with that module.
-"""
-
-# get a list of all our pandas DataFrames
-A_list = list(temp_dir.glob('A*.p'))
-A_list.sort()
-# make a list of the datetimes and form a time index
-ot_list = []
-for fn in fn_list:
-    ds = xr.open_dataset(fn)
-    ot = ds['ocean_time'].values[0]
-    ot_list.append(ot)
-ot_ind = pd.Index(ot_list)
-# make a list of the output as DataArrays
-x_list = []
-for A_fn in A_list:
-    A = pd.read_pickle(A_fn)
-    x_list.append(xr.DataArray(A, dims=('seg','vn')))
-# and concatenate that list into a single DataArray, with time as the concatenating dimension
-da = xr.concat(x_list, pd.Index(ot_ind, name='time'))
-# repackage the DataArray as a Dataset
-vns = da.coords['vn'].values
-segs = da.coords['seg'].values
-times = da.coords['time'].values
-ds = xr.Dataset(coords={'time': times,'seg': segs})
-for vn in vns:
-    v = da.sel(vn=vn).values
-    ds[vn] = (('time','seg'), v)
+# Package the results as an xarray Dataset of variable(time, segment) DataArrays.
+# The times are decoded the same way xarray would do it for the history files.
+tds = xr.Dataset({'time': (('time',), np.array([CC['ot'] for CC in CC_list]), {'units':ot_units})})
+times = xr.decode_cf(tds).time.values
+ds = xr.Dataset(coords={'time': times,'seg': seg_list})
+for vn in ['volume', 'area'] + vn_list + two_d_list:
+    ds[vn] = (('time','seg'), np.array([CC[vn] for CC in CC_list]))
 # save it to NetCDF
 ds.to_netcdf(out_fn)
 ds.close()
 
-# Clean up
-if not Ldir['testing']:
-    Lfun.make_dir(temp_dir, clean=True)
-    temp_dir.rmdir()
-
 if Ldir['testing']:
     # check results
-    seg_info_dict = pd.read_pickle(seg_info_dict_fn) # same as using pickle.load()
     dd = xr.open_dataset(out_fn)
-    print(dd.salt.sel(seg=list(seg_info_dict.keys())[0]).values)
+    print(dd.salt.sel(seg=seg_list[0]).values)
     dd.close()
-
-
@@ -4,6 +4,16 @@ volume, salt, and other variables.
 
 PERFORMANCE: 21 seconds for test.
 
+2026.10.18 Recoded the salinity binning to be vectorized. The bin index of each
+salinity value is calculated once for all times, and then the binned sums for
+each variable are made with a single np.bincount() call, using an index that
+combines time and salinity bin. This replaces a call to
+scipy.stats.binned_statistic() for every time and variable, and gives
+identical results. The work is done in blocks of NTB times to limit memory use.
+The sections are done together, by stacking their points and offsetting the
+bin index by the section number, in groups of NSG sections whose output arrays
+fit in mem_max bytes.
+
 To test on mac:
 run process_sections.py -gtx cas7_trapsV00_meV00 -ctag c0 -0 2017.07.04 -1 2017.07.06
 
@@ -15,7 +25,6 @@ import numpy as np
 import pickle
 from time import time
 import pandas as pd
-from scipy.stats import binned_statistic
 
 from lo_tools import Lfun, zrfun, zfun
 from lo_tools import extract_argfun as exfun
@@ -49,104 +58,134 @@ print(str(in_dir))
 
 tt00 = time()
 
-for ext_fn in sect_list:
-    tt0 = time()
-    print(ext_fn)
-
-    # name output file
-    out_fn = ext_fn
-
-    # load fields
-    ds = xr.open_dataset(in_dir / ext_fn)
-    V = dict()
-    for vn in vn_list:
-        V[vn] = ds[vn].to_numpy()
-    V['salt2'] = V['salt']*V['salt']
-    q = ds['dd'].to_numpy() * ds['DZ'].to_numpy() * ds['vel'].to_numpy()
-    V['q'] = q
-    ot = ds['time'].to_numpy()
-    zeta = ds['zeta'].to_numpy()
-    ds.close()
-
-    # make arrays of property transport
-    QV = dict()
-    for vn in V.keys():
-        if vn == 'q':
-            QV[vn] = q
-        else:
-            QV[vn] = q*V[vn]
-    NT, NZ, NX = q.shape
-    
-    # define salinity bins
-    if Ldir['testing']:
-        NS = 36 # number of salinity bins
-    else:
-        NS = 1000 # number of salinity bins
-    S_low = 0
-    S_hi = 36
-    sedges = np.linspace(S_low, S_hi, NS+1)
-    sbins = sedges[:-1] + np.diff(sedges)/2
-
-    # TEF variables
-    Omat = np.zeros((NT, NS))
+# The sections are processed together: their points are stacked along the p
+# axis, and the salinity bin index is offset by the section number times NS,
+# so one np.bincount() call per variable does every section at once. To
+# bound memory, since the output arrays hold every time for every section,
+# this is done for groups of sections that fit in mem_max bytes of output.
+sect_list.sort()
+ds = xr.open_dataset(in_dir / sect_list[0])
+ot = ds['time'].to_numpy()
+NT = len(ot)
+salt_dtype = ds['salt'].dtype
+ds.close()
+
+# define salinity bins
+if Ldir['testing']:
+    NS = 36 # number of salinity bins
+else:
+    NS = 1000 # number of salinity bins
+S_low = 0
+S_hi = 36
+sedges = np.linspace(S_low, S_hi, NS+1)
+sbins = sedges[:-1] + np.diff(sedges)/2
+
+# Number of sections to process together, so the output arrays for a group
+# (every time, salinity bin, and variable) use at most mem_max bytes.
+mem_max = 2e9
+NSG = max(1, int(mem_max / (8 * NT * NS * (len(vn_list) + 2))))
+g = 9.8
+rho = 1025
+
+# This follows scipy.stats.binned_statistic(): bins are half-open except the
+# last one, which also gets values equal to S_hi (after rounding), and values
+# outside of the range (or nan) are dropped. Like scipy we make the bin edges
+# with the same precision as the salinity.
+if np.issubdtype(salt_dtype, np.floating):
+    sedges_b = np.linspace(S_low, S_hi, NS+1, dtype=salt_dtype)
+else:
+    sedges_b = sedges
+decimal = int(-np.log10(np.diff(sedges_b).min())) + 6
+
+def process_group(sect_group):
+    # Process the sections in sect_group in one pass, and save the results
+    # for each one to NetCDF.
+    NSEC = len(sect_group)
+    ds_list = [xr.open_dataset(in_dir / ext_fn) for ext_fn in sect_group]
+    NZ = ds_list[0]['vel'].shape[1]
+    NX_list = [ds['vel'].shape[2] for ds in ds_list]
+    NP = sum(NX_list)
+    # the range of stacked points for each section
+    p1_list = list(np.cumsum(NX_list))
+    p0_list = [0] + p1_list[:-1]
+    # the section number of each stacked point
+    isec_p = np.repeat(np.arange(NSEC), NX_list)
+    dd = np.concatenate([ds['dd'].to_numpy() for ds in ds_list])
+
+    # TEF variables, packed (time, section, salinity bin) or (time, section)
     TEF = dict()
-    for vn in QV.keys():
-        TEF[vn] = Omat.copy()
-    # other variables
-    omat = np.zeros(NT)
-    qnet = omat.copy()
-    fnet = omat.copy()
-    ssh = omat.copy()
-    g = 9.8
-    rho = 1025
-
-    # Process into salinity bins.
-    for tt in range(NT):
-        sf = V['salt'][tt,:,:].squeeze().flatten()
-        
-        for vn in QV.keys():
-            XF = QV[vn][tt,:,:].squeeze().flatten()
+    for vn in vn_list + ['salt2', 'q']:
+        TEF[vn] = np.zeros((NT, NSEC, NS))
+    for vn in ['qnet', 'fnet', 'ssh']:
+        TEF[vn] = np.zeros((NT, NSEC))
+
+    # Process in blocks of NTB times, to limit memory use.
+    NTB = max(1, int(1e6 / (NZ*NP)))
+    for it0 in range(0, NT, NTB):
+        it1 = min(it0 + NTB, NT)
+        NTT = it1 - it0
+        # load fields for all sections, packed (t,z,p)
+        V = dict()
+        for vn in vn_list:
+            V[vn] = np.concatenate([ds[vn][it0:it1,:,:].to_numpy() for ds in ds_list], axis=2)
+        V['salt2'] = V['salt']*V['salt']
+        DZ = np.concatenate([ds['DZ'][it0:it1,:,:].to_numpy() for ds in ds_list], axis=2)
+        vel = np.concatenate([ds['vel'][it0:it1,:,:].to_numpy() for ds in ds_list], axis=2)
+        q = dd * DZ * vel
+        V['q'] = q
+        zeta = np.concatenate([ds['zeta'][it0:it1,:].to_numpy() for ds in ds_list], axis=1)
+
+        for isec in range(NSEC):
+            p0 = p0_list[isec]; p1 = p1_list[isec]
+            qs = q[:,:,p0:p1]
+            # volume transport
+            qnet = np.nansum(qs.reshape(NTT, NZ*(p1-p0)), axis=1)
+            # and tidal energy flux
+            zi = zeta[:,p0:p1].copy()
+            zi[np.isnan(qs[:,0,:])] = np.nan # jx, if q = NaN, zi = NaN
+            ssh = np.nanmean(zi, axis=1).astype(float)
+            TEF['qnet'][it0:it1,isec] = qnet
+            TEF['ssh'][it0:it1,isec] = ssh
+            TEF['fnet'][it0:it1,isec] = g * rho * ssh * qnet
+
+        # Process into salinity bins.
+        sf = V['salt'].reshape(NTT, NZ*NP)
+        ib = np.searchsorted(sedges_b, sf, side='right') - 1
+        on_edge = ((sf >= sedges_b[-1])
+            & (np.around(sf, decimal) == np.around(sedges_b[-1], decimal)))
+        ib[on_edge] = NS - 1
+        good = (ib >= 0) & (ib < NS)
+        # index into the flattened [NTT, NSEC, NS] output
+        isec_zp = np.tile(isec_p, NZ).reshape(1, NZ*NP)
+        itb = (ib + NS*isec_zp + NSEC*NS*np.arange(NTT).reshape(NTT,1))[good]
+        for vn in V.keys():
             if vn == 'q':
-                # also keep track of volume transport
-                #qnet[tt] = XF.sum() #jx
-                qnet[tt] = np.nansum(XF) #jx
-                # and tidal energy flux
-                zi = zeta[tt,:].squeeze()
-                zi[np.isnan(QV[vn][tt,0,:])] = np.nan # jx, if q = NaN, zi = NaN
-                #ssh[tt] = zi.mean() #jx
-                ssh[tt] = np.nanmean(zi) #jx
-                fnet[tt] = g * rho * ssh[tt] * qnet[tt]
-                
-            # scipy.stats.binned_statistic(x, values, statistic='mean', bins=10, range=None)
-            XF[np.isnan(XF)] = 0 #jx
-            TEF[vn][tt,:] = binned_statistic(sf, XF, statistic='sum', bins=NS, range=(S_low,S_hi)).statistic
-            
-            if Ldir['testing'] and (tt==10) and (vn=='salt'):
-                print(TEF[vn][tt,:])
-    
-    TEF['qnet'] = qnet
-    TEF['fnet'] = fnet
-    TEF['ssh'] = ssh
-    
-    # Pack results in a Dataset and then save to NetCDF
-    ds = xr.Dataset(coords={'time': ot,'sbins': sbins})
-    for vn in ['qnet','fnet','ssh']:
-        ds[vn] = (('time'), TEF[vn])
-    for vn in vn_list + ['q','salt2']:
-        ds[vn] = (('time','sbins'), TEF[vn])
-    # save it to NetCDF
-    ds.to_netcdf(out_dir / out_fn)
-    if Ldir['testing']:
-        pass
-    else:
+                XF = q.reshape(NTT, NZ*NP)
+            else:
+                XF = (q*V[vn]).reshape(NTT, NZ*NP)
+            XF = np.where(np.isnan(XF), 0, XF) #jx
+            TEF[vn][it0:it1,:,:] = np.bincount(itb, weights=XF[good],
+                minlength=NTT*NSEC*NS).reshape(NTT, NSEC, NS)
+    for ds in ds_list:
         ds.close()
-    
-    print('  elapsed time for section = %d seconds' % (time()-tt0))
-    sys.stdout.flush()
-    
-    
-
-print('\nTotal elapsed time = %d seconds' % (time()-tt00))
-
+    if Ldir['testing'] and (NT > 10):
+        print(TEF['salt'][10,0,:])
+
+    for isec in range(NSEC):
+        # Pack results for this section in a Dataset and then save to NetCDF
+        out_fn = sect_group[isec]
+        print(out_fn)
+        ds = xr.Dataset(coords={'time': ot,'sbins': sbins})
+        for vn in ['qnet','fnet','ssh']:
+            ds[vn] = (('time'), TEF[vn][:,isec])
+        for vn in vn_list + ['q','salt2']:
+            ds[vn] = (('time','sbins'), TEF[vn][:,isec,:])
+        # save it to NetCDF
+        ds.to_netcdf(out_dir / out_fn)
+        ds.close()
+        sys.stdout.flush()
 
+for ig0 in range(0, len(sect_list), NSG):
+    process_group(sect_list[ig0:ig0 + NSG])
 
+print('\nTotal elapsed time = %d seconds' % (time()-tt00))
@@ -1,45 +1,52 @@
 """
 Functions from Marvin Lorenz for making multi-layer TEF calculations, for bulk_calc.
 Modifed lightly by Parker MacCready.
+
+2026.10.18 Recoded the slow parts of find_extrema() and calc_bulk_values() to use
+numpy arrays instead of loops over salinity bins, with the same results. The
+sliding-window search for extrema is done for all days of a section at once in
+get_window_extrema(), and calc_bulk_values_all() does the whole bulk calculation
+for an array of Q(s) packed as (days, bins).
 """
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-def find_extrema(x, comp=5, print_info=False): # new, reduced, better described
+def get_window_extrema(X, comp=5):
     """
     input
-    x = Q(S)
+    X = Q(S), either a vector or an array packed as (days, bins)
     comp = size of the window as an integer number
+    
+    output
+    is_max, is_min = boolean arrays the same shape as X that are True where
+    a value is the max (or min) of the values within comp bins of it,
+    ignoring windows where all the values are the same
     """
+    X = np.asarray(X, dtype=float)
+    # pad the bin axis so that each window is [i-comp:i+comp+1], clipped to
+    # the ends of the record, just like the original loop
+    pad = [(0,0)]*(X.ndim-1) + [(comp,comp)]
+    Wmax = sliding_window_view(np.pad(X, pad, constant_values=-np.inf), 2*comp+1, axis=-1).max(axis=-1)
+    Wmin = sliding_window_view(np.pad(X, pad, constant_values=np.inf), 2*comp+1, axis=-1).min(axis=-1)
+    not_flat = Wmax != Wmin
+    is_max = (X == Wmax) & not_flat
+    # this does not catch an initial increase...
+    is_min = (X == Wmin) & not_flat & ~is_max
+    return is_max, is_min
 
-    indices = []
-    minmax = []
-    
-    i = 0
-    while i < len(x): # np.shape(x)[0]:
-        
-        # set a to be i-1 (except for the first point, where a = 0)
-        # assuming comp = 1
-        if i-comp < 0:
-            a = 0
-        else:
-            a=i-comp
-            
-        # set b to be i + 2 (unless it puts it out of bounds, then b = None)
-        if i+comp >= len(x):
-            b=None
-        else:
-            b=i+comp+1
-            
-        # so [a:b] is the three points centered on i (for comp = 1)
-        if (x[i] == np.max(x[a:b])) and (np.max(x[a:b]) != np.min(x[a:b])):# and (x[i] != x[i-1]):
-            indices.append(i)
-            minmax.append('max')
-        # this does not catch an initial increase...
-        elif (x[i] == np.min(x[a:b])) and (np.max(x[a:b]) != np.min(x[a:b])):# and (x[i] != x[i-1]):
-            indices.append(i)
-            minmax.append('min')
-        i+=1
+def find_extrema(x, comp=5, print_info=False, is_max=None, is_min=None): # new, reduced, better described
+    """
+    input
+    x = Q(S)
+    comp = size of the window as an integer number
+    is_max, is_min = (optional) the output of get_window_extrema(x, comp),
+        passed in when it has already been computed for many days at once
+    """
+    if (is_max is None) or (is_min is None):
+        is_max, is_min = get_window_extrema(x, comp=comp)
+    indices = list(np.nonzero(is_max | is_min)[0])
+    minmax = ['max' if is_max[i] else 'min' for i in indices]
         
     if print_info:
         print('* first step')
@@ -48,26 +55,21 @@ def find_extrema(x, comp=5, print_info=False): # new, reduced, better described
         
     # correct min min min or max max max parts,
     # especially in the beginning and end of the Q(S)
-    ii=1
-    while ii < len(indices):
-        index=[]
-        if minmax[ii] == minmax[ii-1]:
-            if minmax[ii] == 'max': #note the index of the smaller maximum
-                if x[indices[ii]]>=x[indices[ii-1]]:
-                    index.append(ii-1)
-                else:
-                    index.append(ii)
-            elif minmax[ii] == 'min': #note the index of the greater minimum
-                if x[indices[ii]]<=x[indices[ii-1]]:
-                    index.append(ii-1)
-                else:
-                    index.append(ii)
-            minmax = np.asarray(minmax)
-            indices = np.asarray(indices)
-            indices = np.delete(indices, index)
-            minmax = np.delete(minmax, index)
+    # In a run of maxima we keep the largest (the last one in case of a tie)
+    # and in a run of minima we keep the smallest (also the last one).
+    new_indices = []
+    new_minmax = []
+    for i, mm in zip(indices, minmax):
+        if (len(new_minmax) > 0) and (mm == new_minmax[-1]):
+            if mm == 'max' and x[i] >= x[new_indices[-1]]:
+                new_indices[-1] = i
+            elif mm == 'min' and x[i] <= x[new_indices[-1]]:
+                new_indices[-1] = i
         else:
-            ii+=1
+            new_indices.append(i)
+            new_minmax.append(mm)
+    indices = np.array(new_indices, dtype=int)
+    minmax = np.array(new_minmax, dtype='<U3')
     
     if print_info:
         print('* after correct min min min or max max max parts')
@@ -140,15 +142,22 @@ def find_extrema(x, comp=5, print_info=False): # new, reduced, better described
         
         # this section seems to give rise to errors when the code above did not 
         # catch the initial min.
-        ii=1
-        while (np.abs(np.abs(x[ii])-np.abs(x[0])) < 1e-10) and (ii < len(x)-1):
-            ii+=1
+        # ii is the first point after 0 where x changes (or len(x)-1 if it never does)
+        ii_vec = np.arange(1, len(x)-1)
+        moved = ~(np.abs(np.abs(x[ii_vec])-np.abs(x[0])) < 1e-10)
+        if moved.any():
+            ii = ii_vec[np.argmax(moved)]
+        else:
+            ii = len(x)-1
         indices[0]=ii-1
         #correct smax index
         if x[-1]==0: #for low salinity classes Q[-1] might not be zero as supposed.
-            jj=-1
-            while (x[jj] == 0) and (np.abs(jj) < len(x)-1):
-                jj-=1
+            # jj is the last nonzero point, counting back from -1
+            nonzero = x[::-1][:len(x)-2] != 0
+            if nonzero.any():
+                jj = -(np.argmax(nonzero) + 1)
+            else:
+                jj = -(len(x)-1)
             indices[-1]=len(x)+jj+1
             
         # PM edit
@@ -162,53 +171,74 @@ def find_extrema(x, comp=5, print_info=False): # new, reduced, better described
     
     return indices, minmax
     
-def calc_bulk_values(s, thisQ_dict, vn_list, print_info=False, min_trans=1):
+def calc_bulk_values(s, thisQ_dict, vn_list, print_info=False, min_trans=1,
+    is_max=None, is_min=None):
     """
     input
     s=salinity array (sedges)
     Integrated transport arrays vs. S for a given time
     min_trans = minimum transport to consider
+    is_max, is_min = (optional) the output of get_window_extrema() for this time
     """    
     # use the find_extrema algorithm
-    ind, minmax = find_extrema(thisQ_dict['q'], print_info=print_info)
+    ind, minmax = find_extrema(thisQ_dict['q'], print_info=print_info,
+        is_max=is_max, is_min=is_min)
+    ind = np.asarray(ind, dtype=int)
     
     # compute dividing salinities
     smin=s[0]
     DS=s[1]-s[0]
-    div_sal=[]
-    i=0
-    while i < len(ind): 
-        div_sal.append(smin+DS*ind[i])
-        i+=1
+    div_sal = smin + DS*ind
                 
-    #calculate transports etc.
-    in_dict = dict()
-    out_dict = dict()
-    for vn in vn_list:
-            in_dict[vn] = []
-            out_dict[vn] = []
-    index=[]
-    i=0
-    vn_list_short = [item for item in vn_list if item != 'q']
-    while i < len(ind)-1:
-        # compute the transports and sort to in and out
-        Q_i=-(thisQ_dict['q'][ind[i+1]]-thisQ_dict['q'][ind[i]])
-        if Q_i<0 and np.abs(Q_i)>min_trans:
-            out_dict['q'].append(Q_i)
-        elif Q_i > 0 and np.abs(Q_i)>min_trans:
-            in_dict['q'].append(Q_i)
-        else:
-            index.append(i)
-            # this allows clipping of cases with tiny transport
-        for vn in vn_list_short:
-            F_i =-(thisQ_dict[vn][ind[i+1]] - thisQ_dict[vn][ind[i]])
-            vn_i=np.abs(F_i)/np.abs(Q_i)
-            if Q_i<0 and np.abs(Q_i)>1:
-                out_dict[vn].append(vn_i)
-            elif Q_i > 0 and np.abs(Q_i)>1:
-                in_dict[vn].append(vn_i)
-        i+=1
-    # remove clipped div_sal values
-    div_sal = np.delete(div_sal, index)
+    # calculate transports etc. for all the layers at once,
+    # and sort to in and out
+    Q = -(thisQ_dict['q'][ind[1:]] - thisQ_dict['q'][ind[:-1]])
+    keep = np.abs(Q) > min_trans
+    in_mask = keep & (Q > 0)
+    out_mask = keep & (Q < 0)
+    in_dict = {'q': list(Q[in_mask])}
+    out_dict = {'q': list(Q[out_mask])}
+    for vn in [item for item in vn_list if item != 'q']:
+        F = -(thisQ_dict[vn][ind[1:]] - thisQ_dict[vn][ind[:-1]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vn_layer = np.abs(F)/np.abs(Q)
+        in_dict[vn] = list(vn_layer[in_mask])
+        out_dict[vn] = list(vn_layer[out_mask])
+    # remove clipped div_sal values (this allows clipping of cases with tiny transport)
+    div_sal = np.delete(div_sal, np.nonzero(~keep)[0])
         
-    return (in_dict, out_dict, div_sal, ind, minmax)
\ No newline at end of file
+    return (in_dict, out_dict, div_sal, ind, minmax)
+    
+def calc_bulk_values_all(s, Q_dict, vn_list, nlay=30, min_trans=1):
+    """
+    input
+    s=salinity array (sedges)
+    Q_dict = integrated transport arrays vs. S, packed as (days, bins)
+    nlay = max number of layers to save
+    min_trans = minimum transport to consider
+    
+    output
+    MLO = dict of multi-layer output, packed as (days, nlay), with
+    the layers sorted by salinity and nan-padded
+    """
+    NT = Q_dict['q'].shape[0]
+    # find the window extrema for all days at once
+    is_max, is_min = get_window_extrema(Q_dict['q'])
+    MLO = dict()
+    for vn in vn_list:
+        MLO[vn] = np.nan * np.ones((NT, nlay))
+    for dd in range(NT):
+        thisQ_dict = dict()
+        for vn in vn_list:
+            thisQ_dict[vn] = Q_dict[vn][dd,:]
+        in_dict, out_dict, div_sal, ind, minmax = calc_bulk_values(s, thisQ_dict, vn_list,
+            min_trans=min_trans, is_max=is_max[dd,:], is_min=is_min[dd,:])
+        bulk_dict = dict()
+        for vn in vn_list:
+            bulk_dict[vn] = np.array(in_dict[vn] + out_dict[vn])
+        ii = np.argsort(bulk_dict['salt'])
+        NL = len(ii)
+        if NL > 0:
+            for vn in vn_list:
+                MLO[vn][dd, :NL] = bulk_dict[vn][ii]
+    return MLO
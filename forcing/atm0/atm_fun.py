@@ -2,10 +2,16 @@
 Functions to use with atmospheric forcing.  Translated from matlab to python.
 """
 
+import sys
 import numpy as np
 import netCDF4 as nc
 import seawater as sw
 import matplotlib.path as mpath
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from lo_tools import Lfun
+from lo_tools import cache_functions as cachefun
 
 invar_list = ['Q2', 'T2', 'PSFC', 'U10', 'V10','RAINCV', 'RAINNCV', 'SWDOWN', 'GLW']
 
@@ -105,6 +111,112 @@ def get_indices_in_polygon(plon_poly, plat_poly, lon, lat):
     M = M.reshape(lon.shape)
     return M
     
+def get_mask(lonw, latw, lon, lat):
+    # Get the mask of points on the ROMS grid (lon, lat) that are inside a WRF grid.
+    # We appear to be avoiding a strip on the N.  Why?
+    plon_poly = np.concatenate((lonw[0,4:],lonw[:-5,-1],lonw[-5,4::-1],lonw[:-5:-1,4]))
+    plat_poly = np.concatenate((latw[0,4:],latw[:-5,-1],latw[-5,4::-1],latw[:-5:-1,4]))
+    M = get_indices_in_polygon(plon_poly, plat_poly, lon, lat)
+    return M
+
+# Regridding info that has been used in this run, so we only go to
+# the disk cache once for each WRF grid.
+cache_dict = dict()
+
+def get_cache_dir(Ldir):
+    """
+    The place where we save the regridding info for each WRF grid so it
+    can be reused on other days. It is safe to delete at any time.
+    """
+    cache_dir = Ldir['LOo'] / 'forcing' / Ldir['gtag'] / 'wrf_cache'
+    Lfun.make_dir(cache_dir)
+    return cache_dir
+
+def get_linear_weights(lonw, latw, lon, lat, IM):
+    """
+    Make a sparse matrix W so that W @ v linearly interpolates a field v on the
+    WRF grid lonw, latw to the ROMS points lon, lat. Each WRF grid cell is split
+    into two triangles and we use the barycentric weights of the triangle that
+    holds the ROMS point, searching only the four cells around the nearest WRF
+    point IM (from cKDTree). ROMS points outside the WRF grid get the value of
+    the nearest WRF point, as in the nearest neighbor method.
+    """
+    NRw, NCw = lonw.shape
+    NP = lon.size
+    x = lon.flatten()
+    y = lat.flatten()
+    jn, jin = np.unravel_index(IM, (NRw, NCw))
+    # the corners of the two triangles in a cell, as (j, i) offsets from its SW corner
+    tri_list = [((0,0), (0,1), (1,1)), ((0,0), (1,1), (1,0))]
+    rows = np.arange(NP)
+    found = np.zeros(NP, dtype=bool)
+    cols = np.zeros((NP, 3), dtype=int)
+    w = np.zeros((NP, 3))
+    for dj in [-1, 0]:
+        for di in [-1, 0]:
+            j0 = np.clip(jn + dj, 0, NRw - 2)
+            i0 = np.clip(jin + di, 0, NCw - 2)
+            for tri in tri_list:
+                todo = ~found
+                if todo.sum() == 0:
+                    break
+                jj = [j0[todo] + c[0] for c in tri]
+                ii = [i0[todo] + c[1] for c in tri]
+                xa, xb, xc = [lonw[jj[n], ii[n]] for n in range(3)]
+                ya, yb, yc = [latw[jj[n], ii[n]] for n in range(3)]
+                det = (yb - yc)*(xa - xc) + (xc - xb)*(ya - yc)
+                wa = ((yb - yc)*(x[todo] - xc) + (xc - xb)*(y[todo] - yc)) / det
+                wb = ((yc - ya)*(x[todo] - xc) + (xa - xc)*(y[todo] - yc)) / det
+                wc = 1 - wa - wb
+                eps = -1e-10
+                inside = (wa >= eps) & (wb >= eps) & (wc >= eps)
+                ind = rows[todo][inside]
+                for n in range(3):
+                    cols[ind, n] = jj[n][inside]*NCw + ii[n][inside]
+                w[ind, 0] = wa[inside]
+                w[ind, 1] = wb[inside]
+                w[ind, 2] = wc[inside]
+                found[ind] = True
+    # use the nearest point for everything else
+    cols[~found, 0] = IM[~found]
+    w[~found, :] = [1, 0, 0]
+    W = sparse.csr_matrix((w.flatten(), (np.repeat(rows, 3), cols.flatten())),
+        shape=(NP, NRw*NCw))
+    W.eliminate_zeros()
+    return W
+
+def get_regrid(lonw, latw, lon, lat, method='nearest', cache_dir=None):
+    """
+    Get everything needed to move fields from a (trimmed) WRF grid lonw, latw
+    to the ROMS grid lon, lat, packed in a dict R:
+    - 'ca', 'sa' the rotation arrays from get_angle()
+    - 'M' the mask of ROMS points inside the WRF grid, from get_mask()
+    - 'IM' the nearest neighbor indices (method='nearest'), or
+    - 'W' a sparse matrix of linear interpolation weights (method='linear')
+    The WRF and ROMS grids rarely change, so R is saved in cache_dir using
+    a hash of the grids, and reused on later days.
+    """
+    if method not in ['nearest', 'linear']:
+        print('ERROR: unsupported regridding method ' + method)
+        sys.exit()
+    key = 'wrf_' + method + '_' + cachefun.get_hash([lonw, latw, lon, lat])
+    R = cachefun.load_cache(key, cache_dir, cache_dict)
+    if R is not None:
+        return R
+    R = dict()
+    R['method'] = method
+    R['ca'], R['sa'] = get_angle(lonw, latw)
+    R['M'] = get_mask(lonw, latw, lon, lat)
+    XY = np.array((lon.flatten(), lat.flatten())).T # shape is (NR*NC, 2)
+    XYw = np.array((lonw.flatten(), latw.flatten())).T
+    IM = cKDTree(XYw).query(XY)[1]
+    if method == 'nearest':
+        R['IM'] = IM
+    elif method == 'linear':
+        R['W'] = get_linear_weights(lonw, latw, lon, lat, IM)
+    cachefun.save_cache(key, R, cache_dir, cache_dict)
+    return R
+
 def gather_and_process_fields(fn, imax, ca, sa, outvar_list):
     # This is where we define any transformations to get from WRF to ROMS variables.
     # we pass outvar_list only because it may have been shortened by the calling program
@@ -147,11 +259,15 @@ def gather_and_process_fields(fn, imax, ca, sa, outvar_list):
             ov_dict[ovn] = ca*iv_dict['V10'] - sa*iv_dict['U10']
     return ov_dict
     
-def interp_to_roms(ov_dict, outvar_list, IMn, NR, NC):
+def interp_to_roms(ov_dict, outvar_list, R, NR, NC):
+    # R is the regridding dict from get_regrid()
     ovi_dict = dict()
     for ovn in outvar_list:
         v = ov_dict[ovn].flatten()
-        ovi_dict[ovn] = v[IMn].reshape((NR,NC))
+        if R['method'] == 'nearest':
+            ovi_dict[ovn] = v[R['IM']].reshape((NR,NC))
+        elif R['method'] == 'linear':
+            ovi_dict[ovn] = (R['W'] @ np.ma.filled(v, np.nan)).reshape((NR,NC))
     return ovi_dict
 
 def Z_wmo_RH(P,T,Q):
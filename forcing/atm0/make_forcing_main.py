@@ -29,11 +29,10 @@ result_dict['start_dt'] = datetime.now()
 import os
 import time
 import shutil
+import multiprocessing as mp
 import netCDF4 as nc
 import numpy as np
 import seawater as sw
-from scipy.interpolate import griddata
-from scipy.spatial import cKDTree
 
 from lo_tools import Lfun, zfun, zrfun
 
@@ -44,6 +43,12 @@ reload(afun)
 # Set where are files located, and other situational choices.
 do_d3 = True
 do_d4 = True
+# How to interpolate from the WRF grids to the ROMS grid:
+# 'nearest' (the default) or 'linear' (linear on the triangles of the WRF grid cells)
+interp_method = 'nearest'
+# Number of worker processes for the hours (each hour is independent).
+# Nproc = 1 does everything in this process, which is useful for debugging.
+Nproc = 10
 wrf_dir = Ldir['data'] / 'wrf' # the default
 if Ldir['lo_env'] == 'pm_mac':
     Ldir['run_type'] == 'backfill'
@@ -139,7 +144,8 @@ if planB == False:
     else:
         outvar_list = afun.outvar_list
     
-    # Initialize NetCDF output files, one for each variable
+    # Names of the NetCDF output files, one for each variable. They are
+    # written all at once after the hours are processed.
     NR, NC = lon.shape
     NT = len(mod_time_list)
     nc_out_dict = {}
@@ -149,21 +155,6 @@ if planB == False:
         # print(out_fn)
         nc_out_dict[vn] = out_fn
         out_fn.unlink(missing_ok=True) # get rid of any old version
-        foo = nc.Dataset(out_fn, 'w')
-        # create dimensions
-        timename = afun.timename_dict[vn]
-        foo.createDimension(timename, NT) # could use None
-        foo.createDimension('eta_rho', NR)
-        foo.createDimension('xi_rho', NC)
-        # add time data
-        vv = foo.createVariable(timename, float, (timename,))
-        vv.units = Lfun.roms_time_units
-        vv[:] = mod_time_vec
-        # add variable definition
-        vv = foo.createVariable(vn, float, (timename, 'eta_rho', 'xi_rho'))
-        vv.long_name = afun.longname_dict[vn]
-        vv.units = afun.units_dict[vn]
-        foo.close()
 
     # Find index to trim Eastern part of wrf fields
     lon_max = lon[0,-1] # easternmost edge of ROMS grid
@@ -179,55 +170,41 @@ if planB == False:
         lon4 = lon4[:,:imax4]
         lat4 = lat4[:, :imax4]
 
-    # Prepare coordinate arrays for interpolation
-    XY = np.array((lon.flatten(), lat.flatten())).T # shape is (NR*NC, 2)
-    XY2 = np.array((lon2.flatten(), lat2.flatten())).T
-    if do_d3:
-        XY3 = np.array((lon3.flatten(), lat3.flatten())).T
-    if do_d4:
-        XY4 = np.array((lon4.flatten(), lat4.flatten())).T
-
-    # get nearest neighbor trees to use with wrf grids to interpolate
-    # values from the wrf grids onto the ROMS grid
-    IM2 = cKDTree(XY2).query(XY); IM2 = IM2[1]
-    if do_d3:
-        IM3 = cKDTree(XY3).query(XY); IM3 = IM3[1]
-    if do_d4:
-        IM4 = cKDTree(XY4).query(XY); IM4 = IM4[1]
-    
-    # Find coordinate rotation matrices to translate wrf velocity from
-    # wrf grid directions to ROMS standard E+, N+
-    ca2, sa2 = afun.get_angle(lon2, lat2)
-    if do_d3:
-        ca3, sa3 = afun.get_angle(lon3, lat3)
-    if do_d4:
-        ca4, sa4 = afun.get_angle(lon4, lat4)
-
-    # Get the d3 and d4 masks. We appear to be avoiding a strip on the N.  Why?
-    # We use these to overwrite just the parts where we have higher resolution wrf data.
+    # Get the regridding info for each WRF grid: the nearest neighbor indices
+    # (or linear interpolation weights) to get values from the wrf grids onto the
+    # ROMS grid, the coordinate rotation matrices to translate wrf velocity from
+    # wrf grid directions to ROMS standard E+, N+, and the masks of the ROMS grid
+    # where we have higher resolution wrf data from d3 and d4. These are saved in
+    # cache_dir and reused on later days, as long as the grids do not change.
+    cache_dir = afun.get_cache_dir(Ldir)
+    R2 = afun.get_regrid(lon2, lat2, lon, lat, method=interp_method, cache_dir=cache_dir)
     if do_d3:
-        plon3_poly = np.concatenate((lon3[0,4:],lon3[:-5,-1],lon3[-5,4::-1],lon3[:-5:-1,4]))
-        plat3_poly = np.concatenate((lat3[0,4:],lat3[:-5,-1],lat3[-5,4::-1],lat3[:-5:-1,4]))
-        M3 = afun.get_indices_in_polygon(plon3_poly, plat3_poly, lon, lat)
+        R3 = afun.get_regrid(lon3, lat3, lon, lat, method=interp_method, cache_dir=cache_dir)
     if do_d4:
-        plon4_poly = np.concatenate((lon4[0,4:],lon4[:-5,-1],lon4[-5,4::-1],lon4[:-5:-1,4]))
-        plat4_poly = np.concatenate((lat4[0,4:],lat4[:-5,-1],lat4[-5,4::-1],lat4[:-5:-1,4]))
-        M4 = afun.get_indices_in_polygon(plon4_poly, plat4_poly, lon, lat)
+        R4 = afun.get_regrid(lon4, lat4, lon, lat, method=interp_method, cache_dir=cache_dir)
     
-    # MAIN TASK: loop over all hours
+    # MAIN TASK: process all hours
 
     if Ldir['testing']:
         # 20 = about noon local time
         d2_list = d2_list[20:22]
         d3_list = d3_list[20:22]
         d4_list = d4_list[20:22]
-    dall_list = zip(d2_list, d3_list, d4_list)
+    dall_list = list(zip(d2_list, d3_list, d4_list))
     # Check out help(zip) to see how this works.  It creates an interable
     # that returns tuples made sequentially from entries of the things you zipped.
     # Note that this always works because we made our lists synthetically without regard
     # for if the files existed.
-    for fn2, fn3, fn4 in dall_list:
-        print('Working on ' + str(fn2).split('/')[-1] + ' and etc.')
+
+    def do_one_hour(fn_tup):
+        """
+        Process the WRF files for one hour and combine them on the ROMS grid.
+        This runs in the worker processes, so instead of printing it returns
+        a list of messages, along with the dict of combined fields (None if the
+        d2 file could not be processed, which sends us to Plan B).
+        """
+        fn2, fn3, fn4 = fn_tup
+        msg_list = ['Working on ' + str(fn2).split('/')[-1] + ' and etc.']
     
         # flags to allow processing more files
         do_this_d3 = True
@@ -235,39 +212,38 @@ if planB == False:
     
         # if we are missing a d3 or d4 file then we don't work on it
         if not fn3.is_file():
-            print(' - missing ' + str(fn3))
+            msg_list.append(' - missing ' + str(fn3))
             do_this_d3 = False
         if not fn4.is_file():
-            print(' - missing ' + str(fn4))
+            msg_list.append(' - missing ' + str(fn4))
             do_this_d4 = False
     
         try:
             # On 2022.06.07 one of the d2 files showed up with a time index of length 0
             # (it should have been 1).  This is designed to respond to that specific error.
             # I could wrap the whole job in a try-except but I like to keep it more specific.
-            ov2_dict = afun.gather_and_process_fields(fn2, imax2, ca2, sa2, outvar_list)
+            ov2_dict = afun.gather_and_process_fields(fn2, imax2, R2['ca'], R2['sa'], outvar_list)
         except Exception as e:
-            print('Error in gather and process d2 fields - going to Plan B')
-            print(e)
-            planB = True
-            break
+            msg_list.append('Error in gather and process d2 fields - going to Plan B')
+            msg_list.append(str(e))
+            return fn2, None, msg_list
             
-        ovi2_dict = afun.interp_to_roms(ov2_dict, outvar_list, IM2, NR, NC)
+        ovi2_dict = afun.interp_to_roms(ov2_dict, outvar_list, R2, NR, NC)
     
         if do_this_d3:
             try:
-                ov3_dict = afun.gather_and_process_fields(fn3, imax3, ca3, sa3, outvar_list)
-                ovi3_dict = afun.interp_to_roms(ov3_dict, outvar_list, IM3, NR, NC)
+                ov3_dict = afun.gather_and_process_fields(fn3, imax3, R3['ca'], R3['sa'], outvar_list)
+                ovi3_dict = afun.interp_to_roms(ov3_dict, outvar_list, R3, NR, NC)
             except:
-                print(' - could not process ' + str(fn3))
+                msg_list.append(' - could not process ' + str(fn3))
                 do_this_d3 = False
     
         if do_this_d4:
             try:
-                ov4_dict = afun.gather_and_process_fields(fn4, imax4, ca4, sa4, outvar_list)
-                ovi4_dict = afun.interp_to_roms(ov4_dict, outvar_list, IM4, NR, NC)
+                ov4_dict = afun.gather_and_process_fields(fn4, imax4, R4['ca'], R4['sa'], outvar_list)
+                ovi4_dict = afun.interp_to_roms(ov4_dict, outvar_list, R4, NR, NC)
             except:
-                print(' - could not process ' + str(fn4))
+                msg_list.append(' - could not process ' + str(fn4))
                 do_this_d4 = False
     
         # combine the grids
@@ -277,21 +253,68 @@ if planB == False:
             v = v2.copy()
             if do_this_d3:
                 v3 = ovi3_dict[ovn]
-                v[M3] = v3[M3]
+                v[R3['M']] = v3[R3['M']]
             if do_this_d4:
                 v4 = ovi4_dict[ovn]
-                v[M4] = v4[M4]
+                v[R4['M']] = v4[R4['M']]
             if np.sum(np.isnan(v)) > 0:
-                print('** WARNING Nans in combined output ' + ovn)
+                msg_list.append('** WARNING Nans in combined output ' + ovn)
             ovc_dict[ovn] = v
-    
-        # save to NetCDF
-        tt = d2i_dict[fn2]
-        for vn in outvar_list:
-            fn = nc_out_dict[vn]
-            foo = nc.Dataset(fn, 'a')
-            foo[vn][tt,:,:] = ovc_dict[vn]
-            foo.close()
+        return fn2, ovc_dict, msg_list
+
+    # Each worker inherits everything above (the forked processes share the
+    # grids and regridding info) and does whole hours. The results come back
+    # in order, and are packed into arrays for all the hours we work on, which
+    # are always a continuous block of time indices starting at tt0. Note that
+    # these take about 500 MB per variable for a 73 hour forecast on cas6.
+    tt0 = d2i_dict[d2_list[0]]
+    NTW = len(dall_list)
+    ovc_all = dict()
+    for vn in outvar_list:
+        ovc_all[vn] = np.nan * np.ones((NTW, NR, NC))
+    if (Nproc > 1) and (NTW > 1):
+        pool = mp.get_context('fork').Pool(min(Nproc, NTW))
+        result_iter = pool.imap(do_one_hour, dall_list)
+    else:
+        pool = None
+        result_iter = map(do_one_hour, dall_list)
+    for fn2, ovc_dict, msg_list in result_iter:
+        for msg in msg_list:
+            print(msg)
+        sys.stdout.flush()
+        if ovc_dict == None:
+            # we keep going (instead of breaking out of the loop) so the pool can
+            # finish cleanly, but nothing more is saved
+            planB = True
+        if planB == False:
+            tt = d2i_dict[fn2]
+            for vn in outvar_list:
+                ovc_all[vn][tt - tt0,:,:] = ovc_dict[vn]
+    if pool != None:
+        pool.close()
+        pool.join()
+
+if planB == False:
+    # save to NetCDF, writing each variable once, compressed and chunked by time
+    for vn in outvar_list:
+        out_fn = nc_out_dict[vn]
+        foo = nc.Dataset(out_fn, 'w')
+        # create dimensions
+        timename = afun.timename_dict[vn]
+        foo.createDimension(timename, NT) # could use None
+        foo.createDimension('eta_rho', NR)
+        foo.createDimension('xi_rho', NC)
+        # add time data
+        vv = foo.createVariable(timename, float, (timename,))
+        vv.units = Lfun.roms_time_units
+        vv[:] = mod_time_vec
+        # add variable definition
+        vv = foo.createVariable(vn, float, (timename, 'eta_rho', 'xi_rho'),
+            zlib=True, complevel=1, chunksizes=(1, NR, NC))
+        vv.long_name = afun.longname_dict[vn]
+        vv.units = afun.units_dict[vn]
+        vv[tt0:tt0+NTW,:,:] = ovc_all[vn]
+        foo.close()
 
 if planB == True:
     # We make this an in instead of elif because planB might have been set to True
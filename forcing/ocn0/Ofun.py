@@ -16,6 +16,7 @@ import requests
 import Ofun_CTD
 from lo_tools import Lfun, zfun, zrfun
 from lo_tools import hycom_functions as hfun
+from lo_tools import cache_functions as cachefun
 
 verbose = False
 
@@ -185,11 +186,11 @@ def get_data_oneday(this_dt, out_fn, testing_fmrc):
         sys.stdout.flush()
     return got_fmrc
 
-def get_hnc_short_list(this_dt, Ldir):
+def get_hnc_unique_list(this_dt, Ldir):
     """
-    This makes a list of strings giving the full paths to the LO_data/hycom
-    extractions to use for this backfill day.  It accounts for possible gaps
-    in time.
+    This makes a list of strings giving the full paths to all the daily
+    LO_data/hycom extractions that could be used for this day (the list
+    changes at the switch from hy5 to hy6), with repeated days removed.
     """
     # initial experiment list
     hy_list = list(hfun.hy_dict.keys())
@@ -218,6 +219,19 @@ def get_hnc_short_list(this_dt, Ldir):
         if dd not in seen:
             seen.append(dd)
             hnc_unique_list.append(str(hnc))
+    return hnc_unique_list
+
+def get_hnc_short_list(this_dt, Ldir, hnc_unique_list=None):
+    """
+    This makes a list of strings giving the full paths to the LO_data/hycom
+    extractions to use for this backfill day.  It accounts for possible gaps
+    in time.
+
+    hnc_unique_list (optional) is the output of get_hnc_unique_list(), passed
+    in when doing many days so that we only list the archive once.
+    """
+    if hnc_unique_list == None:
+        hnc_unique_list = get_hnc_unique_list(this_dt, Ldir)
     # then find the index of the start of the current day
     # but if it is missing search for the most recent past one that exists
     keep_looking = True
@@ -343,23 +357,11 @@ def time_filter(in_dir, h_list, out_dir, Ldir):
     are aliased in the daily sampling.
     """
     print('-Filtering in time')
-    vl = ['ssh', 'u3d', 'v3d', 't3d', 's3d']
     dts0 = Ldir['date_string']
     dt0 = datetime.strptime(dts0, '%Y.%m.%d')
     nh = len(h_list)    
     # test for gaps in h_list
-    no_gaps = True
-    dtsg = h_list[0].strip('h').strip('.p')
-    dtg0 = datetime.strptime(dtsg, '%Y.%m.%d')
-    for hh in h_list[1:]:
-        dtsg = hh.strip('h').strip('.p')
-        dtg1 = datetime.strptime(dtsg, '%Y.%m.%d')
-        if (dtg1-dtg0).days != 1:
-            no_gaps = False
-            print('** HAS GAPS **')
-            break
-        else:
-            dtg0 = dtg1    
+    no_gaps = check_gaps(h_list)
     fac_list_H = [12, 4, 3, 4, 12]
     # inverse weighting factors for a Hanning window of length 5
     nfilt = len(fac_list_H)
@@ -372,16 +374,8 @@ def time_filter(in_dir, h_list, out_dir, Ldir):
         fac_list = fac_list_H
         for nt in range(nh - 4):
             n_center = nt + 2
-            aa = dict()
-            for n in range(nfilt):
-                nn = n + nt
-                fn = in_dir / h_list[nn]
-                a = pickle.load(open(fn, 'rb'))
-                for v in vl:
-                    if n == 0:
-                        aa[v] = a[v]/fac_list[n]
-                    else:
-                        aa[v] = aa[v] + a[v]/fac_list[n]
+            a_list = [pickle.load(open(in_dir / h_list[n + nt], 'rb')) for n in range(nfilt)]
+            aa = filter_dicts(a_list, fac_list)
             out_name = 'f' + h_list[n_center]
             dts = out_name.strip('fh').strip('.p')
             dt = datetime.strptime(dts, '%Y.%m.%d')
@@ -392,15 +386,8 @@ def time_filter(in_dir, h_list, out_dir, Ldir):
         print('--Using block average')
         # make a simple average and use it for everything
         fac_list = list(nh * np.ones(nh))
-        aa = dict()
-        for n in range(nh):
-            fn = in_dir / h_list[n]
-            a = pickle.load(open(fn, 'rb'))
-            for v in vl:
-                if n == 0:
-                    aa[v] = a[v]/fac_list[n]
-                else:
-                    aa[v] = aa[v] + a[v]/fac_list[n]        
+        a_list = [pickle.load(open(in_dir / h_list[n], 'rb')) for n in range(nh)]
+        aa = filter_dicts(a_list, fac_list)
         if rtp == 'backfill':
             nd = 1
         else:
@@ -418,11 +405,52 @@ def time_filter(in_dir, h_list, out_dir, Ldir):
         # print('   ' + out_name1)
         pickle.dump(aa, open(out_dir / out_name1, 'wb'))
 
+def check_gaps(h_list):
+    """
+    Returns True if the sorted list of names like h2019.07.04.p
+    has no gaps in time.
+    """
+    no_gaps = True
+    dtsg = h_list[0].strip('h').strip('.p')
+    dtg0 = datetime.strptime(dtsg, '%Y.%m.%d')
+    for hh in h_list[1:]:
+        dtsg = hh.strip('h').strip('.p')
+        dtg1 = datetime.strptime(dtsg, '%Y.%m.%d')
+        if (dtg1-dtg0).days != 1:
+            no_gaps = False
+            print('** HAS GAPS **')
+            break
+        else:
+            dtg0 = dtg1
+    return no_gaps
+
+def filter_dicts(a_list, fac_list):
+    """
+    Make the weighted sum of the fields in a list of dicts of hycom fields,
+    where field n is divided by fac_list[n]. Used by time_filter().
+    """
+    vl = ['ssh', 'u3d', 'v3d', 't3d', 's3d']
+    aa = dict()
+    for n in range(len(a_list)):
+        a = a_list[n]
+        for v in vl:
+            if n == 0:
+                aa[v] = a[v]/fac_list[n]
+            else:
+                aa[v] = aa[v] + a[v]/fac_list[n]
+    return aa
+
 def get_coords(in_dir):
     """
     get coordinate fields and sizes
     """
     coord_dict = pickle.load(open(in_dir / 'coord_dict.p', 'rb'))
+    return make_coords(coord_dict)
+
+def make_coords(coord_dict):
+    """
+    get coordinate fields and sizes from a dict with lon, lat, and z
+    """
     lon = coord_dict['lon']
     lat = coord_dict['lat']
     z = coord_dict['z']
@@ -442,7 +470,38 @@ def checknan(fld):
     if np.isnan(fld).sum() > 0:
         print('WARNING: nans in data field')    
 
-def extrap_nearest_to_masked(X, Y, fld, fld0=0):
+# Nearest neighbor index maps and vertical interpolation operators that have
+# been used in this run, so we only go to the disk cache once for each one.
+cache_dict = dict()
+
+def get_cache_dir(Ldir):
+    """
+    The place where we save nearest neighbor index maps (and vertical
+    interpolation operators) so they can be reused on other days. The HYCOM
+    grid and masks, and the ROMS grid, almost never change, so each day's
+    forcing can use the maps saved on earlier days.
+    """
+    cache_dir = Ldir['LOo'] / 'forcing' / Ldir['gtag'] / 'hycom_cache'
+    Lfun.make_dir(cache_dir)
+    return cache_dir
+
+def get_nn_inds(xyorig, xynew, name, arr_list, cache_dir=None):
+    """
+    Returns the indices of the points in xyorig that are nearest to each
+    point in xynew, using cKDTree. The result is kept in memory and, if
+    cache_dir is given, saved to disk, using a key made from name and a hash
+    of arr_list (the arrays that determine xyorig and xynew), so the next
+    call with the same grid and mask does no tree search at all.
+    """
+    key = name + '_' + cachefun.get_hash(arr_list)
+    inds = cachefun.load_cache(key, cache_dir, cache_dict)
+    if (inds is not None) and (len(inds) == len(xynew)):
+        return inds
+    inds = cKDTree(xyorig).query(xynew)[1]
+    cachefun.save_cache(key, inds, cache_dir, cache_dict)
+    return inds
+
+def extrap_nearest_to_masked(X, Y, fld, fld0=0, cache_dir=None):
     """
     INPUT: fld is a 2D array (np.ndarray or np.ma.MaskedArray) on spatial grid X, Y
     OUTPUT: a numpy array of the same size with no mask
@@ -454,6 +513,8 @@ def extrap_nearest_to_masked(X, Y, fld, fld0=0):
         * If it is all unmasked then return the data.    
     If input is not a masked array:        
         * Return the array.    
+    The nearest neighbor indices depend only on X, Y, and the mask, so they
+    are reused from memory or from cache_dir when possible.
     """
     # first make sure nans are masked
     if np.ma.is_masked(fld) == False:
@@ -468,22 +529,30 @@ def extrap_nearest_to_masked(X, Y, fld, fld0=0):
     else:
         # do the extrapolation using nearest neighbor
         fldf = fld.copy() # initialize the "filled" field
-        xyorig = np.array((X[~fld.mask],Y[~fld.mask])).T
-        xynew = np.array((X[fld.mask],Y[fld.mask])).T
-        a = cKDTree(xyorig).query(xynew)
-        aa = a[1]
-        fldf[fld.mask] = fld[~fld.mask][aa]
+        mask = np.ma.getmaskarray(fld)
+        xyorig = np.array((X[~mask],Y[~mask])).T
+        xynew = np.array((X[mask],Y[mask])).T
+        aa = get_nn_inds(xyorig, xynew, 'extrap', [X, Y, mask], cache_dir=cache_dir)
+        fldf[mask] = fld[~mask][aa]
         fldd = fldf.data
         checknan(fldd)
         return fldd
 
-def get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=False):
+def get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=False, cache_dir=None):
     """
     Make use of extrap_nearest_to_masked() to fill fields completely
     before interpolating to the ROMS grid.  It also adds CTD data if asked to,
     creates ubar and vbar, and converts the temperature to potential temperature.
     """
     b = pickle.load(open(in_fn, 'rb'))
+    return extrapolate_dict(b, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=add_CTD,
+        cache_dir=cache_dir)
+
+def extrapolate_dict(b, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=False, cache_dir=None):
+    """
+    The work of get_extrapolated(), for a dict b of filtered hycom fields
+    that is already in memory. Note that b is modified (ubar and vbar are added).
+    """
     vn_list = list(b.keys())    
     # check that things are the expected shape
     def check_coords(shape_tuple, arr_shape):
@@ -505,7 +574,7 @@ def get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=False):
     # extrapolate ssh
     vn = 'ssh'
     v = b[vn]
-    vv = extrap_nearest_to_masked(X, Y, v)
+    vv = extrap_nearest_to_masked(X, Y, v, cache_dir=cache_dir)
     V[vn] = vv
     vn_list.remove('ssh')    
     # extrapolate 3D fields
@@ -520,7 +589,7 @@ def get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=False):
             if add_CTD==False:
                 for k in range(N):
                     fld = v[k, :, :]
-                    fldf = extrap_nearest_to_masked(X, Y, fld, fld0=v0)
+                    fldf = extrap_nearest_to_masked(X, Y, fld, fld0=v0, cache_dir=cache_dir)
                     V[vn][k, :, :] = fldf
             elif add_CTD==True:
                 print(vn + ' Adding CTD data before extrapolating')
@@ -606,31 +675,67 @@ def get_zr(G, S, vn):
         print('Unknown variable name for get_zr: ' + vn)
     return zr
 
-def get_zinds(h, S, z):
+def get_zop(h, S, z, linear=False, cache_dir=None):
     """
-    Precalculate the array of indices to go from HYCOM z to ROMS z.
-    This just finds the vertical index in HYCOM z for each ROMS z_rho
-    value in the whole 3D array, with the index being the UPPER one of
-    the two HYCOM z indices that any ROMS z falls between.
+    Precalculate the vertical interpolation operator to go from HYCOM z to
+    ROMS z, for use with apply_zop(). It only depends on the ROMS grid, the
+    S-coordinates, and HYCOM z, so it is reused from memory or from cache_dir
+    when possible.
+
+    If linear is False each ROMS z_rho gets the value at the UPPER of the two
+    HYCOM z levels it falls between (as the original code did), and if it is
+    True we do linear interpolation between those two levels.
+
+    Returns a dict Z with:
+    'i1' = (N, M, L) array of the UPPER HYCOM z index for each ROMS z_rho
+    'fr' = (N, M, L) array of the fractional distance from the level below
+        to the level above (only if linear is True)
     """
-    tt0 = time.time()
-    zr = zrfun.get_z(h, 0*h, S, only_rho=True)
-    zrf = zr.flatten()
-    zinds = np.nan * np.ones_like(zrf)
     if isinstance(z, np.ma.MaskedArray):
         z = z.data
-    for ii in range(len(z)-1):
-        zlo = z[ii]; zhi = z[ii+1]
-        mask = (zrf>zlo) & (zrf<=zhi)
-        zinds[mask] = ii+1 # this is where the UPPER index is enforced
-    zinds = zinds.astype(int)
-    if isinstance(zinds, np.ma.MaskedArray):
-        zinds = zinds.data
+    key = 'zop_' + cachefun.get_hash([h, z, S['s_rho'], S['Cs_r'],
+        np.array([S['hc'], S['Vtransform'], linear])])
+    Z = cachefun.load_cache(key, cache_dir, cache_dict)
+    if Z is not None:
+        return Z
+    tt0 = time.time()
+    zr = zrfun.get_z(h, 0*h, S, only_rho=True)
+    Z = {'linear':linear}
+    i1 = np.searchsorted(z, zr, side='left')
+    if linear:
+        # points below the bottom or above the top HYCOM z are
+        # given the value at the nearest end level
+        i1 = np.clip(i1, 1, len(z)-1)
+        z0 = z[i1-1]
+        z1 = z[i1]
+        Z['fr'] = np.clip((zr - z0)/(z1 - z0), 0, 1)
+    else:
+        i1 = np.clip(i1, 0, len(z)-1)
+    # HYCOM has fewer than 32767 levels
+    Z['i1'] = i1.astype(np.int16)
     if verbose:
-        print(' --create zinds array took %0.1f seconds' % (time.time() - tt0))
-    return zinds
+        print(' --create zop took %0.1f seconds' % (time.time() - tt0))
+    cachefun.save_cache(key, Z, cache_dir, cache_dict)
+    return Z
+
+def apply_zop(Z, vi):
+    """
+    Do the vertical interpolation from HYCOM z to ROMS z using the
+    operator Z from get_zop().
+    
+    vi is packed (..., N_hycom, M, L), where the leading dimensions can be
+    anything, e.g. several variables and several days, and they are all done
+    in a single gather. The result is packed (..., N_roms, M, L).
+    """
+    i1 = np.broadcast_to(Z['i1'], vi.shape[:-3] + Z['i1'].shape)
+    vv1 = np.take_along_axis(vi, i1, axis=-3)
+    if Z['linear']:
+        vv0 = np.take_along_axis(vi, i1 - 1, axis=-3)
+        return vv0*(1 - Z['fr']) + vv1*Z['fr']
+    else:
+        return vv1
 
-def get_interpolated(G, S, b, lon, lat, z, N, zinds):
+def get_interpolated(G, S, b, lon, lat, z, N, Z, cache_dir=None):
     """
     This does the horizontal and vertical interpolation to get from
     extrapolated, filtered HYCOM fields to ROMS fields.
@@ -638,10 +743,21 @@ def get_interpolated(G, S, b, lon, lat, z, N, zinds):
     We use fast nearest neighbor interpolation as much as possible.
     Also we interpolate everything to the ROMS rho grid, and then crudely
     interpolate to the u and v grids at the last moment.  Much simpler.
+
+    The HYCOM to ROMS nearest neighbor indices are reused from memory or
+    from cache_dir when possible.
+
+    Z is the vertical interpolation operator from get_zop().
+    """
+    return get_interpolated_list(G, S, [b], lon, lat, z, N, Z, cache_dir=cache_dir)[0]
+
+def get_interpolated_list(G, S, b_list, lon, lat, z, N, Z, cache_dir=None):
+    """
+    The work of get_interpolated(), for a list of dicts b (e.g. several
+    filtered days). The vertical interpolation of all the 3D fields of all
+    the days is done in a single call to apply_zop(). Returns a list of
+    dicts c, in the same order as b_list.
     """
-    
-    # start input dict
-    c = {}
     
     # precalculate useful arrays that are used for horizontal interpolation
     if isinstance(lon, np.ma.MaskedArray):
@@ -652,47 +768,44 @@ def get_interpolated(G, S, b, lon, lat, z, N, zinds):
     XYin = np.array((Lon.flatten(), Lat.flatten())).T
     XYr = np.array((G['lon_rho'].flatten(), G['lat_rho'].flatten())).T
     h = G['h']
-    IMr = cKDTree(XYin).query(XYr)[1]
+    IMr = get_nn_inds(XYin, XYr, 'interp', [lon, lat, G['lon_rho'], G['lat_rho']],
+        cache_dir=cache_dir)
     
-    # 2D fields
-    for vn in ['ssh', 'ubar', 'vbar']:
-        vv = b[vn].flatten()[IMr].reshape(h.shape)
-        if vn == 'ubar':
-            vv = (vv[:,:-1] + vv[:,1:])/2
-        elif vn == 'vbar':
-            vv = (vv[:-1,:] + vv[1:,:])/2
-        vvc = vv.copy()
-        # always a good idea to make sure dict entries are not just pointers
-        # to arrays that might be changed later, hence the .copy()
-        c[vn] = vvc
-        checknan(vvc)
-        
-    # 3D fields
-    # create intermediate arrays which are on the ROMS lon_rho, lat_rho grid
-    # but have the HYCOM vertical grid (N layers)
-    F = np.nan * np.ones(((N,) + h.shape))
-    vi_dict = {}
-    for vn in ['theta', 's3d', 'u3d', 'v3d']:
-        FF = F.copy()
-        for nn in range(N):
-            vin = b[vn][nn,:,:].flatten()
-            FF[nn,:,:] = vin[IMr].reshape(h.shape)
-        checknan(FF)
-        vi_dict[vn] = FF
+    # start the list of input dicts
+    c_list = [{} for b in b_list]
+    vn_list = ['theta', 's3d', 'u3d', 'v3d']
+    # intermediate arrays which are on the ROMS lon_rho, lat_rho grid
+    # but have the HYCOM vertical grid (N layers), packed (day, variable, N, M, L)
+    vi = np.nan * np.ones((len(b_list), len(vn_list), N) + h.shape)
+    for ib, b in enumerate(b_list):
+        c = c_list[ib]
+        # 2D fields
+        for vn in ['ssh', 'ubar', 'vbar']:
+            vv = b[vn].flatten()[IMr].reshape(h.shape)
+            if vn == 'ubar':
+                vv = (vv[:,:-1] + vv[:,1:])/2
+            elif vn == 'vbar':
+                vv = (vv[:-1,:] + vv[1:,:])/2
+            vvc = vv.copy()
+            # always a good idea to make sure dict entries are not just pointers
+            # to arrays that might be changed later, hence the .copy()
+            c[vn] = vvc
+            checknan(vvc)
+        # 3D fields: gather all levels at once
+        for iv, vn in enumerate(vn_list):
+            vi[ib, iv] = b[vn].reshape((N, -1))[:, IMr].reshape((N,) + h.shape)
+            checknan(vi[ib, iv])
     
-    # do the vertical interpolation from HYCOM to ROMS z positions
-    for vn in ['theta', 's3d', 'u3d', 'v3d']:
-        vi = vi_dict[vn]
-        hinds = np.indices((S['N'], G['M'], G['L']))
-        vvf = vi[zinds, hinds[1].flatten(), hinds[2].flatten()]
-        vv = vvf.reshape((S['N'], G['M'], G['L']))
-        vvc = vv.copy()
-        if vn == 'u3d':
-            vvc = (vvc[:,:,:-1] + vvc[:,:,1:])/2
-        elif vn == 'v3d':
-            vvc = (vvc[:,:-1,:] + vvc[:,1:,:])/2
-        checknan(vvc)
-        c[vn] = vvc
-    return c
-
-
+    # do the vertical interpolation from HYCOM to ROMS z positions,
+    # for all four variables of all the days at once
+    vv_all = apply_zop(Z, vi)
+    for ib in range(len(b_list)):
+        for iv, vn in enumerate(vn_list):
+            vvc = vv_all[ib, iv].copy()
+            if vn == 'u3d':
+                vvc = (vvc[:,:,:-1] + vvc[:,:,1:])/2
+            elif vn == 'v3d':
+                vvc = (vvc[:,:-1,:] + vvc[:,1:,:])/2
+            checknan(vvc)
+            c_list[ib][vn] = vvc
+    return c_list
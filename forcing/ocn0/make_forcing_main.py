@@ -55,6 +55,9 @@ planC = False
 add_CTD = False
 do_bio = True
 verbose = False
+# Set linear_z = True to use linear interpolation from HYCOM z to ROMS z, instead
+# of using the value at the HYCOM level just above each ROMS z_rho.
+linear_z = False
 
 if Ldir['testing']:
     verbose = True
@@ -168,13 +171,15 @@ if planC == False:
 
     # extrapolate
     lon, lat, z, L, M, N, X, Y = Ofun.get_coords(h_out_dir)
+    # nearest neighbor index maps are saved here to be reused on later days
+    cache_dir = Ofun.get_cache_dir(Ldir)
     fh_list = sorted([item.name for item in h_out_dir.iterdir()
             if item.name[:2]=='fh'])
     for fn in fh_list:
         print('-Extrapolating ' + fn)
         in_fn = h_out_dir / fn
         V = Ofun.get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir,
-            add_CTD=add_CTD)
+            add_CTD=add_CTD, cache_dir=cache_dir)
         pickle.dump(V, open(h_out_dir / ('x' + fn), 'wb'))
 
     # and interpolate to ROMS format
@@ -192,12 +197,12 @@ if planC == False:
     dt_list = []
     count = 0
     c_dict = dict()
-    zinds = Ofun.get_zinds(G['h'], S, z)
+    Z = Ofun.get_zop(G['h'], S, z, linear=linear_z, cache_dir=cache_dir)
     for fn in xfh_list:
         print('-Interpolating ' + fn + ' to ROMS grid')
         b = pickle.load(open(h_out_dir / fn, 'rb'))
         dt_list.append(b['dt'])
-        c = Ofun.get_interpolated(G, S, b, lon, lat, z, N, zinds)
+        c = Ofun.get_interpolated(G, S, b, lon, lat, z, N, Z, cache_dir=cache_dir)
         c_dict[count] = c
         count += 1
     # Write to ROMS forcing files
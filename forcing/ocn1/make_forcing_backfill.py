@@ -0,0 +1,214 @@
+"""
+This makes the OCN forcing files for a range of backfill days in a single process.
+It gives the same ocean_[clm, ini, bry].nc files as running make_forcing_main.py
+for each day, but is much faster for long backfills because:
+- each daily HYCOM archive file is read once, instead of up to six times
+- each time-filtered day is extrapolated and interpolated to the ROMS grid once,
+and used for both of the days whose clm file it is in
+- the ROMS grid, S-coordinates, nearest neighbor index maps, and vertical
+interpolation operator are made once and shared by all days
+
+The days are streamed through the rolling Hanning window, so only the HYCOM
+days needed for the current day are kept in memory. It does not save the
+intermediate pickled dicts in the Data folder that make_forcing_main.py makes.
+
+Test on mac in ipython:
+
+run make_forcing_backfill.py -g cas6 -t v3 -0 2019.07.04 -1 2019.07.10
+
+"""
+
+import sys
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+from lo_tools import Lfun, zrfun
+from lo_tools import forcing_argfun as ffun
+from lo_tools import cache_functions as cachefun
+import Ofun
+import Ofun_nc
+import Ofun_bio
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-g', '--gridname', type=str)   # e.g. cas6
+parser.add_argument('-t', '--tag', type=str)        # e.g. v3
+parser.add_argument('-f', '--frc', type=str, default='ocn1')
+parser.add_argument('-s', '--start_type', type=str, default='continuation') # new or continuation
+parser.add_argument('-0', '--ds0', type=str)        # e.g. 2019.07.04
+parser.add_argument('-1', '--ds1', type=str)        # e.g. 2019.07.10
+parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
+args = parser.parse_args()
+
+# test that required arguments were provided
+argsd = args.__dict__
+for a in ['gridname', 'tag', 'ds0', 'ds1']:
+    if argsd[a] == None:
+        print('*** Missing required argument to make_forcing_backfill.py: ' + a)
+        sys.exit()
+
+Ldir = Lfun.Lstart(gridname=args.gridname, tag=args.tag)
+Ldir['frc'] = args.frc
+Ldir['run_type'] = 'backfill'
+Ldir['start_type'] = args.start_type
+Ldir['testing'] = args.testing
+
+# defaults (these should be the same as in make_forcing_main.py)
+do_bio = True
+linear_z = False
+if Ldir['testing']:
+    Ofun.verbose = True
+
+dt0 = datetime.strptime(args.ds0, Lfun.ds_fmt)
+dt1 = datetime.strptime(args.ds1, Lfun.ds_fmt)
+
+# grid info shared by all days
+G = zrfun.get_basic_info(Ldir['grid'] / 'grid.nc', only_G=True)
+S_fn = Ldir['grid'] / 'S_COORDINATE_INFO.csv'
+S_info_dict = pd.read_csv(S_fn, index_col='ITEMS').to_dict()['VALUES']
+S = zrfun.get_S(S_info_dict)
+# nearest neighbor index maps, etc. are saved here to be reused on later days
+cache_dir = Ofun.get_cache_dir(Ldir)
+
+# Things we keep from one day to the next:
+# the list of HYCOM archive files (it changes at the switch from hy5 to hy6)
+hnc_unique_dict = dict()
+# dicts of HYCOM fields, from convert_extraction_oneday(), keyed by file name
+a_dict = dict()
+# dicts of fields on the ROMS grid, from get_interpolated_list(), keyed by the
+# files in the Hanning window and the HYCOM grid
+c_memo = dict()
+
+def get_a(fn):
+    # read a daily HYCOM archive file, or get it from memory
+    if fn not in a_dict.keys():
+        a_dict[fn] = Ofun.convert_extraction_oneday(fn)
+    return a_dict[fn]
+
+def get_c_list(item_list, coords, add_CTD):
+    # filter in time, extrapolate, and interpolate to ROMS format, for a list
+    # of (fn_list, fac_list, dt) tuples, each of which makes one filtered day,
+    # doing the vertical interpolation of all of them at once
+    lon, lat, z, L, M, N, X, Y = coords
+    V_list = []
+    for fn_list, fac_list, dt in item_list:
+        aa = Ofun.filter_dicts([get_a(fn) for fn in fn_list], fac_list)
+        aa['dt'] = dt
+        V_list.append(Ofun.extrapolate_dict(aa, L, M, N, X, Y, lon, lat, z, Ldir,
+            add_CTD=add_CTD, cache_dir=cache_dir))
+    Z = Ofun.get_zop(G['h'], S, z, linear=linear_z, cache_dir=cache_dir)
+    return Ofun.get_interpolated_list(G, S, V_list, lon, lat, z, N, Z, cache_dir=cache_dir)
+
+fac_list_H = [12, 4, 3, 4, 12]
+# inverse weighting factors for a Hanning window of length 5
+
+tt00 = datetime.now()
+this_dt = dt0
+while this_dt <= dt1:
+    result_dict = dict()
+    result_dict['start_dt'] = datetime.now()
+    Ldir['date_string'] = this_dt.strftime(Lfun.ds_fmt)
+    print('\n' + (' %s %s ' % (Ldir['frc'], Ldir['date_string'])).center(60,'-'))
+    sys.stdout.flush()
+    out_dir = Ldir['LOo'] / 'forcing' / Ldir['gtag'] / ('f' + Ldir['date_string']) / Ldir['frc']
+    Lfun.make_dir(out_dir, clean=True)
+    Lfun.make_dir(out_dir / 'Info')
+    Lfun.make_dir(out_dir / 'Data')
+
+    # *** automate when to set add_CTD to True ***
+    add_CTD = False
+    if this_dt == datetime(2016,12,15):
+        print('WARNING: adding CTD data to extrapolation!!')
+        add_CTD = True
+
+    try:
+        # Make a list of files to use from the hycom archive.
+        hy_key = this_dt <= datetime(2018,12,6)
+        if hy_key not in hnc_unique_dict.keys():
+            hnc_unique_dict[hy_key] = Ofun.get_hnc_unique_list(this_dt, Ldir)
+        hnc_short_list = Ofun.get_hnc_short_list(this_dt, Ldir,
+            hnc_unique_list=hnc_unique_dict[hy_key])
+        # Name them by the time of their data, as make_forcing_main.py does
+        # for its pickled dicts (so a repeated time uses the later file).
+        h_dict = dict()
+        for fn in hnc_short_list:
+            a = get_a(fn)
+            h_dict['h' + datetime.strftime(a['dt'], Lfun.ds_fmt) + '.p'] = fn
+        h_list = sorted(h_dict.keys())
+        nh = len(h_list)
+        # drop HYCOM days we no longer need
+        for fn in list(a_dict.keys()):
+            if fn not in hnc_short_list:
+                a_dict.pop(fn)
+
+        # HYCOM grid info (assume that from the first file works)
+        a = get_a(h_dict[h_list[0]])
+        coords = Ofun.make_coords({'lon':a['lon'], 'lat':a['lat'], 'z':a['z']})
+        coord_key = cachefun.get_hash([coords[0], coords[1], coords[2]])
+
+        # filter in time, extrapolate, and interpolate
+        print('-Filtering in time')
+        dt_list = []
+        c_dict = dict()
+        if (nh == len(fac_list_H) + 1) and Ofun.check_gaps(h_list):
+            print('--Using Hanning window')
+            key_dict = dict()
+            todo_list = []
+            for nt in range(nh - 4):
+                fn_list = [h_dict[h_list[n + nt]] for n in range(len(fac_list_H))]
+                dt = datetime.strptime(h_list[nt + 2].strip('h').strip('.p'), Lfun.ds_fmt)
+                key = (tuple(fn_list), coord_key, add_CTD)
+                if key in c_memo.keys():
+                    print('-Reusing filtered and interpolated fields for ' + h_list[nt + 2])
+                    c_dict[nt] = c_memo[key]
+                else:
+                    print('-Interpolating f' + h_list[nt + 2] + ' to ROMS grid')
+                    todo_list.append((nt, (fn_list, fac_list_H, dt)))
+                key_dict[nt] = key
+                dt_list.append(dt)
+            # all the new filtered days are interpolated together
+            if len(todo_list) > 0:
+                c_list = get_c_list([item for nt, item in todo_list], coords, add_CTD)
+                for ii in range(len(todo_list)):
+                    c_dict[todo_list[ii][0]] = c_list[ii]
+            # only keep the fields that may be used tomorrow
+            c_memo = {key_dict[nt]:c_dict[nt] for nt in key_dict.keys()}
+        else:
+            print('--Using block average')
+            # make a simple average and use it for both times
+            fn_list = [h_dict[hh] for hh in h_list]
+            c = get_c_list([(fn_list, list(nh * np.ones(nh)), this_dt)], coords, add_CTD)[0]
+            for nt in range(2):
+                dt_list.append(this_dt + timedelta(days=nt))
+                c_dict[nt] = c
+            c_memo = dict()
+
+        # Write to ROMS forcing files
+        Ofun_nc.make_clm_file(Ldir, out_dir, out_dir / 'Data', c_dict, dt_list, S, G)
+        if do_bio:
+            Ofun_bio.add_bio(out_dir, G, add_CTD=add_CTD)
+        Ofun_nc.make_ini_file(out_dir)
+        Ofun_nc.make_bry_file(out_dir)
+    except Exception as e:
+        print(e)
+        c_memo = dict()
+
+    # check results
+    nc_list = ['ocean_clm.nc', 'ocean_ini.nc', 'ocean_bry.nc']
+    result_dict['result'] = 'success'
+    result_dict['note'] = 'backfill range %s-%s' % (args.ds0, args.ds1)
+    for fn in nc_list:
+        if (out_dir / fn).is_file():
+            pass
+        else:
+           result_dict['result'] = 'fail'
+    result_dict['end_dt'] = datetime.now()
+    ffun.finale(Ldir, result_dict)
+    print('* %s result=%s (took %0.1f sec)' % (Ldir['date_string'], result_dict['result'],
+        (result_dict['end_dt'] - result_dict['start_dt']).total_seconds()))
+    sys.stdout.flush()
+
+    this_dt += timedelta(days=1)
+
+print('\nTotal time = %0.1f sec' % ((datetime.now() - tt00).total_seconds()))
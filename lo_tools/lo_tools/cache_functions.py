@@ -0,0 +1,61 @@
+"""
+Functions for saving things that are slow to make, like nearest neighbor index
+maps or regridding weights, so they can be reused on later calls or later days.
+
+Each item is identified by a string key, usually a name plus get_hash() of the
+arrays it depends on. Items are kept in an in-memory dict supplied by the caller
+(so that separate modules keep separate caches), and optionally pickled to a
+cache_dir on disk. It is always safe to delete the files in a cache_dir.
+"""
+
+import os
+import pickle
+import hashlib
+from pathlib import Path
+import numpy as np
+
+def get_hash(arr_list):
+    """
+    Make a short string that identifies the contents of a list of arrays.
+    """
+    h = hashlib.sha1()
+    for arr in arr_list:
+        arr = np.ascontiguousarray(arr)
+        h.update(str(arr.shape).encode())
+        h.update(str(arr.dtype).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()[:20]
+
+def load_cache(key, cache_dir=None, cache_dict=None):
+    """
+    Get a saved item from the dict cache_dict in memory, or from cache_dir.
+    Returns None if it has not been saved.
+    """
+    if (cache_dict != None) and (key in cache_dict.keys()):
+        return cache_dict[key]
+    if cache_dir != None:
+        cache_fn = Path(cache_dir) / (key + '.p')
+        if cache_fn.is_file():
+            try:
+                item = pickle.load(open(cache_fn, 'rb'))
+                if cache_dict != None:
+                    cache_dict[key] = item
+                return item
+            except Exception as e:
+                print(e)
+    return None
+
+def save_cache(key, item, cache_dir=None, cache_dict=None):
+    """
+    Save an item in the dict cache_dict in memory, and in cache_dir,
+    for each one that is given.
+    """
+    if cache_dict != None:
+        cache_dict[key] = item
+    if cache_dir != None:
+        # write to a temporary name and then rename, so that another
+        # job reading the cache never sees a partly written file
+        cache_fn = Path(cache_dir) / (key + '.p')
+        temp_fn = Path(cache_dir) / (key + '_' + str(os.getpid()) + '.temp')
+        pickle.dump(item, open(temp_fn, 'wb'))
+        os.replace(temp_fn, cache_fn)
@@ -20,6 +20,7 @@ def intro():
     parser.add_argument('-source', type=str) # e.g. dfo
     parser.add_argument('-otype', type=str) # observation type, e.g. ctd, bottle, etc.
     parser.add_argument('-year', type=int) # e.g. 2019
+    parser.add_argument('-batch', type=Lfun.boolean_string, default=False) # group casts by history file
     # arguments used by extract/tef and tef2
     parser.add_argument('-sect_name', type=str, default='ai1')
     parser.add_argument('-get_bio', type=Lfun.boolean_string, default=False)
@@ -27,6 +28,8 @@ def intro():
     parser.add_argument('-ctag','--collection_tag', type=str)
     parser.add_argument('-riv', type=str) # e.g. riv00
     parser.add_argument('-his_num', type=int, default=2) # use 1 to start with ocean_his_0001.nc
+    # arguments used by extract/lowpass
+    parser.add_argument('-stream', type=Lfun.boolean_string, default=False) # read each hourly file once
     
     # get the args and put into Ldir
     args = parser.parse_args()
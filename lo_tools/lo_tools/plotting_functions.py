@@ -369,11 +369,18 @@ def get_aa_ex(ds):
     aa = [x[0], x[-1], y[0], y[-1]]
     return aa
 
-def get_zfull(ds, fn, which_grid):
+def get_zfull(ds, fn, which_grid, gtagex=None):
     # get zfull field on "which_grid" ('rho', 'u', or 'v')
-    G, S, T = zrfun.get_basic_info(fn)
-    zeta = 0 * G['h']
-    zr_mid = zrfun.get_z(G['h'], zeta, S, only_rho=True)
+    # Passing gtagex uses (and if needed writes) the grid cache in
+    # LO_output/grid_cache/[gtagex], otherwise nothing is written.
+    if gtagex == None:
+        G, S, T = zrfun.get_basic_info(fn)
+        zeta = 0 * G['h']
+        zr_mid = zrfun.get_z(G['h'], zeta, S, only_rho=True)
+    else:
+        G, S, T = zrfun.get_basic_info_cached(fn, gtagex=gtagex)
+        zeta = 0 * G['h']
+        zr_mid = G['z_rho0']
     zr_bot = -G['h'].reshape(1, G['M'], G['L']).copy()
     zr_top = zeta.reshape(1, G['M'], G['L']).copy()
     zfull0 = make_full((zr_bot, zr_mid, zr_top))
@@ -387,16 +394,103 @@ def get_zfull(ds, fn, which_grid):
 
 def get_laym(ds, zfull, mask, vn, zlev):
     # make the layer
+    # This gives the same result as using make_full() and get_layer(), but uses
+    # the faster get_layer_weights() and apply_layer_weights().
     fld_mid = ds[vn].values.squeeze()
-    fld = make_full((fld_mid,))
-    zlev_a = zlev * np.ones(1)
-    lay = get_layer(fld, zfull, zlev_a)
+    W = get_layer_weights(zfull, [zlev])
+    lay = apply_layer_weights(W, fld_mid)[0,:,:]
     lay[mask == False] = np.nan
     # Note: if mask came directly from the mask_rho field of a history file it is
     # 1 = water, and 0 = land, so it would be better to add nan's using this as a
     # test, but using mask == False works.
     return lay
 
+def get_layms(ds, zfull, mask, vn_list, zlev_list, W=None):
+    """
+    Like get_laym() but for many variables and many z levels at once. The
+    vertical interpolation weights are found once (or passed in as W, from
+    get_layer_weights(zfull, zlev_list), to reuse them for more variables)
+    and then applied to all the variables in a single gather.
+    Output:
+        lay_dict = {vn: (len(zlev_list), M, L) ndarray of layers}
+    """
+    if W is None:
+        W = get_layer_weights(zfull, zlev_list)
+    fld_mid = np.stack([ds[vn].values.squeeze() for vn in vn_list])
+    lay_all = apply_layer_weights(W, fld_mid)
+    lay_all[:, :, mask == False] = np.nan
+    lay_dict = dict()
+    for ii, vn in enumerate(vn_list):
+        lay_dict[vn] = lay_all[ii]
+    return lay_dict
+
+def get_layer_weights(zfull, zlev_list):
+    """
+    Finds the vertical bracketing indices and linear interpolation weights for
+    horizontal slices at one or more z levels, so that they can be used for
+    any number of fields on the same grid (see apply_layer_weights()). The
+    results are the same as those from get_layer(), which finds them again
+    for each field.
+    Input:
+        zfull (3D ndarray) of z values, from get_zfull() or make_full()
+        zlev_list (list or 1D ndarray) of z values for the layers (negative down)
+    Output:
+        W = dict of (NZ, M, L) ndarrays, where NZ = len(zlev_list):
+            'k0', 'k1' = indices of the levels below and above each z level,
+            given as indices into the field WITHOUT the added top and bottom
+            layers of make_full(), which are just copies of its end levels
+            'fr' = the fraction of the way from k0 to k1,
+            with np.nan where the layer is not defined
+    """
+    NF, M, L = zfull.shape # NF = N+2 for full fields
+    zlev_a = np.array(zlev_list, dtype=float).reshape(-1, 1, 1)
+    W = {'k0':[], 'k1':[], 'fr':[]}
+    for zz in zlev_a:
+        # index of points below zz in the full field
+        ind0 = (zfull < zz).sum(0) - 1
+        # cells out of bounds, above or below the full field, are masked
+        good = (ind0 >= 0) & (ind0 <= NF-2)
+        ind0[~good] = 0
+        z0 = np.take_along_axis(zfull, ind0[np.newaxis], axis=0)[0]
+        z1 = np.take_along_axis(zfull, ind0[np.newaxis] + 1, axis=0)[0]
+        z0[~good] = np.nan
+        z1[~good] = np.nan
+        # do the interpolation weights
+        dz = z1 - z0
+        dzf = zz - z0
+        dz[dz == 0] = np.nan
+        W['fr'].append(dzf / dz)
+        # convert to indices of the field without the added top and bottom
+        W['k0'].append(np.clip(ind0 - 1, 0, NF-3))
+        W['k1'].append(np.clip(ind0, 0, NF-3))
+    for k in W.keys():
+        W[k] = np.array(W[k])
+    return W
+
+def apply_layer_weights(W, fld):
+    """
+    Makes horizontal slices through 3D ROMS data fields, using the weights
+    from get_layer_weights().
+    Input:
+        W = dict from get_layer_weights()
+        fld (ndarray) the data field(s) on the vertical rho grid, packed
+            as (N, M, L), or (NV, N, M, L) for NV fields at once
+    Output:
+        lay (ndarray) packed as (NZ, M, L), or (NV, NZ, M, L),
+            with np.nan where it is not defined
+    """
+    if fld.ndim == 3:
+        return apply_layer_weights(W, fld[np.newaxis])[0]
+    NV = fld.shape[0]
+    NZ, M, L = W['fr'].shape
+    k0 = np.broadcast_to(W['k0'][np.newaxis], (NV, NZ, M, L))
+    k1 = np.broadcast_to(W['k1'][np.newaxis], (NV, NZ, M, L))
+    fld0 = np.take_along_axis(fld, k0, axis=1)
+    fld1 = np.take_along_axis(fld, k1, axis=1)
+    fr = W['fr'][np.newaxis]
+    lay = fld0*(1 - fr) + fld1*fr
+    return lay
+
 def get_layer(fld, zfull, which_z):
     """
     Creates a horizontal slice through a 3D ROMS data field.  It is very fast
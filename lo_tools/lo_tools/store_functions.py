@@ -0,0 +1,216 @@
+"""
+Functions for writing the output of extractions (like extract/box and extract/moor)
+to time-chunked, compressed stores, and for reading them back lazily.
+
+There are two kinds of store:
+- 'nc' is a NetCDF-4 file with an unlimited ocean_time dimension.
+- 'zarr' is a zarr directory store (written with xarray, so it needs zarr installed).
+
+In both cases time-dependent variables are chunked along ocean_time and compressed,
+and we can append new times to an existing store, for example when extracting one
+day at a time. Then open_store() gives an xarray Dataset backed by dask arrays, so
+that only the slices you actually use are read from disk.
+
+The extraction codes describe their output with two dicts:
+- dim_dict = {dim name: size}, ocean_time is not included
+- var_dict = {vn: {'dims':tuple, 'dtype':dtype, 'attrs':dict, 'data':array}}
+where 'data' is only given for variables that do not have an ocean_time dimension.
+"""
+
+import sys
+import shutil
+import numpy as np
+import netCDF4 as nc
+import xarray as xr
+from pathlib import Path
+
+store_list = ['nc', 'zarr']
+
+def get_store_fn(fn, store):
+    """
+    Make the name of the output file fn have the right suffix for this store.
+    """
+    if store not in store_list:
+        print('ERROR: unknown store: ' + str(store))
+        sys.exit()
+    # The names often have dates with dots in them (like job_2019.07.04_2019.07.06),
+    # so we only replace a suffix that is a store type.
+    fn = Path(fn)
+    if fn.suffix[1:] in store_list:
+        fn = fn.with_suffix('')
+    return fn.parent / (fn.name + '.' + store)
+
+def start_store(fn, dim_dict, var_dict, global_attrs=dict(), nt_chunk=1, append=False):
+    """
+    Create a new store at fn (the suffix of fn determines the type), or if append
+    is True and the store exists, open it to add more times.
+
+    nt_chunk is the number of times in each chunk of the time-dependent variables.
+
+    Returns the dict St that is passed to write_block() and close_store().
+    """
+    fn = Path(fn)
+    St = {'fn':fn, 'store':fn.suffix[1:], 'var_dict':var_dict, 'dim_dict':dim_dict,
+        'global_attrs':global_attrs, 'nt_chunk':nt_chunk}
+    St['n_skip'] = 0 # number of times skipped because they were already in the store
+    St['time_list'] = [vn for vn in var_dict.keys() if 'ocean_time' in var_dict[vn]['dims']]
+    if St['store'] not in store_list:
+        print('ERROR: unknown store: ' + str(fn))
+        sys.exit()
+    # new is True if we are making a new store
+    St['new'] = not (append and fn.exists())
+    if not St['new']:
+        # check that the existing store has the variables we will add to it
+        ds = open_store(fn)
+        missing = [vn for vn in St['time_list'] if vn not in ds.variables]
+        if len(missing) > 0:
+            print('ERROR: cannot append, missing variables in %s: %s' % (str(fn), ', '.join(missing)))
+            sys.exit()
+        St['NT'] = len(ds['ocean_time'])
+        if St['NT'] > 0:
+            St['t_last'] = float(ds['ocean_time'][-1].values)
+        else:
+            St['t_last'] = None
+        ds.close()
+        print('Appending to %s (%d times already)' % (str(fn), St['NT']))
+    else:
+        if fn.is_dir():
+            shutil.rmtree(fn)
+        else:
+            fn.unlink(missing_ok=True)
+        St['NT'] = 0
+        St['t_last'] = None
+    if St['store'] == 'nc':
+        if St['new']:
+            make_nc(St)
+        St['ds'] = nc.Dataset(fn, 'a')
+    return St
+
+def make_nc(St):
+    # Create a NetCDF-4 file with all the dimensions and variables, and write
+    # the variables that do not depend on time.
+    out_ds = nc.Dataset(St['fn'], 'w')
+    out_ds.setncatts(St['global_attrs'])
+    out_ds.createDimension('ocean_time', None)
+    for dim in St['dim_dict'].keys():
+        out_ds.createDimension(dim, St['dim_dict'][dim])
+    for vn in St['var_dict'].keys():
+        vd = St['var_dict'][vn]
+        if vn in St['time_list']:
+            if vn == 'ocean_time':
+                vv = out_ds.createVariable(vn, vd['dtype'], vd['dims'])
+            else:
+                chunks = (St['nt_chunk'],) + tuple([St['dim_dict'][dim] for dim in vd['dims'][1:]])
+                if np.dtype(vd['dtype']).kind == 'f':
+                    fill_value = 1e20
+                else:
+                    fill_value = None
+                vv = out_ds.createVariable(vn, vd['dtype'], vd['dims'], zlib=True, complevel=1,
+                    fill_value=fill_value, chunksizes=chunks)
+            vv.setncatts(vd['attrs'])
+        else:
+            vv = out_ds.createVariable(vn, vd['dtype'], vd['dims'])
+            vv.setncatts(vd['attrs'])
+            vv[:] = vd['data']
+    out_ds.close()
+
+def write_block(St, CC_dict):
+    """
+    Add a block of times to the store. CC_dict has an array for each time-dependent
+    variable, packed (time, ...), including ocean_time. Any times that are not
+    after the last time already in the store are skipped.
+    """
+    ot = np.array(CC_dict['ocean_time'], dtype=float)
+    if St['t_last'] != None:
+        mask = ot > St['t_last']
+        if not mask.all():
+            St['n_skip'] += (~mask).sum()
+            if not mask.any():
+                return
+            CC_dict = {vn:np.asarray(CC_dict[vn])[mask] for vn in St['time_list']}
+            ot = ot[mask]
+    nt = len(ot)
+    it0 = St['NT']
+    if St['store'] == 'nc':
+        out_ds = St['ds']
+        for vn in St['time_list']:
+            if vn == 'ocean_time':
+                out_ds[vn][it0:it0+nt] = ot
+            else:
+                # nan is written as the fill value
+                out_ds[vn][it0:it0+nt, ...] = np.ma.masked_invalid(CC_dict[vn])
+    elif St['store'] == 'zarr':
+        ds = xr.Dataset()
+        for vn in St['time_list']:
+            vd = St['var_dict'][vn]
+            attrs = vd['attrs'].copy()
+            coords = attrs.pop('coordinates', None)
+            ds[vn] = (vd['dims'], np.asarray(CC_dict[vn], dtype=vd['dtype']), attrs)
+            if coords != None:
+                ds[vn].encoding['coordinates'] = coords
+        if St['new']:
+            # first block: also write the static variables and set the chunking
+            for vn in St['var_dict'].keys():
+                if vn not in St['time_list']:
+                    vd = St['var_dict'][vn]
+                    ds[vn] = (vd['dims'], np.asarray(vd['data'], dtype=vd['dtype']), vd['attrs'])
+            ds.attrs = St['global_attrs']
+            enc_dict = dict()
+            for vn in St['time_list']:
+                chunks = (St['nt_chunk'],) + tuple([St['dim_dict'][dim] for dim in St['var_dict'][vn]['dims'][1:]])
+                enc_dict[vn] = {'chunks':chunks}
+            ds.to_zarr(St['fn'], mode='w', encoding=enc_dict)
+            St['new'] = False
+        else:
+            ds.to_zarr(St['fn'], append_dim='ocean_time')
+    St['NT'] += nt
+    St['t_last'] = ot[-1]
+
+def close_store(St):
+    if St['n_skip'] > 0:
+        print(' - skipped %d times already in %s' % (St['n_skip'], St['fn'].name))
+    if St['store'] == 'nc':
+        St['ds'].close()
+
+def open_store(fn, chunks={}):
+    """
+    Open a store (NetCDF or zarr) lazily as an xarray Dataset. With the default
+    chunks={} the dask chunks are the same as the chunks on disk.
+    """
+    fn = Path(fn)
+    if fn.suffix == '.zarr':
+        ds = xr.open_zarr(fn, chunks=chunks, decode_times=False)
+    else:
+        ds = xr.open_dataset(fn, chunks=chunks, decode_times=False)
+    return ds
+
+def convert_store(in_fn, out_fn, nt_chunk=24):
+    """
+    Copy an existing extraction file in_fn (e.g. the NetCDF output of an older
+    extraction) to out_fn, which may be NetCDF or zarr, with the time-dependent
+    variables chunked in time and compressed. It is done nt_chunk times at a time,
+    so the whole file is never in memory.
+    """
+    in_fn = Path(in_fn)
+    out_fn = Path(out_fn)
+    ds = xr.open_dataset(in_fn, decode_times=False)
+    dim_dict = {dim:ds.sizes[dim] for dim in ds.dims if dim != 'ocean_time'}
+    var_dict = dict()
+    for vn in ds.variables:
+        vd = {'dims':ds[vn].dims, 'dtype':ds[vn].dtype, 'attrs':ds[vn].attrs.copy()}
+        if 'coordinates' in ds[vn].encoding.keys():
+            vd['attrs']['coordinates'] = ds[vn].encoding['coordinates']
+        if 'ocean_time' not in ds[vn].dims:
+            vd['data'] = ds[vn].values
+        elif ds[vn].dims[0] != 'ocean_time':
+            print('ERROR: ocean_time must be the first dimension of ' + vn)
+            sys.exit()
+        var_dict[vn] = vd
+    St = start_store(out_fn, dim_dict, var_dict, global_attrs=ds.attrs.copy(), nt_chunk=nt_chunk)
+    NT = ds.sizes['ocean_time']
+    for it0 in range(0, NT, nt_chunk):
+        it1 = min(it0 + nt_chunk, NT)
+        CC_dict = {vn:ds[vn][it0:it1].values for vn in St['time_list']}
+        write_block(St, CC_dict)
+    close_store(St)
+    ds.close()
@@ -114,23 +114,14 @@ def get_interpolant(x, xvec, show_warnings=True):
         if not np.all(np.diff(xvec) > 0):
             itp_err('xvec must be monotonic and increasing')
 
-    nx = len(x)
     nxvec = len(xvec)
 
-    X = x.reshape(nx, 1) # column vector
-    xvec = xvec.reshape(1, nxvec)
-    XVEC = xvec.repeat(nx, axis=0) # matrix
-
-    # preallocate results arrays
-    i0 = np.zeros(nx, dtype=int)
-    i1 = np.zeros(nx, dtype=int)
-    fr = np.zeros(nx, dtype=float)
-
-    # calculate index columns
-    mask = X >= XVEC
-    # the above line broadcasts correctly even if nx = nxvec
-    # because we forced X to be a column vector
-    i0 = mask.sum(axis=1) - 1
+    # Calculate the index below each x using a binary search.  This is the
+    # number of points in xvec that are <= x, minus one, and uses memory
+    # that only scales with the size of x.
+    i0 = np.searchsorted(xvec, x, side='right') - 1
+    # searchsorted puts nan at the end, but we want it treated as below xvec
+    i0[np.isnan(x)] = -1
 
     # these masks are used to handle values of x beyond the range of xvec
     lomask = i0 < 0
@@ -140,15 +131,15 @@ def get_interpolant(x, xvec, show_warnings=True):
     i1 = i0 + 1
 
     # compute the fraction
-    xvec0 = xvec[0,i0]
-    xvec1 = xvec[0,i1]
+    xvec0 = xvec[i0]
+    xvec1 = xvec[i1]
     fr = (x - xvec0)/(xvec1 - xvec0)
 
     # fractions for out of range x
     fr[lomask] = np.nan
     fr[himask] = np.nan
     # override for the case where x = the last point of xvec
-    fr[X[:,0]==XVEC[0,-1]] = 1.0
+    fr[x==xvec[-1]] = 1.0
 
     return i0, i1, fr
 
@@ -231,7 +222,7 @@ def godin_shape():
     ** use ONLY with hourly data! **
     """
     k = np.arange(12)
-    filt = np.NaN * np.ones(71)
+    filt = np.nan * np.ones(71)
     filt[35:47] = (0.5/(24*24*25))*(1200-(12-k)*(13-k)-(12+k)*(13+k))
     k = np.arange(12,36)
     filt[47:71] = (0.5/(24*24*25))*(36-k)*(37-k)
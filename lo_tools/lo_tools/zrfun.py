@@ -9,7 +9,13 @@ import numpy as np
 import pandas as pd
 from lo_tools import Lfun
 import sys
+import os
 import pickle
+from pathlib import Path
+import shutil
+import hashlib
+import time
+import netCDF4 as nc
 
 def get_basic_info(fn, only_G=False, only_S=False, only_T=False):
     """
@@ -61,7 +67,116 @@ def get_basic_info(fn, only_G=False, only_S=False, only_T=False):
         return make_G(ds), make_S(ds), make_T(ds)
     ds.close()
 
-def get_z(h, zeta, S, only_rho=False, only_w=False):
+def get_grid_hash(fn):
+    """
+    Returns a hex string hash that identifies the grid and S-coordinates used
+    by the ROMS history file fn. This is what get_basic_info_cached() uses to
+    decide if a cached grid is still good.
+
+    To keep this fast it only reads h, mask_rho, one row of lon_rho, one
+    column of lat_rho (the grids are plaid), and the S-coordinate variables,
+    using netCDF4 hyperslabs.
+    """
+    ds = nc.Dataset(fn)
+    ds.set_auto_mask(False)
+    md = hashlib.md5()
+    for vn in ['h', 'mask_rho', 's_rho', 's_w', 'hc', 'Cs_r', 'Cs_w', 'Vtransform']:
+        md.update(np.ascontiguousarray(ds[vn][:]).tobytes())
+    md.update(np.ascontiguousarray(ds['lon_rho'][0,:]).tobytes())
+    md.update(np.ascontiguousarray(ds['lat_rho'][:,0]).tobytes())
+    ds.close()
+    return md.hexdigest()
+
+def get_basic_info_cached(fn, gtagex=None, check=True, wait_sec=600):
+    """
+    A faster version of get_basic_info(fn) for code that calls it many times,
+    like the subprocess workers used for extractions.
+
+    The first call for a given grid makes G and S in the usual way and saves
+    them to LO_output/grid_cache/[gtagex]/[grid hash], with each array as a .npy
+    file. After that G and S are loaded from there, with the arrays memory-mapped
+    (copy-on-write, so changing them does not change the cache).
+
+    G also has some precomputed fields that are not in get_basic_info():
+    - z_rho0 and z_w0: z on the rho and w grids for zeta = 0
+    - DA: the cell area DX*DY
+
+    If gtagex is None it is taken from the path of fn, which we assume is like
+    [roms_out]/[gtagex]/f[date]/ocean_his_0001.nc.
+
+    If check is True we use the version of the cache for the hash from
+    get_grid_hash(fn), making it if needed. Use check=False only when you know
+    the cache was made for the same grid, e.g. by the calling driver: then we
+    use the version named in [gtagex]/current.txt, waiting up to wait_sec for it
+    to appear, and raise a RuntimeError if it does not (we never make it).
+
+    A version is written to a temporary directory and renamed into place, and
+    current.txt is replaced by a rename, so workers running at the same time
+    never see a partial cache. A version is never deleted once it exists.
+
+    Output: dicts G, S, and T, as in get_basic_info()
+    """
+    fn = Path(fn)
+    if gtagex == None:
+        gtagex = fn.parent.parent.name
+    cache_dir = Lfun.Ldir['LOo'] / 'grid_cache' / gtagex
+    current_fn = cache_dir / 'current.txt'
+    def get_current():
+        # the grid hash of the current version, or None
+        try:
+            return current_fn.read_text().strip()
+        except FileNotFoundError:
+            return None
+    if check:
+        grid_hash = get_grid_hash(fn)
+    else:
+        grid_hash = get_current()
+        tt0 = time.time()
+        while (grid_hash == None) and (time.time() - tt0 < wait_sec):
+            time.sleep(1)
+            grid_hash = get_current()
+        if grid_hash == None:
+            raise RuntimeError('get_basic_info_cached(): no grid cache in %s after %d sec'
+                % (str(cache_dir), wait_sec))
+    version_dir = cache_dir / grid_hash
+    info_fn = version_dir / 'info.p'
+    if info_fn.is_file():
+        info = pickle.load(open(info_fn, 'rb'))
+        G = info['G'].copy()
+        for vn in info['G_arrays']:
+            G[vn] = np.load(version_dir / (vn + '.npy'), mmap_mode='c')
+        S = info['S']
+        T = get_basic_info(fn, only_T=True)
+    elif not check:
+        raise RuntimeError('get_basic_info_cached(): missing ' + str(info_fn))
+    else:
+        G, S, T = get_basic_info(fn)
+        G['z_rho0'], G['z_w0'] = get_z(G['h'], 0*G['h'], S)
+        G['DA'] = G['DX'] * G['DY']
+        # Write to a temporary directory and then rename it.
+        temp_dir = cache_dir / ('temp_' + str(os.getpid()))
+        Lfun.make_dir(temp_dir, clean=True)
+        info = {'grid_hash':grid_hash, 'G':dict(), 'S':S, 'G_arrays':[]}
+        for vn in G.keys():
+            if isinstance(G[vn], np.ndarray) and G[vn].ndim >= 2:
+                np.save(temp_dir / (vn + '.npy'), G[vn])
+                info['G_arrays'].append(vn)
+            else:
+                info['G'][vn] = G[vn]
+        pickle.dump(info, open(temp_dir / 'info.p', 'wb'))
+        try:
+            os.rename(temp_dir, version_dir)
+        except OSError:
+            # another process made the same version first, so we use theirs
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    if check and (get_current() != grid_hash):
+        # point check=False callers at this version
+        temp_fn = cache_dir / ('current_' + str(os.getpid()) + '.temp')
+        temp_fn.write_text(grid_hash)
+        os.replace(temp_fn, current_fn)
+    return G, S, T
+
+def get_z(h, zeta, S, only_rho=False, only_w=False, out=None, dtype=None):
     """
     Used to calculate the z position of fields in a ROMS history file
 
@@ -74,6 +189,22 @@ def get_z(h, zeta, S, only_rho=False, only_w=False):
     vectors of length VL, the output array (e.g. z_rho) will have size (N, VL)
     (i.e. it will never return an array with size (N, VL, 1), even if (VL, 1) was
     the input shape).  This is a result of the initial and final squeeze calls.
+
+    Optional arguments:
+    - zeta may have one more (leading) dimension than h, e.g. a time series
+    zeta[NT, M, L]. Then the output will be z_rho[NT, N, M, L], and z_w
+    [NT, N+1, M, L], still subject to the final squeeze.
+    - dtype: e.g. np.float32 to do the calculation (and return the result)
+    in single precision.
+    - out: a preallocated, C-contiguous array with the shape of the (squeezed)
+    result to write into, which is then returned. If both z_rho and z_w are
+    returned then out must be a tuple of two arrays. A ValueError is raised if
+    out is not C-contiguous or is the wrong size. Note that out is a plain
+    array, so if zeta is masked the mask is NOT applied to it.
+
+    2026.10.18 Recoded to broadcast h and zeta against the S-coordinate vectors
+    one level at a time, instead of using np.tile to make many full 3-D copies.
+    The results are identical.
     """
     # input error checking
     if ( (not isinstance(h, np.ndarray))
@@ -86,67 +217,83 @@ def get_z(h, zeta, S, only_rho=False, only_w=False):
     # remove singleton dimensions
     h = h.squeeze()
     zeta = zeta.squeeze()
+    # keep track of a mask on zeta, if any, to apply to the result
+    zmask = None
+    if isinstance(zeta, np.ma.core.MaskedArray):
+        zmask = np.ma.getmaskarray(zeta)
+        zeta = zeta.data
+    # check for a leading (e.g. time) dimension on zeta
+    if (zeta.ndim == h.ndim + 1) and (zeta.shape[1:] == h.shape):
+        NT = zeta.shape[0]
+    else:
+        NT = None
     # ensure that we have enough dimensions
     h = np.atleast_2d(h)
-    zeta = np.atleast_2d(zeta)
+    if NT is None:
+        zeta = np.atleast_2d(zeta)
+    else:
+        zeta = zeta.reshape((NT,) + h.shape)
     # check that the dimensions are the same
-    if h.shape != zeta.shape:
+    if zeta.shape[-2:] != h.shape:
         print('WARNING from get_z(): h and zeta must be the same shape')
     M, L = h.shape
-    def make_z_rho(h, zeta, S, N, M, L):
-        # rho
-        # create some useful arrays
-        csr = S['Cs_r']
-        csrr = csr.reshape(N, 1, 1).copy()
-        Cs_r = np.tile(csrr, [1, M, L])
-        H_r = np.tile(h.reshape(1, M, L).copy(), [N, 1, 1])
-        Zeta_r = np.tile(zeta.reshape(1, M, L).copy(), [N, 1, 1])
-        if S['hc'] == 0: # if hc = 0 the transform is simpler (and faster)
-            z_rho = H_r*Cs_r + Zeta_r + Zeta_r*Cs_r
-        elif S['hc'] != 0: # need to calculate a few more useful arrays
-            sr = S['s_rho'] # PM edit 2019.01.24
-            srr = sr.reshape(N, 1, 1).copy()
-            S_rho = np.tile(srr, [1, M, L])
-            Hc_r = np.tile(S['hc'], [N, M, L])
-            if S['Vtransform'] == 1:
-                zr0 = (S_rho - Cs_r) * Hc_r + Cs_r*H_r
-                z_rho = zr0 + Zeta_r * (1 + zr0/H_r)
-            elif S['Vtransform'] == 2:
-                zr0 = (S_rho*Hc_r + Cs_r*H_r) / (Hc_r + H_r)
-                z_rho = Zeta_r + (Zeta_r + H_r)*zr0
-        z_rho = z_rho.squeeze()
-        return z_rho
-    def make_z_w(h, zeta, S, N, M, L):
-        # w
-        # create some useful arrays
-        csw = S['Cs_w']
-        csww = csw.reshape(N+1, 1, 1).copy()
-        Cs_w = np.tile(csww, [1, M, L])
-        H_w = np.tile(h.reshape(1, M, L).copy(), [N+1, 1, 1])
-        Zeta_w = np.tile(zeta.reshape(1, M, L).copy(), [N+1, 1, 1])
-        if S['hc'] == 0: # if hc = 0 the transform is simpler (and faster)
-            z_w = H_w*Cs_w + Zeta_w + Zeta_w*Cs_w
-        elif S['hc'] != 0: # need to calculate a few more useful arrays
-            #sw = S['s_w']
-            sw = S['s_w'] # PM edit 2019.01.24
-            sww = sw.reshape(N+1, 1, 1).copy()
-            S_w = np.tile(sww, [1, M, L])    #
-            Hc_w = np.tile(S['hc'], [N+1, M, L])
-            if S['Vtransform'] == 1:
-                zw0 = (S_w - Cs_w) * Hc_w + Cs_w*H_w
-                z_w = zw0 + Zeta_w * (1 + zw0/H_w)
+    # S-coordinate parameters, cast to dtype if requested so that the
+    # arithmetic is all done at that precision
+    hc = S['hc']
+    if dtype is not None:
+        h = h.astype(dtype, copy=False)
+        zeta = zeta.astype(dtype, copy=False)
+        hc = np.array(hc).astype(dtype)
+    def make_z(s, Cs, NZ, out):
+        # s and Cs are the S-coordinate vectors, with length NZ
+        if dtype is not None:
+            s = s.astype(dtype)
+            Cs = Cs.astype(dtype)
+        if NT is None:
+            zshape = (NZ, M, L)
+        else:
+            zshape = (NT, NZ, M, L)
+        if out is None:
+            z = np.empty(zshape, dtype=np.result_type(h, zeta, Cs))
+        else:
+            # reshape() would silently make a copy instead of a view if out
+            # were not C-contiguous, and then out would never be filled
+            if not out.flags['C_CONTIGUOUS']:
+                raise ValueError('get_z(): out must be C-contiguous')
+            if out.size != np.prod(zshape):
+                raise ValueError('get_z(): out has size %d but the result has shape %s'
+                    % (out.size, str(zshape)))
+            z = out.reshape(zshape) # a view into out
+        if hc != 0:
+            hch = hc + h # used by Vtransform 2
+        # fill one level at a time, so the only temporary arrays are 2-D
+        for k in range(NZ):
+            if hc == 0: # if hc = 0 the transform is simpler (and faster)
+                z[..., k, :, :] = h*Cs[k] + zeta + zeta*Cs[k]
+            elif S['Vtransform'] == 1:
+                z0 = (s[k] - Cs[k]) * hc + Cs[k]*h
+                z[..., k, :, :] = z0 + zeta * (1 + z0/h)
             elif S['Vtransform'] == 2:
-                zw0 = (S_w*Hc_w  + Cs_w*H_w) / (Hc_w + H_w)
-                z_w = Zeta_w + (Zeta_w + H_w)*zw0
-        z_w = z_w.squeeze()
-        return z_w
+                z0 = (s[k]*hc + Cs[k]*h) / hch
+                z[..., k, :, :] = zeta + (zeta + h)*z0
+        if out is not None:
+            return out
+        if zmask is not None:
+            if NT is None:
+                zm = np.broadcast_to(zmask.reshape(1, M, L), zshape)
+            else:
+                zm = np.broadcast_to(zmask.reshape(NT, 1, M, L), zshape)
+            z = np.ma.masked_where(zm, z)
+        return z.squeeze()
     # return results
     if only_rho:
-        return make_z_rho(h, zeta, S, N, M, L)
+        return make_z(S['s_rho'], S['Cs_r'], N, out)
     elif only_w:
-        return make_z_w(h, zeta, S, N, M, L)
-    else :
-        return make_z_rho(h, zeta, S, N, M, L), make_z_w(h, zeta, S, N, M, L)
+        return make_z(S['s_w'], S['Cs_w'], N+1, out)
+    else:
+        if out is None:
+            out = (None, None)
+        return make_z(S['s_rho'], S['Cs_r'], N, out[0]), make_z(S['s_w'], S['Cs_w'], N+1, out[1])
     
 def get_S(S_info_dict):
     """
@@ -0,0 +1,80 @@
+"""
+Code to test zfun.get_interpolant(), which was recoded to use a binary search
+(np.searchsorted) instead of making an [len(x), len(xvec)] matrix.
+
+It checks that the results are identical to the original version (copied
+below as get_interpolant_old()) for a set of regression cases, including the
+edge cases described in the docstring, and then compares the speed.
+
+RESULT: identical for all cases, and much faster and lighter for large x.
+
+"""
+
+import numpy as np
+from time import time
+
+from lo_tools import zfun
+from importlib import reload
+reload(zfun)
+
+def get_interpolant_old(x, xvec):
+    # original version, without the warnings
+    x = x.flatten()
+    xvec = xvec.flatten()
+    nx = len(x)
+    nxvec = len(xvec)
+    X = x.reshape(nx, 1) # column vector
+    xvec = xvec.reshape(1, nxvec)
+    XVEC = xvec.repeat(nx, axis=0) # matrix
+    mask = X >= XVEC
+    i0 = mask.sum(axis=1) - 1
+    lomask = i0 < 0
+    himask = i0 > nxvec - 2
+    i0[lomask] = 0
+    i0[himask] = nxvec - 2
+    i1 = i0 + 1
+    xvec0 = xvec[0,i0]
+    xvec1 = xvec[0,i1]
+    fr = (x - xvec0)/(xvec1 - xvec0)
+    fr[lomask] = np.nan
+    fr[himask] = np.nan
+    fr[X[:,0]==XVEC[0,-1]] = 1.0
+    return i0, i1, fr
+
+xvec = np.array([0., 1., 2.5, 3., 10.])
+case_dict = {
+    'inside': (np.array([0.5, 1.7, 2.9, 9.]), xvec),
+    'on points': (xvec.copy(), xvec),
+    'below range': (np.array([-5., -0.001]), xvec),
+    'above range': (np.array([10.001, 50.]), xvec),
+    'last point': (np.array([10.]), xvec),
+    'nan in x': (np.array([np.nan, 1.5, np.nan]), xvec),
+    '2D x': (np.array([[0.5, 11.], [-1., 3.]]), xvec),
+    'integer x': (np.array([0, 1, 2, 3, 10, 11]), xvec),
+    'x same length as xvec': (np.array([4., 0.2, 2.6, 10., -1.]), xvec),
+    'two point xvec': (np.array([-1., 0., 0.5, 1., 2.]), np.array([0., 1.])),
+    'random': (np.random.uniform(-2, 12, 10000), np.sort(np.random.uniform(0, 10, 300))),
+    }
+
+all_good = True
+for case in case_dict.keys():
+    x, xv = case_dict[case]
+    a0, a1, afr = get_interpolant_old(x, xv)
+    b0, b1, bfr = zfun.get_interpolant(x, xv, show_warnings=False)
+    good = (np.array_equal(a0, b0) and np.array_equal(a1, b1)
+        and np.array_equal(afr, bfr, equal_nan=True))
+    all_good = all_good and good
+    print('%25s: %s' % (case, 'PASS' if good else 'FAIL'))
+print('All cases identical = ' + str(all_good))
+
+# speed test
+xvec = np.linspace(-130, -122, 1000)
+for nx in [1000, 10000, 100000]:
+    x = np.random.uniform(-131, -121, nx)
+    tt0 = time()
+    get_interpolant_old(x, xvec)
+    t_old = time() - tt0
+    tt0 = time()
+    zfun.get_interpolant(x, xvec, show_warnings=False)
+    t_new = time() - tt0
+    print('nx = %6d, nxvec = %d: old %0.4f sec, new %0.4f sec' % (nx, len(xvec), t_old, t_new))
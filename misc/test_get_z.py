@@ -0,0 +1,132 @@
+"""
+Code to test zrfun.get_z(), which was recoded to broadcast h and zeta against
+the S-coordinate vectors one level at a time instead of using np.tile.
+
+It checks that the results are identical to the original version (copied
+below as get_z_old()) for hc = 0 and both Vtransforms, for 2-D and vector
+input, and then tests the new options: a leading time dimension on zeta,
+dtype=np.float32, and the out= buffer (including that a bad one raises a
+ValueError). Last it compares the speed.
+
+RESULT: identical for all cases, and faster and lighter on memory.
+
+"""
+
+import numpy as np
+from time import time
+
+from lo_tools import zrfun
+from importlib import reload
+reload(zrfun)
+
+def get_z_old(h, zeta, S, only_rho=False, only_w=False):
+    # original version, without the input checks
+    N = S['N']
+    h = np.atleast_2d(h.squeeze())
+    zeta = np.atleast_2d(zeta.squeeze())
+    M, L = h.shape
+    def make_z(Cs, s, NZ):
+        Cs = np.tile(Cs.reshape(NZ, 1, 1), [1, M, L])
+        H = np.tile(h.reshape(1, M, L), [NZ, 1, 1])
+        Zeta = np.tile(zeta.reshape(1, M, L), [NZ, 1, 1])
+        if S['hc'] == 0:
+            z = H*Cs + Zeta + Zeta*Cs
+        else:
+            S_ = np.tile(s.reshape(NZ, 1, 1), [1, M, L])
+            Hc = np.tile(S['hc'], [NZ, M, L])
+            if S['Vtransform'] == 1:
+                z0 = (S_ - Cs) * Hc + Cs*H
+                z = z0 + Zeta * (1 + z0/H)
+            elif S['Vtransform'] == 2:
+                z0 = (S_*Hc + Cs*H) / (Hc + H)
+                z = Zeta + (Zeta + H)*z0
+        return z.squeeze()
+    if only_rho:
+        return make_z(S['Cs_r'], S['s_rho'], N)
+    elif only_w:
+        return make_z(S['Cs_w'], S['s_w'], N+1)
+    else:
+        return make_z(S['Cs_r'], S['s_rho'], N), make_z(S['Cs_w'], S['s_w'], N+1)
+
+def make_S(N, hc, Vtransform):
+    S_info_dict = {'VTRANSFORM':Vtransform, 'VSTRETCHING':4, 'THETA_S':4,
+        'THETA_B':2, 'TCLINE':hc, 'N':N}
+    S = zrfun.get_S(S_info_dict)
+    S['hc'] = np.array(float(hc)) # like S from get_basic_info()
+    return S
+
+M = 60; L = 40; N = 30
+h = np.random.uniform(4, 300, (M, L))
+zeta = np.random.uniform(-2, 2, (M, L))
+
+all_good = True
+for hc, Vt in [(0, 2), (10, 1), (10, 2)]:
+    S = make_S(N, hc, Vt)
+    for tag, hh, zz in [('2D', h, zeta), ('vector', h[:,0], zeta[:,0]),
+            ('column (VL,1)', h[:,:1], zeta[:,:1]), ('point', h[:1,:1], zeta[:1,:1])]:
+        a_r, a_w = get_z_old(hh, zz, S)
+        b_r, b_w = zrfun.get_z(hh, zz, S)
+        good = (np.array_equal(a_r, b_r) and np.array_equal(a_w, b_w)
+            and np.array_equal(a_r, zrfun.get_z(hh, zz, S, only_rho=True))
+            and np.array_equal(a_w, zrfun.get_z(hh, zz, S, only_w=True)))
+        all_good = all_good and good
+        print('hc = %2d Vtransform = %d %15s: %s' % (hc, Vt, tag, 'PASS' if good else 'FAIL'))
+
+    # leading time dimension on zeta
+    NT = 5
+    zeta_t = np.random.uniform(-2, 2, (NT, M, L))
+    b_r, b_w = zrfun.get_z(h, zeta_t, S)
+    good = (b_r.shape == (NT, N, M, L)) and (b_w.shape == (NT, N+1, M, L))
+    for tt in range(NT):
+        a_r, a_w = get_z_old(h, zeta_t[tt,:,:], S)
+        good = good and np.array_equal(a_r, b_r[tt]) and np.array_equal(a_w, b_w[tt])
+    all_good = all_good and good
+    print('hc = %2d Vtransform = %d %15s: %s' % (hc, Vt, 'time series', 'PASS' if good else 'FAIL'))
+
+    # out= buffers, reused
+    zr = np.empty((N, M, L)); zw = np.empty((N+1, M, L))
+    for ii in range(2):
+        r, w = zrfun.get_z(h, zeta, S, out=(zr, zw))
+    a_r, a_w = get_z_old(h, zeta, S)
+    good = (r is zr) and (w is zw) and np.array_equal(a_r, zr) and np.array_equal(a_w, zw)
+    all_good = all_good and good
+    print('hc = %2d Vtransform = %d %15s: %s' % (hc, Vt, 'out=', 'PASS' if good else 'FAIL'))
+
+    # bad out= buffers must raise a ValueError, not be silently ignored
+    good = True
+    for bad in [np.empty((L, M, N)).T, np.empty((N, M, L+1))]:
+        try:
+            zrfun.get_z(h, zeta, S, only_rho=True, out=bad)
+            good = False
+        except ValueError:
+            pass
+    all_good = all_good and good
+    print('hc = %2d Vtransform = %d %15s: %s' % (hc, Vt, 'bad out=', 'PASS' if good else 'FAIL'))
+
+    # float32
+    b_r = zrfun.get_z(h, zeta, S, only_rho=True, dtype=np.float32)
+    good = (b_r.dtype == np.float32) and (np.abs(b_r - a_r).max() < 1e-3)
+    all_good = all_good and good
+    print('hc = %2d Vtransform = %d %15s: %s' % (hc, Vt, 'float32', 'PASS' if good else 'FAIL'))
+print('All cases good = ' + str(all_good))
+
+# speed test, for a grid about the size of cas7
+S = make_S(30, 10, 2)
+M = 1302; L = 663
+h = np.random.uniform(4, 300, (M, L))
+zeta = np.random.uniform(-2, 2, (M, L))
+tt0 = time()
+get_z_old(h, zeta, S)
+t_old = time() - tt0
+tt0 = time()
+zrfun.get_z(h, zeta, S)
+t_new = time() - tt0
+zr = np.empty((30, M, L)); zw = np.empty((31, M, L))
+tt0 = time()
+zrfun.get_z(h, zeta, S, out=(zr, zw))
+t_out = time() - tt0
+tt0 = time()
+zrfun.get_z(h, zeta, S, dtype=np.float32)
+t_32 = time() - tt0
+print('M = %d, L = %d, N = 30: old %0.3f sec, new %0.3f sec, new out= %0.3f sec, new float32 %0.3f sec'
+    % (M, L, t_old, t_new, t_out, t_32))
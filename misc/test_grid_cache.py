@@ -0,0 +1,73 @@
+"""
+Code to test zrfun.get_basic_info_cached(), comparing its output to
+zrfun.get_basic_info() and timing the first (build) and later (load) calls.
+
+Run with the full path to any ROMS history file, e.g.:
+run test_grid_cache.py -fn /Users/pm8/Documents/LO_roms/cas7_t0_x4b/f2017.07.04/ocean_his_0002.nc
+
+RESULT: identical output. For a compressed file with a cas7-sized grid:
+get_basic_info() 0.59 sec, build 1.57 sec, load with check=True 0.20 sec,
+and load with check=False 0.03 sec. Concurrent calls from many processes,
+starting from no cache, all get the same output.
+
+"""
+
+import argparse
+import multiprocessing as mp
+import numpy as np
+import shutil
+from time import time
+from pathlib import Path
+
+from lo_tools import Lfun, zrfun
+from importlib import reload
+reload(zrfun)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-fn', type=str) # full path to a history file
+args = parser.parse_args()
+fn = Path(args.fn)
+
+# start from no cache
+gtagex = fn.parent.parent.name
+shutil.rmtree(Lfun.Ldir['LOo'] / 'grid_cache' / gtagex, ignore_errors=True)
+
+tt0 = time()
+G0, S0, T0 = zrfun.get_basic_info(fn)
+print('get_basic_info() took %0.4f sec' % (time()-tt0))
+tt0 = time()
+G, S, T = zrfun.get_basic_info_cached(fn)
+print('get_basic_info_cached() build took %0.4f sec' % (time()-tt0))
+for check in [True, False]:
+    tt0 = time()
+    G, S, T = zrfun.get_basic_info_cached(fn, check=check)
+    print('get_basic_info_cached() load with check=%s took %0.4f sec' % (check, time()-tt0))
+
+good = (all([np.array_equal(G0[k], G[k]) for k in G0.keys()])
+    and all([np.array_equal(S0[k], S[k]) for k in S0.keys()])
+    and (T == T0))
+good = good and np.array_equal(G['z_w0'], zrfun.get_z(G0['h'], 0*G0['h'], S0, only_w=True))
+print('Output identical = ' + str(good))
+
+# changing the loaded arrays must not change the cache
+G['h'][0,0] = -99
+G, S, T = zrfun.get_basic_info_cached(fn)
+print('Cache unchanged = ' + str(G['h'][0,0] == G0['h'][0,0]))
+
+# many processes at once, starting from no cache: the ones with check=True
+# make (or find) the cache, and the ones with check=False wait for it
+def one_call(ii):
+    check = (ii % 2 == 0)
+    G, S, T = zrfun.get_basic_info_cached(fn, check=check)
+    return all([np.array_equal(G0[k], G[k]) for k in G0.keys()])
+shutil.rmtree(Lfun.Ldir['LOo'] / 'grid_cache' / gtagex, ignore_errors=True)
+with mp.get_context('fork').Pool(8) as pool:
+    res_list = pool.map(one_call, range(16))
+print('Concurrent calls all identical = ' + str(all(res_list)))
+
+# check=False must not make a cache, and fails if there is none
+try:
+    zrfun.get_basic_info_cached(fn, gtagex='no_such_gtagex', check=False, wait_sec=1)
+    print('check=False with no cache: FAIL (no error)')
+except RuntimeError as e:
+    print('check=False with no cache raised RuntimeError: ' + str(e))
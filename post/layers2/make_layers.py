@@ -84,21 +84,29 @@ do_carbon = True
 if 'TIC' not in vn_in_list:
     do_carbon = False
 
-# create zfull to use with the pfun.get_laym() function
+# create zfull to use with the pfun.get_layms() function
 zfull = pfun.get_zfull(in_ds, in_fn, 'rho')
 in_mask_rho = in_ds.mask_rho.values # 1 = water, 0 = land
 # account for WET_DRY
 if 'wetdry_mask_rho' in in_ds.data_vars:
     in_mask_rho = in_ds.wetdry_mask_rho[0,:,:].values.squeeze()
 
-def get_layer(vn, depth, in_ds, zfull, in_mask_rho):
+# Make the layers at all the z levels for all variables at once. The vertical
+# interpolation weights are found once and then used for every variable.
+tt0 = time()
+z_depth_list = [depth for depth in depth_list if depth not in ['surface', 'bottom']]
+lay_dict = pfun.get_layms(in_ds, zfull, in_mask_rho, vn_in_list,
+    [-float(depth) for depth in z_depth_list])
+if testing:
+    print(' - make z layers took %0.2f sec' % (time()-tt0))
+
+def get_layer(vn, depth, in_ds, lay_dict):
     if depth == 'surface':
         L = in_ds[vn][0,-1,:,:].values
     elif depth == 'bottom':
         L = in_ds[vn][0,0,:,:].values
     else:
-        L = pfun.get_laym(in_ds, zfull, in_mask_rho, vn, -float(depth))
-            
+        L = lay_dict[vn][z_depth_list.index(depth),:,:]
     return L
 
 def get_Ld(depth, in_ds, in_mask_rho):
@@ -120,7 +128,7 @@ for depth in depth_list:
     v_dict = dict()
     tt0 = time()
     for vn in vn_in_list:
-        v_dict[vn] = get_layer(vn, depth, in_ds, zfull, in_mask_rho)
+        v_dict[vn] = get_layer(vn, depth, in_ds, lay_dict)
     if testing:
         print('   -- fill v_dict took %0.2f sec' % (time()-tt0))
         
@@ -0,0 +1,80 @@
+"""
+Code to compare the accuracy and cost of the two interpolation methods
+in trackfun: nearest neighbor ('nn', using the KDTrees or the grid locator)
+and linear ('lin').
+
+It makes smooth analytic fields on the rho, u, and w grids, interpolates them
+to random particle positions, and compares with the exact values.
+
+It uses LO_output/tracks/exp_info.csv so you have to have done a tracker run
+first, and the trees have to exist for that grid.
+
+Run from the command line as:
+
+python test_interp.py
+
+To see the effect on tracks, run tracker.py with -interp nn and -interp lin
+at a few values of -ndiv and compare the results.
+
+"""
+
+import numpy as np
+from time import time
+
+from lo_tools import Lfun, zrfun
+Ldir = Lfun.Lstart()
+
+tfun = Lfun.module_from_file('trackfun', Ldir['LO'] / 'tracker' / 'trackfun.py')
+G = tfun.G
+S = tfun.S
+
+NP = 100000
+
+# random positions within a grid cell of water points, at random fractional depth
+np.random.seed(0)
+ii = np.random.randint(0, len(tfun.lonrf), NP)
+plon = tfun.lonrf[ii] + (np.random.rand(NP) - 0.5)*tfun.dxg
+plat = tfun.latrf[ii] + (np.random.rand(NP) - 0.5)*tfun.dyg
+pcs = -np.random.rand(NP)
+
+# a smooth field with a few grid cells per wavelength
+kx = 2*np.pi/(20*tfun.dxg)
+ky = 2*np.pi/(20*tfun.dyg)
+def ff(lon, lat, cs):
+    return np.sin(kx*lon)*np.cos(ky*lat)*(1 + cs)
+
+h = G['h']
+for tag in ['rho', 'u', 'rho3', 'w3']:
+    # make the masked, flattened field
+    gtag = tag.replace('3','')
+    if gtag == 'w':
+        gtag = 'rho'
+    lon = G['lon_' + gtag]
+    lat = G['lat_' + gtag]
+    mask = G['mask_' + gtag] == 1
+    if gtag == 'u':
+        hh = (h[:,:-1] + h[:,1:])/2
+    else:
+        hh = h
+    if tag[-1] == '3':
+        z = zrfun.get_z(hh, 0*hh, S, only_w=(tag=='w3'), only_rho=(tag!='w3'))
+        fld = ff(lon, lat, z/hh)
+        fldf = fld[np.tile(mask, [z.shape[0],1,1])]
+        truth = ff(plon, plat, pcs)
+    else:
+        fld = ff(lon, lat, 0)
+        fldf = fld[mask]
+        truth = ff(plon, plat, 0)
+    for interp in ['nn', 'lin']:
+        tfun.interp = interp
+        ix = tfun.get_ix(plon, plat, pcs)
+        tt0 = time()
+        fi = tfun.get_val(fldf, ix, tag)
+        t_first = time() - tt0
+        # the second call uses the cached indices and weights
+        tt0 = time()
+        fi = tfun.get_val(fldf, ix, tag)
+        t_second = time() - tt0
+        err = np.abs(fi - truth)
+        print('%4s %3s: rms error %0.4f, max error %0.4f, first call %0.3f sec, second call %0.4f sec' %
+            (tag, interp, np.sqrt(np.mean(err**2)), err.max(), t_first, t_second))
@@ -0,0 +1,57 @@
+"""
+Code to test that trackfun.get_nn_grid() finds the same nearest neighbor
+indices as the KDTrees, for random particle positions over the water.
+
+It uses LO_output/tracks/exp_info.csv so you have to have done a tracker run
+first, and the trees have to exist for that grid.
+
+It stops with an AssertionError if the indices differ in 2D, or in 3D
+when hc = 0.
+
+Run from the command line as:
+
+python test_locator.py
+
+"""
+
+import numpy as np
+from time import time
+
+from lo_tools import Lfun
+Ldir = Lfun.Lstart()
+
+tfun = Lfun.module_from_file('trackfun', Ldir['LO'] / 'tracker' / 'trackfun.py')
+
+NP = 100000
+
+# random positions within a grid cell of water points, at random fractional depth
+G = tfun.G
+np.random.seed(0)
+ii = np.random.randint(0, len(tfun.lonrf), NP)
+plon = tfun.lonrf[ii] + (np.random.rand(NP) - 0.5)*tfun.dxg
+plat = tfun.latrf[ii] + (np.random.rand(NP) - 0.5)*tfun.dyg
+pcs = -np.random.rand(NP)
+
+# In 2D the indices must always be identical. In 3D they must be identical
+# when hc = 0, and otherwise they can differ near cell edges (see README.md),
+# so then we only report the percentage that match.
+exact_3d = (tfun.S['hc'] == 0)
+all_good = True
+for tag in ['rho_un', 'rho', 'u', 'v', 'rho3', 'u3', 'v3', 'w3']:
+    ix = tfun.get_ix(plon, plat, pcs)
+    tt0 = time()
+    nn_tree = tfun.get_nn_tree(ix, tag)
+    t_tree = time() - tt0
+    tt0 = time()
+    nn_grid = tfun.get_nn_grid(ix, tag)
+    t_grid = time() - tt0
+    match = (nn_tree == nn_grid).mean()
+    if (tag[-1] != '3') or exact_3d:
+        good = np.array_equal(nn_tree, nn_grid)
+        all_good = all_good and good
+        result = 'PASS' if good else 'FAIL (%7.3f%% match)' % (100*match)
+    else:
+        result = '%7.3f%% match (hc > 0)' % (100*match)
+    print('%6s: %s, tree %0.3f sec, grid %0.3f sec' % (tag, result, t_tree, t_grid))
+print('All required matches good = ' + str(all_good))
+assert all_good, 'get_nn_grid() does not match the KDTrees'
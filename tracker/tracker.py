@@ -117,6 +117,28 @@ parser.add_argument('-ndiv', default=12, type=int)
 parser.add_argument('-sph', default=1, type=int)
 # sph = saves per hour, a new argument to allow more frequent writing of output.
 
+# how to find nearest neighbors: 'tree' uses the KDTrees from make_KDTrees.py,
+# 'grid' uses index arithmetic on the plaid grid (see trackfun.get_nn_grid())
+parser.add_argument('-loc', '--locator', default='tree', type=str)
+
+# how to interpolate fields to the particles: 'nn' is nearest neighbor,
+# 'lin' is bilinear in lon, lat and linear in fractional z (see trackfun.get_lin())
+# Because the velocity is smoother with 'lin' you may be able to use a smaller ndiv.
+parser.add_argument('-interp', default='nn', type=str)
+
+# read the next history file in a background thread while integrating the current hour
+parser.add_argument('-prefetch', default=True, type=zfun.boolean_string)
+
+# Use Nproc > 1 to split the particles into Nproc chunks, tracked in separate processes.
+# The fields are read once and shared through memory-mapped files in [outdir]/field_cache.
+parser.add_argument('-Nproc', default=1, type=int)
+
+# Output is written as it is made, in blocks of save_block saves (0 means one day).
+# Use -float32 True and/or -compress True to make smaller output files.
+parser.add_argument('-save_block', default=0, type=int)
+parser.add_argument('-float32', default=False, type=zfun.boolean_string)
+parser.add_argument('-compress', default=False, type=zfun.boolean_string)
+
 args = parser.parse_args()
 TR = args.__dict__ 
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -175,10 +197,20 @@ if TR['stay'] > 0:
 if TR['stay'] < 0:
     print('Error: negative stay depth not allowed')
     sys.exit()
+if TR['locator'] not in ['tree', 'grid']:
+    print('Error: unknown locator ' + TR['locator'])
+    sys.exit()
+if TR['interp'] not in ['nn', 'lin']:
+    print('Error: unknown interp ' + TR['interp'])
+    sys.exit()
 if TR['no_advection'] == True:
     out_name += '_nadv'
 if TR['ndiv'] != 12: # only mention ndiv if it is NOT 12
     out_name += '_ndiv' + str(TR['ndiv'])
+if TR['locator'] != 'tree': # only mention locator if it is NOT tree
+    out_name += '_' + TR['locator']
+if TR['interp'] != 'nn': # only mention interp if it is NOT nn
+    out_name += '_' + TR['interp']
 if len(TR['sub_tag']) > 0:
     out_name += '_' + TR['sub_tag']
 
@@ -249,7 +281,9 @@ for idt0 in idt_list:
     out_fn = outdir / outname
     
     # we do the calculation in one-day segments, but write complete
-    # output for a release to a single NetCDF file.
+    # output for a release to a single NetCDF file, as we go.
+    W = tfnc.start_writer(out_fn, float32=TR['float32'], compress=TR['compress'],
+        NB=TR['save_block'])
     for nd in range(TR['days_to_track']):
         
         # get or replace the history file list for this day
@@ -280,17 +314,26 @@ for idt0 in idt_list:
             # do the tracking
             if TR['start_hour'] > 0:
                 fn_list = fn_list[TR['start_hour']:]
-            P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=True)
-            # save the results to NetCDF
-            tfnc.start_outfile(out_fn, P)
+            if TR['Nproc'] > 1:
+                P = tfun.get_tracks_parallel(fn_list, plon0, plat0, pcs0, TR,
+                    outdir / 'field_cache', trim_loc=True)
+                tfnc.write_block(W, P)
+            else:
+                # this writes the results to NetCDF as it goes
+                P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=True, W=W)
         else: # subsequent days
             # set IC
             plon0 = P['lon'][-1,:]
             plat0 = P['lat'][-1,:]
             pcs0 = P['cs'][-1,:]
             # do the tracking
-            P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR)
-            tfnc.append_to_outfile(out_fn, P)
+            if TR['Nproc'] > 1:
+                P = tfun.get_tracks_parallel(fn_list, plon0, plat0, pcs0, TR,
+                    outdir / 'field_cache')
+                tfnc.write_block(W, P, skip_first=True)
+            else:
+                P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR, W=W)
+    tfnc.close_writer(W)
         
     print(' - Took %0.1f sec for %s day(s)' %
             (time() - tt0, str(TR['days_to_track'])))
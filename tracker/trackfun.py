@@ -7,6 +7,7 @@ LO_output/tracks/exp_info.csv.
 """
 # setup (assume path to alpha set by calling code)
 from lo_tools import Lfun, zfun, zrfun
+import trackfun_nc as tfnc
 
 import numpy as np
 import xarray as xr
@@ -14,6 +15,11 @@ from scipy.spatial import cKDTree
 import pickle
 from time import time
 import sys
+import queue
+import threading
+import multiprocessing as mp
+import shutil
+import traceback
 
 verbose = False
 
@@ -48,18 +54,52 @@ Maskr3 = np.tile(Maskr.reshape(1,G['M'],G['L']),[S['N'],1,1])
 Masku3 = np.tile(Masku.reshape(1,G['M'],G['L']-1),[S['N'],1,1])
 Maskv3 = np.tile(Maskv.reshape(1,G['M']-1,G['L']),[S['N'],1,1])
 Maskw3 = np.tile(Maskr.reshape(1,G['M'],G['L']),[S['N']+1,1,1])
-# load pre-made trees
+# Choice of how to find nearest neighbors:
+# 'tree' = query the pre-made KDTrees
+# 'grid' = index arithmetic on the plaid grid, see get_nn_grid()
+locator = TR0['locator']
+
+# Choice of how to interpolate fields to the particle positions:
+# 'nn' = nearest neighbor
+# 'lin' = bilinear in lon, lat and linear in fractional z, see get_lin()
+interp = TR0['interp']
+
+# pre-made trees, organized by the tags used by get_nn()
 tree_dir = Ldir['LOo'] / 'tracker_trees' / TR0['gridname']
-# 2D
-xyT_rho = pickle.load(open(tree_dir / 'xyT_rho.p', 'rb'))
-xyT_u = pickle.load(open(tree_dir / 'xyT_u.p', 'rb'))
-xyT_v = pickle.load(open(tree_dir / 'xyT_v.p', 'rb'))
-xyT_rho_un = pickle.load(open(tree_dir / 'xyT_rho_un.p', 'rb'))
-# 3D
-xyzT_rho = pickle.load(open(tree_dir / 'xyzT_rho.p', 'rb'))
-xyzT_u = pickle.load(open(tree_dir / 'xyzT_u.p', 'rb'))
-xyzT_v = pickle.load(open(tree_dir / 'xyzT_v.p', 'rb'))
-xyzT_w = pickle.load(open(tree_dir / 'xyzT_w.p', 'rb'))
+tree_fn_dict = {'rho':'xyT_rho.p', 'u':'xyT_u.p', 'v':'xyT_v.p', 'rho_un':'xyT_rho_un.p',
+    'rho3':'xyzT_rho.p', 'u3':'xyzT_u.p', 'v3':'xyzT_v.p', 'w3':'xyzT_w.p'}
+tree_dict = dict()
+def get_tree(tag):
+    # load a pre-made tree the first time it is needed
+    if tag not in tree_dict.keys():
+        tree_dict[tag] = pickle.load(open(tree_dir / tree_fn_dict[tag], 'rb'))
+    return tree_dict[tag]
+if locator == 'tree':
+    for tag in tree_fn_dict.keys():
+        get_tree(tag)
+# With locator = 'grid' the trees are only loaded if some particle has a
+# masked nearest grid point, which mostly happens for u and v near the coast.
+
+def make_loc(lon, lat, mask, hh):
+    # pack the grid info used by get_nn_grid() for one type of grid point
+    gl = dict()
+    gl['xvec'] = lon[0,:]
+    gl['yvec'] = lat[:,0]
+    gl['NC'] = lon.shape[1]
+    # lookup from an index into the flattened full field to an index into
+    # the masked field (the ordering used by the trees), -1 on land
+    gl['lookup'] = -np.ones(mask.size, dtype=int)
+    gl['lookup'][mask.flatten()] = np.arange(mask.sum())
+    gl['NW'] = mask.sum() # number of water points in a layer
+    # bottom depth used to make the fractional z of the 3D trees
+    gl['hf'] = hh.flatten()
+    return gl
+h = G['h']
+loc_dict = {'rho': make_loc(G['lon_rho'], G['lat_rho'], Maskr, h),
+    'u': make_loc(G['lon_u'], G['lat_u'], Masku, (h[:,:-1] + h[:,1:])/2),
+    'v': make_loc(G['lon_v'], G['lat_v'], Maskv, (h[:-1,:] + h[1:,:])/2)}
+loc_dict['w'] = loc_dict['rho']
+
 # the "f" below refers to flattened, which is the result of passing
 # a Boolean array like Maskr to an array.
 lonrf = G['lon_rho'][Maskr]
@@ -70,9 +110,14 @@ maskr = Maskr.flatten()
 dxg = np.diff(G['lon_rho'][0,:]).min()
 dyg = np.diff(G['lat_rho'][:,0]).min()
 
-def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
+def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False, W=None):
     """
     This is the main function doing the particle tracking.
+    
+    The results are returned in a dict P of arrays.  If you pass W, a writer
+    from trackfun_nc.start_writer(), the results are instead written to the
+    output file in blocks of W['NB'] saves as they are made, and P only has the
+    last block.  Either way P['lon'][-1,:] etc. are the final positions.
     """
     # unpack items needed from TR
     surface = not TR['3d']
@@ -95,6 +140,12 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
     delt = delta_t_his/ndiv # time step in seconds
     delt_save = delta_t_his/TR['sph']
     rot_save = np.linspace(rot[0], rot[-1], NTS)
+    
+    # number of saves held in memory at one time
+    if (W is None) or (W['NB'] == 0):
+        NB = NTS
+    else:
+        NB = min(W['NB'], NTS)
 
     # these lists are used internally to get other variables as needed
     # (the variables must all be present in the history files)
@@ -107,6 +158,10 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
     # plist_main is what ends up written to output
     plist_main = ['lon', 'lat', 'cs', 'ot', 'z'] + vn_list_other
     
+    # Start reading the fields from the history files (in the background
+    # if TR['prefetch'] is True).
+    field_iter = get_field_iter(fn_list, TR)
+    
     # Step through times.
     #
     for counter_his in range(len(fn_list)-1):
@@ -117,178 +172,44 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                 
         it0 = TR['sph']*counter_his
         
-        # get Datasets
-        fn0 = fn_list[counter_his]
-        fn1 = fn_list[counter_his+1]
-        
-        ds0 = xr.open_dataset(fn0)
-        ds1 = xr.open_dataset(fn1)
-        
-        # prepare the fields for nearest neighbor interpolation
+        # get the fields for this pair of history files
         tt0 = time()
         if counter_his == 0:
             h = G['h']
             hf = h[Maskr]
-            if surface == True:
-                u0 = ds0['u'][0,-1,:,:].values
-                u1 = ds1['u'][0,-1,:,:].values
-                uf0 = u0[Masku]
-                uf1 = u1[Masku]
-                v0 = ds0['v'][0,-1,:,:].values
-                v1 = ds1['v'][0,-1,:,:].values
-                vf0 = v0[Maskv]
-                vf1 = v1[Maskv]
-                wf0 = 0; wf1 = 0
-                
-                trf0_dict = dict()
-                trf1_dict = dict()
-                for vn in tracer_list:
-                    tr0 = ds0[vn][0,-1,:,:].values
-                    tr1 = ds1[vn][0,-1,:,:].values
-                    trf0_dict[vn] = tr0[Maskr]
-                    trf1_dict[vn] = tr1[Maskr]
-                
-                if windage > 0:
-                    Uwind0 = ds0['Uwind'][0,:,:].values
-                    Uwind1 = ds1['Uwind'][0,:,:].values
-                    Uwindf0 = Uwind0[Maskr]
-                    Uwindf1 = Uwind1[Maskr]
-                    Vwind0 = ds0['Vwind'][0,:,:].values
-                    Vwind1 = ds1['Vwind'][0,:,:].values
-                    Vwindf0 = Vwind0[Maskr]
-                    Vwindf1 = Vwind1[Maskr]
-            else:
-                u0 = ds0['u'][0,:,:,:].values
-                u1 = ds1['u'][0,:,:,:].values
-                uf0 = u0[Masku3]
-                uf1 = u1[Masku3]
-                v0 = ds0['v'][0,:,:,:].values
-                v1 = ds1['v'][0,:,:,:].values
-                vf0 = v0[Maskv3]
-                vf1 = v1[Maskv3]
-                w0 = ds0['w'][0,:,:,:].values
-                w1 = ds1['w'][0,:,:,:].values
-                wf0 = w0[Maskw3]
-                wf1 = w1[Maskw3]
-                
-                trf0_dict = dict()
-                trf1_dict = dict()
-                for vn in tracer_list:
-                    tr0 = ds0[vn][0,:,:,:].values
-                    tr1 = ds1[vn][0,:,:,:].values
-                    trf0_dict[vn] = tr0[Maskr3]
-                    trf1_dict[vn] = tr1[Maskr3]
-                    
-                if turb == True:
-                    AKs0_temp = ds0['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs0_temp[0,:,:] = AKs0_temp[1,:,:]
-                    AKs0_temp[-1,:,:] = AKs0_temp[-2,:,:]
-                    AKs0 = AKs0_temp.copy()
-                    AKs0[1:-1,:,:] = 0.25*AKs0_temp[:-2,:,:] + 0.5*AKs0_temp[1:-1,:,:] + 0.25*AKs0_temp[2:,:,:]
-                    AKsf0 = AKs0[Maskw3]
-                    #
-                    AKs1_temp = ds1['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs1_temp[0,:,:] = AKs1_temp[1,:,:]
-                    AKs1_temp[-1,:,:] = AKs1_temp[-2,:,:]
-                    AKs1 = AKs1_temp.copy()
-                    AKs1[1:-1,:,:] = 0.25*AKs1_temp[:-2,:,:] + 0.5*AKs1_temp[1:-1,:,:] + 0.25*AKs1_temp[2:,:,:]
-                    AKsf1 = AKs1[Maskw3]
-                    #
-                    # New 2022.11.14 use time-varying dz
-                    zeta0 = ds0['zeta'].values #jx
-                    zeta1 = ds1['zeta'].values #jx
-                    zw0 = zrfun.get_z(G['h'], zeta0, S, only_w=True) #jx
-                    zw1 = zrfun.get_z(G['h'], zeta1, S, only_w=True) #jx
-                    dz0 = np.diff(zw0, axis=0) #jx
-                    dz1 = np.diff(zw1, axis=0) #jx
-                    dKdz0 = np.diff(AKs0, axis=0)/dz0 #jx
-                    dKdz1 = np.diff(AKs1, axis=0)/dz1 #jx
-                    dKdzf0 = dKdz0[Maskr3]
-                    dKdzf1 = dKdz1[Maskr3]
-                    
-                    
-            z0 = ds0['zeta'][0,:,:].values
-            z1 = ds1['zeta'][0,:,:].values
-            zf0 = z0[Maskr]
-            zf1 = z1[Maskr]
-            if verbose:
-                print('   > Prepare fields for tree %0.4f sec' % (time()-tt0))
+            F0 = next(field_iter)
+            F1 = next(field_iter)
         else:
-            # subsequent time steps
-            if surface == True:
-                u1 = ds1['u'][0,-1,:,:].values
-                uf0 = uf1.copy()
-                uf1 = u1[Masku]
-                v1 = ds1['v'][0,-1,:,:].values
-                vf0 = vf1.copy()
-                vf1 = v1[Maskv]
-                wf0 = 0; wf1 = 0
-                
-                for vn in tracer_list:
-                    tr1 = ds1[vn][0,-1,:,:].values
-                    trf0_dict[vn] = trf1_dict[vn].copy()
-                    trf1_dict[vn] = tr1[Maskr]
-                
-                if windage > 0:
-                    Uwind1 = ds1['Uwind'][0,:,:].values
-                    Uwindf0 = Uwindf1
-                    Uwindf1 = Uwind1[Maskr]
-                    Vwind1 = ds1['Vwind'][0,:,:].values
-                    Vwindf0 = Vwindf1
-                    Vwindf1 = Vwind1[Maskr]
-            else:
-                if TR['no_advection'] == False:
-                    u1 = ds1['u'][0,:,:,:].values
-                    uf0 = uf1.copy()
-                    uf1 = u1[Masku3]
-                    v1 = ds1['v'][0,:,:,:].values
-                    vf0 = vf1.copy()
-                    vf1 = v1[Maskv3]
-                    w1 = ds1['w'][0,:,:,:].values
-                    wf0 = wf1.copy()
-                    wf1 = w1[Maskw3]
-                    
-                    for vn in tracer_list:
-                        tr1 = ds1[vn][0,:,:,:].values
-                        trf0_dict[vn] = trf1_dict[vn].copy()
-                        trf1_dict[vn] = tr1[Maskr3]
-                    
-                if turb == True:
-                    AKsf0 = AKsf1.copy()
-                    #
-                    AKs1_temp = ds1['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs1_temp[0,:,:] = AKs1_temp[1,:,:]
-                    AKs1_temp[-1,:,:] = AKs1_temp[-2,:,:]
-                    AKs1 = AKs1_temp.copy()
-                    AKs1[1:-1,:,:] = 0.25*AKs1_temp[:-2,:,:] + 0.5*AKs1_temp[1:-1,:,:] + 0.25*AKs1_temp[2:,:,:]
-                    AKsf1 = AKs1[Maskw3]
-                    #
-                    dKdzf0 = dKdzf1.copy()
-                    # new 2022.11.14 Use time-varying dz
-                    zeta1 = ds1['zeta'].values #jx
-                    zw1 = zrfun.get_z(G['h'], zeta1, S, only_w=True) #jx
-                    dz1 = np.diff(zw1, axis=0) #jx 
-                    dKdz1 = np.diff(AKs1, axis=0)/dz1
-                    dKdzf1 = dKdz1[Maskr3]
-                    
-            z1 = ds1['zeta'][0,:,:].values
-            zf0 = zf1.copy()
-            zf1 = z1[Maskr]
-            if verbose:
-                print('   > Prepare subsequent fields for tree %0.4f sec' % (time()-tt0))
-        ds0.close()
-        ds1.close()
+            F0_old = F0
+            F1_old = F1
+            F0 = F1.copy()
+            F1 = next(field_iter)
+            for k in F1_old.keys():
+                if k not in F1.keys():
+                    # fields that were not read for this hour (the advection fields
+                    # when no_advection is True) keep the values from the first hour
+                    F0[k] = F0_old[k]
+                    F1[k] = F1_old[k]
+        uf0 = F0['uf']; uf1 = F1['uf']
+        vf0 = F0['vf']; vf1 = F1['vf']
+        wf0 = F0['wf']; wf1 = F1['wf']
+        trf0_dict = F0['trf_dict']; trf1_dict = F1['trf_dict']
+        zf0 = F0['zf']; zf1 = F1['zf']
+        if (surface == True) and (windage > 0):
+            Uwindf0 = F0['Uwindf']; Uwindf1 = F1['Uwindf']
+            Vwindf0 = F0['Vwindf']; Vwindf1 = F1['Vwindf']
+        if (surface == False) and (turb == True):
+            AKsf0 = F0['AKsf']; AKsf1 = F1['AKsf']
+            dKdzf0 = F0['dKdzf']; dKdzf1 = F1['dKdzf']
+        if verbose:
+            print('   > Get fields %0.4f sec' % (time()-tt0))
 
         if counter_his == 0:
             if trim_loc == True:
                 # remove points on land
-                xy = np.array((plon0,plat0)).T
                 #print(' ++ making pmask')
                 #print(maskr.shape)
-                pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+                pmask = maskr[get_nn(get_ix(plon0, plat0, pcs0), 'rho_un')]
                 #print(pmask)
                 # keep only points with pmask >= maskr_crit
                 pcond = pmask >= maskr_crit
@@ -305,26 +226,33 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
             P = dict()
             for vn in plist_main:
                 # NOTE: output is packed in a dict P of arrays ordered as [time, particle]
-                P[vn] = np.nan * np.ones((NTS,NP))
+                P[vn] = np.nan * np.ones((NB,NP))
+            P['ot'] = np.nan * np.ones(NB)
+            ib = 0 # the row of P for the next save
 
-            # write initial positions to the results arrays
-            P['lon'][it0,:] = plon
-            P['lat'][it0,:] = plat
             if surface == True:
                 pcs[:] = S['Cs_r'][-1]
-            P['cs'][it0,:] = pcs
-            
-            for vn in tracer_list:
-                P[vn][it0,:] = get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, 0, surface)
+            # write initial positions to the results arrays, unless they were
+            # already written to W as the end of the previous day
+            if (W is None) or (W['nt'] == 0):
+                P['lon'][ib,:] = plon
+                P['lat'][ib,:] = plat
+                P['cs'][ib,:] = pcs
                 
-            V = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, 0, surface)
-            ZH = get_zh(zf0,zf1,hf, plon, plat, 0)
-            P['u'][it0,:] = V[:,0]
-            P['v'][it0,:] = V[:,1]
-            P['w'][it0,:] = V[:,2]
-            P['zeta'][it0,:] = ZH[:,0]
-            P['h'][it0,:] = ZH[:,1]
-            P['z'][it0,:] = pcs * ZH.sum(axis=1) + ZH[:,0]
+                ix = get_ix(plon, plat, pcs)
+                for vn in tracer_list:
+                    P[vn][ib,:] = get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, 0, surface, ix=ix)
+                    
+                V = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, 0, surface, ix=ix)
+                ZH = get_zh(zf0,zf1,hf, plon, plat, 0, ix=ix)
+                P['u'][ib,:] = V[:,0]
+                P['v'][ib,:] = V[:,1]
+                P['w'][ib,:] = V[:,2]
+                P['zeta'][ib,:] = ZH[:,0]
+                P['h'][ib,:] = ZH[:,1]
+                P['z'][ib,:] = pcs * ZH.sum(axis=1) + ZH[:,0]
+                P['ot'][ib] = rot_save[it0]
+                ib += 1
             
         # do the particle tracking for a single pair of history files in ndiv steps
         it1 = it0
@@ -336,24 +264,31 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
             
             if TR['no_advection'] == False:
                 # RK4 integration
-                V0 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, fr0, surface)
-                ZH0 = get_zh(zf0,zf1,hf, plon, plat, fr0)
+                # Each stage gets its own nearest neighbor index cache (ix0, etc.)
+                # so that each tree is queried at most once per stage.
+                ix0 = get_ix(plon, plat, pcs)
+                V0 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, fr0, surface, ix=ix0)
+                ZH0 = get_zh(zf0,zf1,hf, plon, plat, fr0, ix=ix0)
                 plon1, plat1, pcs1 = update_position(dxg, dyg, maskr, V0, ZH0, S, delt/2,
                                                      plon, plat, pcs, surface)
-                V1 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon1, plat1, pcs1, frmid, surface)
-                ZH1 = get_zh(zf0,zf1,hf, plon1, plat1, frmid)
+                ix1 = get_ix(plon1, plat1, pcs1)
+                V1 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon1, plat1, pcs1, frmid, surface, ix=ix1)
+                ZH1 = get_zh(zf0,zf1,hf, plon1, plat1, frmid, ix=ix1)
                 plon2, plat2, pcs2 = update_position(dxg, dyg, maskr, V1, ZH1, S, delt/2,
                                                      plon, plat, pcs, surface)
-                V2 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon2, plat2, pcs2, frmid, surface)
-                ZH2 = get_zh(zf0,zf1,hf, plon2, plat2, frmid)
+                ix2 = get_ix(plon2, plat2, pcs2)
+                V2 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon2, plat2, pcs2, frmid, surface, ix=ix2)
+                ZH2 = get_zh(zf0,zf1,hf, plon2, plat2, frmid, ix=ix2)
                 plon3, plat3, pcs3 = update_position(dxg, dyg, maskr, V2, ZH2, S, delt,
                                                      plon, plat, pcs, surface)
-                V3 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon3, plat3, pcs3, fr1, surface)
-                ZH3 = get_zh(zf0,zf1,hf, plon3, plat3, fr1)
+                ix3 = get_ix(plon3, plat3, pcs3)
+                V3 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon3, plat3, pcs3, fr1, surface, ix=ix3)
+                ZH3 = get_zh(zf0,zf1,hf, plon3, plat3, fr1, ix=ix3)
                 
                 # add windage, calculated from the middle time
                 if (surface == True) and (windage > 0):
-                    Vwind3 = get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frmid, windage)
+                    Vwind3 = get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frmid, windage,
+                        ix=ix0)
                 else:
                     Vwind3 = np.zeros((NP,3))
                 
@@ -393,11 +328,12 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
             # add turbulence to vertical position change (advection already added above)
             if turb == True:
                 # pull values of VdAKs and add up to 3-dimensions
-                VdAKs = get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frmid)
+                ixt = get_ix(plon, plat, pcs)
+                VdAKs = get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frmid, ix=ixt)
                 VdAKs3 = np.zeros((NP,3))
                 VdAKs3[:,2] = VdAKs
                 # update position advecting vertically with 1/2 of AKs gradient
-                ZH = get_zh(zf0,zf1,hf, plon, plat, frmid)
+                ZH = get_zh(zf0,zf1,hf, plon, plat, frmid, ix=ixt)
                 plon_junk, plat_junk, pcs_half = update_position(dxg, dyg, maskr,
                                 VdAKs3/2, ZH, S, delt/2, plon, plat, pcs, surface)
                 # get AKs at this height, and thence the turbulent perturbation velocity
@@ -412,30 +348,267 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
             nihr = int(ndiv/TR['sph']) # number of fractions 1/ndiv between saves
             if np.mod(ihr,nihr) == 0:
                 it1 += 1
+                if ib == NB:
+                    # the block is full so write it out and start over
+                    tfnc.write_block(W, P)
+                    ib = 0
                 # write positions to the results arrays
-                P['lon'][it1,:] = plon
-                P['lat'][it1,:] = plat
+                P['lon'][ib,:] = plon
+                P['lat'][ib,:] = plat
                 if surface == True:
                     pcs[:] = S['Cs_r'][-1]
-                P['cs'][it1,:] = pcs
+                P['cs'][ib,:] = pcs
                 
+                ix = get_ix(plon, plat, pcs)
                 for vn in tracer_list:
-                    P[vn][it1,:] = get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, fr1, surface)
-
-                P['u'][it1,:] = V3[:,0]
-                P['v'][it1,:] = V3[:,1]
-                P['w'][it1,:] = V3[:,2]
-                P['zeta'][it1,:] = ZH3[:,0]
-                P['h'][it1,:] = ZH3[:,1]
-                P['z'][it1,:] = pcs * ZH3.sum(axis=1) + ZH3[:,0]
+                    P[vn][ib,:] = get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, fr1, surface, ix=ix)
+
+                P['u'][ib,:] = V3[:,0]
+                P['v'][ib,:] = V3[:,1]
+                P['w'][ib,:] = V3[:,2]
+                P['zeta'][ib,:] = ZH3[:,0]
+                P['h'][ib,:] = ZH3[:,1]
+                P['z'][ib,:] = pcs * ZH3.sum(axis=1) + ZH3[:,0]
+                # and save the time (seconds in whatever the model reports)
+                P['ot'][ib] = rot_save[it1]
+                ib += 1
         if verbose:
             print('   > RK4 integration took %0.4f sec' % (time()-tt00))
         
-    # and save the time vector (seconds in whatever the model reports)
-    P['ot'] = rot_save
+    # keep only the rows that were used, and write them out if we are streaming
+    for vn in P.keys():
+        P[vn] = P[vn][:ib]
+    if W is not None:
+        tfnc.write_block(W, P)
 
     return P
     
+def read_fields(fn, surface, turb, windage, read_adv=True):
+    """
+    Read the fields needed for tracking from one history file, and return
+    them as masked, flattened arrays packed in a dict F.
+    
+    When read_adv is False the 3D velocity and tracer fields are skipped,
+    which is used for the no_advection case.
+
+    This may run in a background thread, so all the netCDF access is done
+    holding tfnc.nc_lock.
+    """
+    # hold the lock shared with the output writer (see trackfun_nc.nc_lock)
+    with tfnc.nc_lock:
+        ds = xr.open_dataset(fn)
+        F = dict()
+        if surface == True:
+            u = ds['u'][0,-1,:,:].values
+            F['uf'] = u[Masku]
+            v = ds['v'][0,-1,:,:].values
+            F['vf'] = v[Maskv]
+            F['wf'] = 0
+            trf_dict = dict()
+            for vn in tracer_list:
+                tr = ds[vn][0,-1,:,:].values
+                trf_dict[vn] = tr[Maskr]
+            F['trf_dict'] = trf_dict
+            if windage > 0:
+                Uwind = ds['Uwind'][0,:,:].values
+                F['Uwindf'] = Uwind[Maskr]
+                Vwind = ds['Vwind'][0,:,:].values
+                F['Vwindf'] = Vwind[Maskr]
+        else:
+            if read_adv == True:
+                u = ds['u'][0,:,:,:].values
+                F['uf'] = u[Masku3]
+                v = ds['v'][0,:,:,:].values
+                F['vf'] = v[Maskv3]
+                w = ds['w'][0,:,:,:].values
+                F['wf'] = w[Maskw3]
+                trf_dict = dict()
+                for vn in tracer_list:
+                    tr = ds[vn][0,:,:,:].values
+                    trf_dict[vn] = tr[Maskr3]
+                F['trf_dict'] = trf_dict
+            if turb == True:
+                AKs_temp = ds['AKs'][0,:,:,:].values
+                # modify top and bottom AKs to be non-negligible
+                AKs_temp[0,:,:] = AKs_temp[1,:,:]
+                AKs_temp[-1,:,:] = AKs_temp[-2,:,:]
+                AKs = AKs_temp.copy()
+                AKs[1:-1,:,:] = 0.25*AKs_temp[:-2,:,:] + 0.5*AKs_temp[1:-1,:,:] + 0.25*AKs_temp[2:,:,:]
+                F['AKsf'] = AKs[Maskw3]
+                # New 2022.11.14 use time-varying dz
+                zeta = ds['zeta'].values #jx
+                zw = zrfun.get_z(G['h'], zeta, S, only_w=True) #jx
+                dz = np.diff(zw, axis=0) #jx
+                dKdz = np.diff(AKs, axis=0)/dz #jx
+                F['dKdzf'] = dKdz[Maskr3]
+        z = ds['zeta'][0,:,:].values
+        F['zf'] = z[Maskr]
+        ds.close()
+    return F
+
+def get_field_iter(fn_list, TR):
+    """
+    Returns an iterator that gives the result of read_fields() for each
+    history file in fn_list, in order.
+    
+    If TR['prefetch'] is True the files are read by a background thread, so
+    that reading hour n+1 overlaps with the integration of hour n.  The thread
+    does not start reading hour n+1 until get_tracks() has taken hour n, so at
+    most one hour is read ahead (one extra set of fields in memory).
+    
+    If TR has the key 'field_cache' the fields are loaded from the files
+    written there by cache_fields() instead.
+    """
+    surface = not TR['3d']
+    def read_all():
+        for ii in range(len(fn_list)):
+            if 'field_cache' in TR.keys():
+                # fields already read by cache_fields()
+                yield read_cached_fields(fn_list[ii], TR['field_cache'])
+                continue
+            # the first two files always get all fields
+            read_adv = (ii <= 1) or (TR['no_advection'] == False)
+            yield read_fields(fn_list[ii], surface, TR['turb'], TR['windage'],
+                read_adv=read_adv)
+    if TR['prefetch'] == False:
+        return read_all()
+    q = queue.Queue()
+    # released each time get_tracks() takes an hour from q
+    taken = threading.Semaphore(0)
+    def reader():
+        try:
+            all_iter = read_all()
+            for ii in range(len(fn_list)):
+                if ii > 0:
+                    # wait until the previous hour has been taken
+                    taken.acquire()
+                q.put(next(all_iter))
+        except Exception as e:
+            # pass errors on to the main thread
+            q.put(e)
+    threading.Thread(target=reader, daemon=True).start()
+    def get_all():
+        for ii in range(len(fn_list)):
+            F = q.get()
+            taken.release()
+            if isinstance(F, Exception):
+                raise F
+            yield F
+    return get_all()
+
+def cache_dir_name(fn, cache_dir):
+    # directory for the cached fields of one history file, e.g. f2019.07.04_ocean_his_0002
+    return cache_dir / (fn.parent.name + '_' + fn.stem)
+
+def cache_fields(fn_list, TR, cache_dir):
+    """
+    Read the fields for all of fn_list once, and save them as .npy files
+    in cache_dir so that they can be shared by the worker processes of
+    get_tracks_parallel() as memory-mapped arrays.
+    """
+    Lfun.make_dir(cache_dir, clean=True)
+    field_iter = get_field_iter(fn_list, TR)
+    for fn in fn_list:
+        F = next(field_iter)
+        fdir = cache_dir_name(fn, cache_dir)
+        Lfun.make_dir(fdir)
+        for k in F.keys():
+            if k == 'trf_dict':
+                for vn in F[k].keys():
+                    np.save(fdir / ('trf_' + vn + '.npy'), F[k][vn])
+            else:
+                np.save(fdir / (k + '.npy'), F[k])
+
+def read_cached_fields(fn, cache_dir):
+    # load the fields for one history file saved by cache_fields()
+    fdir = cache_dir_name(fn, cache_dir)
+    F = dict()
+    trf_dict = dict()
+    for ffn in fdir.glob('*.npy'):
+        k = ffn.stem
+        if k[:4] == 'trf_':
+            trf_dict[k[4:]] = np.load(ffn, mmap_mode='r')
+        elif k == 'wf':
+            F[k] = np.load(ffn) # surface tracking has wf = 0
+        else:
+            F[k] = np.load(ffn, mmap_mode='r')
+    if len(trf_dict) > 0:
+        F['trf_dict'] = trf_dict
+    return F
+
+def get_tracks_parallel(fn_list, plon0, plat0, pcs0, TR, cache_dir, trim_loc=False):
+    """
+    This does the same thing as get_tracks(), but splits the particles into
+    TR['Nproc'] chunks that are tracked by separate processes.
+    
+    The fields are read only once, by cache_fields(), and the workers
+    share them as memory-mapped files in cache_dir, which is removed at the end
+    (also if a worker fails, in which case its traceback is raised here).
+    The workers are forked, so they also share the trees and grid info.
+    
+    The results are merged into a single dict P, the same as from get_tracks().
+    """
+    try:
+        tt0 = time()
+        cache_fields(fn_list, TR, cache_dir)
+        if verbose:
+            print('   > Cache fields %0.4f sec' % (time()-tt0))
+        TRw = TR.copy()
+        TRw['field_cache'] = cache_dir
+        TRw['prefetch'] = False
+        ctx = mp.get_context('fork')
+        # workers that fail send (chunk index, traceback) back through this
+        err_q = ctx.Queue()
+        
+        def worker(ii, ind):
+            # track one chunk of particles and save the result
+            try:
+                np.random.seed() # otherwise all workers share the same random numbers
+                Pw = get_tracks(fn_list, plon0[ind], plat0[ind], pcs0[ind], TRw, trim_loc=trim_loc)
+                pickle.dump(Pw, open(cache_dir / ('P_' + str(ii) + '.p'), 'wb'))
+            except BaseException:
+                err_q.put((ii, traceback.format_exc()))
+                sys.exit(1)
+            
+        ind_list = np.array_split(np.arange(len(plon0)), TR['Nproc'])
+        proc_list = []
+        for ii in range(len(ind_list)):
+            proc = ctx.Process(target=worker, args=(ii, ind_list[ii]))
+            proc.start()
+            proc_list.append(proc)
+        for proc in proc_list:
+            proc.join()
+        err_dict = dict()
+        while True:
+            try:
+                ii, tb = err_q.get(timeout=1)
+                err_dict[ii] = tb
+            except queue.Empty:
+                break
+        for ii in range(len(proc_list)):
+            if proc_list[ii].exitcode != 0:
+                # re-raise the first failure, with the worker's traceback
+                if ii in err_dict.keys():
+                    msg = err_dict[ii]
+                else:
+                    msg = 'no traceback (exit code %s)' % (str(proc_list[ii].exitcode))
+                raise RuntimeError('get_tracks_parallel(): worker for particle chunk %d of %d failed:\n%s'
+                    % (ii, len(proc_list), msg))
+            
+        # merge the results, stacking the chunks along the particle axis
+        Pw_list = [pickle.load(open(cache_dir / ('P_' + str(ii) + '.p'), 'rb'))
+            for ii in range(len(ind_list))]
+        P = dict()
+        for vn in Pw_list[0].keys():
+            if vn == 'ot':
+                P[vn] = Pw_list[0][vn]
+            else:
+                P[vn] = np.concatenate([Pw[vn] for Pw in Pw_list], axis=1)
+    finally:
+        # always remove the cached fields, even if something failed
+        shutil.rmtree(str(cache_dir), ignore_errors=True)
+    return P
+
 def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface):
     
     # find the new position
@@ -458,8 +631,8 @@ def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface)
     # ## * minimum grid sizes used when particles approach land boundaries
     # Experiments with "trap0" to explore trapping in the Skokomish
     # showed that ## = 0.5 is a reasonable choice.
-    xy = np.array((Plon,Plat)).T
-    pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+    ix = get_ix(Plon, Plat, Pcs)
+    pmask = maskr[get_nn(ix, 'rho_un')]
     pcond = pmask < maskr_crit # a Boolean mask
     if len(pcond) > 0:
         # these randint calls give random vectors of -1,0,1 (note the 2!)
@@ -469,12 +642,12 @@ def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface)
         Plat[pcond] = plat[pcond] + 0.5*riy[pcond]*dyg
         
     # move any particles on land to the middle of the nearest good rho point.
-    xy = np.array((Plon,Plat)).T
-    pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+    ix = get_ix(Plon, Plat, Pcs)
+    pmask = maskr[get_nn(ix, 'rho_un')]
     pcond = pmask < maskr_crit # a Boolean mask
     if len(pcond) > 0:
-        Plon_NEW = lonrf[xyT_rho.query(xy, workers=-1)[1]]
-        Plat_NEW = latrf[xyT_rho.query(xy, workers=-1)[1]]
+        Plon_NEW = lonrf[get_nn(ix, 'rho')]
+        Plat_NEW = latrf[get_nn(ix, 'rho')]
         Plon[pcond] = Plon_NEW[pcond]
         Plat[pcond] = Plat_NEW[pcond]
         
@@ -511,34 +684,170 @@ def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface)
 
     return Plon, Plat, Pcs
 
-def get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, frac, surface):
+def get_ix(plon, plat, pcs):
+    """
+    Start a nearest neighbor index cache for one set of particle positions,
+    typically one stage of the RK4 integration.  Pass the result as "ix" to
+    get_vel(), get_zh(), get_VR(), etc. and each tree is queried at most once
+    for these positions, with the indices reused for both time levels
+    and all tracers.
+    """
+    ix = {'plon':plon, 'plat':plat, 'pcs':pcs}
+    return ix
+
+def get_nn(ix, tag):
+    # Get the nearest neighbor indices for "tag" (a key of tree_fn_dict)
+    # at the positions in ix, searching only the first time they are needed.
+    if tag not in ix.keys():
+        if locator == 'grid':
+            ix[tag] = get_nn_grid(ix, tag)
+        else:
+            ix[tag] = get_nn_tree(ix, tag)
+    return ix[tag]
+
+def get_nn_tree(ix, tag):
+    # Query the pre-made tree for "tag".
+    if tag[-1] == '3':
+        xys = np.array((ix['plon'],ix['plat'],ix['pcs'])).T
+    else:
+        xys = np.array((ix['plon'],ix['plat'])).T
+    # use workers=-1 to use all available cores
+    return get_tree(tag).query(xys, workers=-1)[1]
+
+def nearest_ind(x, xvec):
+    # index of the element of the increasing vector xvec nearest to each x
+    i1 = np.searchsorted(xvec, x).clip(1, len(xvec)-1)
+    i0 = i1 - 1
+    return np.where(x - xvec[i0] <= xvec[i1] - x, i0, i1)
+
+def get_nn_grid(ix, tag):
+    """
+    Find the same nearest neighbor indices as get_nn_tree() using the fact that
+    the LO grids are plaid in lon, lat.  The horizontal search is a binary search
+    on the coordinate vectors, and in 3D the vertical search is over the
+    fractional z (z/h at zeta = 0) of the column, as used in make_KDTrees.py.
+    
+    In 2D the result is identical to the tree.  In 3D it is identical when all
+    columns have the same fractional z (hc = 0).  Otherwise the tree, which mixes
+    degrees and fractional z in its distance, can choose a neighboring column
+    near cell edges.  See test_locator.py.
+    
+    Particles whose nearest grid point is masked are passed to the tree.
+    """
+    gl = loc_dict[tag.replace('_un','').replace('3','')]
+    i = nearest_ind(ix['plon'], gl['xvec'])
+    j = nearest_ind(ix['plat'], gl['yvec'])
+    ic = j*gl['NC'] + i # index into the flattened full 2D field
+    if tag == 'rho_un':
+        return ic
+    iw = gl['lookup'][ic] # index into the masked 2D field
+    if tag[-1] == '3':
+        hh = gl['hf'][ic]
+        if tag == 'w3':
+            z = zrfun.get_z(hh, 0*hh, S, only_w=True)
+        else:
+            z = zrfun.get_z(hh, 0*hh, S, only_rho=True)
+        k = np.argmin(np.abs(z/hh - ix['pcs']), axis=0)
+        nn = k*gl['NW'] + iw
+    else:
+        nn = iw.copy()
+    land = iw == -1
+    if land.any():
+        ixl = {'plon':ix['plon'][land], 'plat':ix['plat'][land]}
+        if tag[-1] == '3':
+            ixl['pcs'] = ix['pcs'][land]
+        nn[land] = get_nn_tree(ixl, tag)
+    return nn
+
+def lin_ind(x, xvec):
+    # indices of the elements of the increasing vector xvec that bracket
+    # each x, and the fraction of the way between them (limited to 0-1)
+    i1 = np.searchsorted(xvec, x).clip(1, len(xvec)-1)
+    i0 = i1 - 1
+    fr = ((x - xvec[i0])/(xvec[i1] - xvec[i0])).clip(0,1)
+    return i0, i1, fr
+
+def get_lin(ix, tag):
+    """
+    Get the indices and weights for linear interpolation of a masked, flattened
+    field of type "tag" to the positions in ix.  This is bilinear in lon, lat,
+    and in 3D also linear in the fractional z (z/h at zeta = 0) of each of the
+    four corner columns.  Like the nearest neighbor indices these are saved in
+    ix, so they are only made once per stage.
+    
+    Corners on land get zero weight and the rest are renormalized.  Particles
+    with all corners on land use the nearest neighbor.
+    
+    Returns arrays inds, wts, both shaped (number of corners, NP).
+    """
+    key = tag + '_lin'
+    if key not in ix.keys():
+        gl = loc_dict[tag.replace('3','')]
+        i0, i1, xf = lin_ind(ix['plon'], gl['xvec'])
+        j0, j1, yf = lin_ind(ix['plat'], gl['yvec'])
+        NC = gl['NC']
+        ic = np.array([j0*NC + i0, j0*NC + i1, j1*NC + i0, j1*NC + i1])
+        wts = np.array([(1-yf)*(1-xf), (1-yf)*xf, yf*(1-xf), yf*xf])
+        iw = gl['lookup'][ic]
+        land = iw == -1
+        if tag[-1] == '3':
+            hh = gl['hf'][ic]
+            if tag == 'w3':
+                z = zrfun.get_z(hh.flatten(), 0*hh.flatten(), S, only_w=True)
+            else:
+                z = zrfun.get_z(hh.flatten(), 0*hh.flatten(), S, only_rho=True)
+            zf = z.reshape((-1,) + hh.shape)/hh
+            nz = zf.shape[0]
+            # bracketing levels (fractional z increases upward)
+            k1 = (zf < ix['pcs']).sum(axis=0).clip(1, nz-1)
+            k0 = k1 - 1
+            zf0 = np.take_along_axis(zf, k0.reshape((1,) + k0.shape), axis=0)[0]
+            zf1 = np.take_along_axis(zf, k1.reshape((1,) + k1.shape), axis=0)[0]
+            zfr = ((ix['pcs'] - zf0)/(zf1 - zf0)).clip(0,1)
+            inds = np.concatenate((k0*gl['NW'] + iw, k1*gl['NW'] + iw))
+            wts = np.concatenate((wts*(1-zfr), wts*zfr))
+            land = np.concatenate((land, land))
+        else:
+            inds = iw
+        inds[land] = 0
+        wts[land] = 0
+        wsum = wts.sum(axis=0)
+        on_land = wsum == 0
+        wts[:,~on_land] = wts[:,~on_land]/wsum[~on_land]
+        if on_land.any():
+            inds[0,on_land] = get_nn(ix, tag)[on_land]
+            wts[0,on_land] = 1
+        ix[key] = (inds, wts)
+    return ix[key]
+
+def get_val(ff, ix, tag):
+    # Get values of the masked, flattened field ff of type "tag" at
+    # the positions in ix, using the method set by "interp".
+    if interp == 'lin':
+        inds, wts = get_lin(ix, tag)
+        ffi = ff[inds]*wts
+        ffi[wts == 0] = 0 # in case land corners point to nan values
+        return ffi.sum(axis=0)
+    else:
+        return ff[get_nn(ix, tag)]
+
+def get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, frac, surface, ix=None):
     # Get the velocity at all points, at an arbitrary time between two saves
     # "frac" is the fraction of the way between the times of ds0 and ds1, 0 <= frac <= 1.
     # NOTE: with ndiv=1 this gets called 4 times per hour, or 96 times per day.
+    if ix is None:
+        ix = get_ix(plon, plat, pcs)
     NP = len(plon)
     V = np.zeros((NP,3))
     if surface == True:
-        xy = np.array((plon,plat)).T
-        # use workers=-1 to use all available cores
-        ui0 = uf0[xyT_u.query(xy, workers=-1)[1]]
-        vi0 = vf0[xyT_v.query(xy, workers=-1)[1]]
-        ui1 = uf1[xyT_u.query(xy, workers=-1)[1]]
-        vi1 = vf1[xyT_v.query(xy, workers=-1)[1]]
-        ui = (1 - frac)*ui0 + frac*ui1
-        vi = (1 - frac)*vi0 + frac*vi1
+        ui = (1 - frac)*get_val(uf0, ix, 'u') + frac*get_val(uf1, ix, 'u')
+        vi = (1 - frac)*get_val(vf0, ix, 'v') + frac*get_val(vf1, ix, 'v')
         V[:,0] = ui
         V[:,1] = vi
     else:
-        xys = np.array((plon,plat,pcs)).T
-        ui0 = uf0[xyzT_u.query(xys, workers=-1)[1]]
-        vi0 = vf0[xyzT_v.query(xys, workers=-1)[1]]
-        wi0 = wf0[xyzT_w.query(xys, workers=-1)[1]]
-        ui1 = uf1[xyzT_u.query(xys, workers=-1)[1]]
-        vi1 = vf1[xyzT_v.query(xys, workers=-1)[1]]
-        wi1 = wf1[xyzT_w.query(xys, workers=-1)[1]]
-        ui = (1 - frac)*ui0 + frac*ui1
-        vi = (1 - frac)*vi0 + frac*vi1
-        wi = (1 - frac)*wi0 + frac*wi1
+        ui = (1 - frac)*get_val(uf0, ix, 'u3') + frac*get_val(uf1, ix, 'u3')
+        vi = (1 - frac)*get_val(vf0, ix, 'v3') + frac*get_val(vf1, ix, 'v3')
+        wi = (1 - frac)*get_val(wf0, ix, 'w3') + frac*get_val(wf1, ix, 'w3')
         V[:,0] = ui
         V[:,1] = vi
         V[:,2] = wi
@@ -546,64 +855,59 @@ def get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, frac, surface):
     V[np.isnan(V)] = 0.0
     return V
     
-def get_zh(zf0,zf1,hf, plon, plat, frac):
+def get_zh(zf0,zf1,hf, plon, plat, frac, ix=None):
     # Get zeta and h at all points, at an arbitrary time between two saves
+    if ix is None:
+        ix = get_ix(plon, plat, None)
     NP = len(plon)
-    xy = np.array((plon,plat)).T
-    zi0 = zf0[xyT_rho.query(xy, workers=-1)[1]]
-    zi1 = zf1[xyT_rho.query(xy, workers=-1)[1]]
-    hi = hf[xyT_rho.query(xy, workers=-1)[1]]
-    zi = (1 - frac)*zi0 + frac*zi1
+    zi = (1 - frac)*get_val(zf0, ix, 'rho') + frac*get_val(zf1, ix, 'rho')
+    hi = get_val(hf, ix, 'rho')
     ZH = np.zeros((NP,2))
     ZH[:,0] = zi
     ZH[:,1] = hi
     return ZH
     
-def get_VR(tf0,tf1, plon, plat, pcs, frac, surface):
+def get_VR(tf0,tf1, plon, plat, pcs, frac, surface, ix=None):
     # Get a variable on the z_rho grid at all points.
+    if ix is None:
+        ix = get_ix(plon, plat, pcs)
     if surface == True:
-        xy = np.array((plon,plat)).T
-        ti0 = tf0[xyT_rho.query(xy, workers=-1)[1]]
-        ti1 = tf1[xyT_rho.query(xy, workers=-1)[1]]
+        tag = 'rho'
     else:
-        xys = np.array((plon,plat,pcs)).T
-        ti0 = tf0[xyzT_rho.query(xys, workers=-1)[1]]
-        ti1 = tf1[xyzT_rho.query(xys, workers=-1)[1]]
-    ti = (1 - frac)*ti0 + frac*ti1
+        tag = 'rho3'
+    ti = (1 - frac)*get_val(tf0, ix, tag) + frac*get_val(tf1, ix, tag)
     return ti
     
-def get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frac, windage):
+def get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frac, windage, ix=None):
     # creates the windage correction to the surface velocity (u,v only)
+    if ix is None:
+        ix = get_ix(plon, plat, None)
     NP = len(plon)
     Vwind3 = np.zeros((NP,3))
-    xy = np.array((plon,plat)).T
-    Uwind00 = Uwindf0[xyT_rho.query(xy, workers=-1)[1]]
-    Uwind11 = Uwindf1[xyT_rho.query(xy, workers=-1)[1]]
-    Uwind = (1 - frac)*Uwind00 + frac*Uwind11
-    Vwind00 = Vwindf0[xyT_rho.query(xy, workers=-1)[1]]
-    Vwind11 = Vwindf1[xyT_rho.query(xy, workers=-1)[1]]
-    Vwind = (1 - frac)*Vwind00 + frac*Vwind11
+    Uwind = (1 - frac)*get_val(Uwindf0, ix, 'rho') + frac*get_val(Uwindf1, ix, 'rho')
+    Vwind = (1 - frac)*get_val(Vwindf0, ix, 'rho') + frac*get_val(Vwindf1, ix, 'rho')
     Vwind3[:,0] = windage*Uwind
     Vwind3[:,1] = windage*Vwind
     return Vwind3
     
-def get_AKs(AKsf, plon, plat, pcs):
+def get_AKs(AKsf, plon, plat, pcs, ix=None):
     # Get AKs at all points, at one time.
-    xys = np.array((plon,plat,pcs)).T
-    AKsi = AKsf[xyzT_w.query(xys, workers=-1)[1]]
+    if ix is None:
+        ix = get_ix(plon, plat, pcs)
+    AKsi = get_val(AKsf, ix, 'w3')
     return AKsi
     
-def get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frac):
-    xys = np.array((plon,plat,pcs)).T
-    dKdzi0 = dKdzf0[xyzT_rho.query(xys, workers=-1)[1]]
-    dKdzi1 = dKdzf1[xyzT_rho.query(xys, workers=-1)[1]]
-    dKdzi = (1 - frac)*dKdzi0 + frac*dKdzi1
+def get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frac, ix=None):
+    if ix is None:
+        ix = get_ix(plon, plat, pcs)
+    dKdzi = (1 - frac)*get_val(dKdzf0, ix, 'rho3') + frac*get_val(dKdzf1, ix, 'rho3')
     return dKdzi
 
 def get_turb(dAKs, AKsf0, AKsf1, delta_t, plon, plat, pcs, frac):
     # get the vertical turbulence correction components
-    V0 = get_AKs(AKsf0, plon, plat, pcs)
-    V1 = get_AKs(AKsf1, plon, plat, pcs)
+    ix = get_ix(plon, plat, pcs)
+    V0 = get_AKs(AKsf0, plon, plat, pcs, ix=ix)
+    V1 = get_AKs(AKsf1, plon, plat, pcs, ix=ix)
     # create weighted average diffusivity
     Vave = (1 - frac)*V0 + frac*V1
     # turbulence calculation from Banas, MacCready, and Hickey (2009)
@@ -4,6 +4,13 @@ Functions associated with NetCDF for tracker.
 
 from lo_tools import Lfun
 import xarray as xr
+import netCDF4 as nc
+import threading
+
+# The netCDF-C and HDF5 libraries are not thread-safe, so when the history files
+# are read by a background thread (trackfun.get_field_iter() with prefetch) the
+# reads and the writes in write_block() must not overlap. Both hold this lock.
+nc_lock = threading.Lock()
 
 # Info for NetCDF output, organized as {variable name: (long_name, units)}
 name_unit_dict = {'lon':('Longitude','degrees'), 'lat':('Latitude','degrees'),
@@ -67,3 +74,66 @@ def append_to_outfile(out_fn, P):
     out_fn.unlink(missing_ok=True)
     ds2.to_netcdf(out_fn)
     ds2.close()
+
+def start_writer(out_fn, float32=False, compress=False, NB=0):
+    """
+    Make a dict W that is used to write output incrementally to out_fn,
+    appending along an unlimited Time dimension.  Use it by passing W to
+    trackfun.get_tracks() or write_block(), and then call close_writer(W).
+    
+    This avoids holding the whole release in memory, and avoids re-writing the
+    whole file for each day the way append_to_outfile() does.
+    
+    float32 = True saves everything but "ot" as single precision in the file
+        (the arrays in memory are still double precision, so the tracking is not affected).
+    compress = True uses zlib compression (level 1).
+    NB = number of saves held in memory before writing (0 means one day).
+    
+    The file is created by the first call to write_block(), when we know how
+    many particles there are.
+    """
+    W = dict()
+    W['out_fn'] = out_fn
+    W['dtype'] = 'float32' if float32 else 'float64'
+    W['compress'] = compress
+    W['NB'] = NB
+    W['nt'] = 0 # number of times written so far
+    W['ds'] = None
+    return W
+
+def write_block(W, P, skip_first=False):
+    """
+    Append the arrays in P (ordered as [time, particle]) to the file for W.
+    Use skip_first=True to skip the first time, e.g. when P is a whole day and its
+    first time is the same as the last time of the previous day.
+    """
+    i0 = 1 if skip_first else 0
+    with nc_lock:
+        if W['ds'] is None:
+            NP = P['lon'].shape[1]
+            ds = nc.Dataset(W['out_fn'], 'w')
+            ds.createDimension('Time', None)
+            ds.createDimension('Particle', NP)
+            for vn in P.keys():
+                if vn == 'ot':
+                    v = ds.createVariable(vn, 'float64', ('Time',))
+                else:
+                    v = ds.createVariable(vn, W['dtype'], ('Time', 'Particle'),
+                        zlib=W['compress'], complevel=1, chunksizes=(1, NP))
+                v.long_name = name_unit_dict[vn][0]
+                v.units = name_unit_dict[vn][1]
+            W['ds'] = ds
+        ds = W['ds']
+        nt = P['ot'].shape[0] - i0
+        for vn in P.keys():
+            if vn == 'ot':
+                ds[vn][W['nt']:W['nt']+nt] = P[vn][i0:]
+            else:
+                ds[vn][W['nt']:W['nt']+nt,:] = P[vn][i0:,:]
+        W['nt'] += nt
+        ds.sync()
+
+def close_writer(W):
+    if W['ds'] is not None:
+        with nc_lock:
+            W['ds'].close()